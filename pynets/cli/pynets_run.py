@@ -3295,6 +3295,7 @@ def build_workflow(args, retval):
             if "func" in dir:
                 for cnfnd_tmp_dir in glob.glob(f"{dir}/*/confounds_tmp"):
                     shutil.rmtree(cnfnd_tmp_dir)
+                shutil.rmtree(f"{dir}/func/ncut_tmp", ignore_errors=True)
                 shutil.rmtree(f"{dir}/reg_fmri", ignore_errors=True)
                 for file_ in [i for i in glob.glob(
                         f"{dir}/func/*") if os.path.isfile(i)]:
@@ -3494,6 +3495,7 @@ def build_workflow(args, retval):
         # Clean up temporary directories
         print("Cleaning up...")
         if func_file:
+            shutil.rmtree(f"{subj_dir}/func/ncut_tmp", ignore_errors=True)
             for file_ in [i for i in glob.glob(
                     f"{subj_dir}/func/*") if os.path.isfile(i)]:
                 if ("reor-RAS" in file_) or ("res-" in file_):
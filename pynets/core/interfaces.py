@@ -508,13 +508,10 @@ class IndividualClustering(SimpleInterface):
         from nipype.utils.filemanip import fname_presuffix, copyfile
         from pynets.fmri import clustools
         from pynets.registration.reg_utils import check_orient_and_dims
-        from joblib import Parallel, delayed
         from joblib.externals.loky.backend import resource_tracker
         from pynets.registration import reg_utils as regutils
         from pynets.core.utils import decompress_nifti
         import pkg_resources
-        import shutil
-        import tempfile
         resource_tracker.warnings = None
 
         template = pkg_resources.resource_filename(
@@ -537,6 +534,7 @@ class IndividualClustering(SimpleInterface):
             hardcoded_params = yaml.load(stream)
             c_boot = hardcoded_params["c_boot"][0]
             nthreads = hardcoded_params["nthreads"][0]
+            scorr_rank = hardcoded_params["clustering_scorr_rank"][0]
         stream.close()
 
         clust_list = ["kmeans", "ward", "complete", "average", "ncut", "rena"]
@@ -633,127 +631,55 @@ class IndividualClustering(SimpleInterface):
         )
 
         atlas = nip.create_clean_mask()
-        nip.create_local_clustering(overwrite=True, r_thresh=0.4)
+        nip.create_local_clustering(overwrite=True, r_thresh=0.4,
+                                    scorr_rank=scorr_rank, n_jobs=nthreads)
+
+        # Eigenvectors of the local connectivity are shared across k, so they
+        # are cached next to the other outputs and removed once the workflow
+        # has finished (see pynets_run)
+        ncut_cache_dir = f"{self.inputs.outdir}/ncut_tmp"
 
         if self.inputs.clust_type in clust_list:
             if float(c_boot) > 1:
-                import random
-                from joblib import Memory
-                from joblib.externals.loky import get_reusable_executor
                 print(
                     f"Performing circular block bootstrapping with {c_boot}"
                     f" iterations..."
                 )
                 ts_data, block_size = nip.prep_boot()
 
-                cache_dir = tempfile.mkdtemp()
-                memory = Memory(cache_dir, verbose=0)
-                ts_data = memory.cache(ts_data)
-
-                def create_bs_imgs(ts_data, block_size, clust_mask_corr_img):
-                    import nibabel as nib
-                    from nilearn.masking import unmask
-                    from pynets.fmri.estimation import timeseries_bootstrap
-                    boot_series = timeseries_bootstrap(
-                        ts_data.func, block_size)[0].astype('float32')
-                    return unmask(boot_series, clust_mask_corr_img)
-
-                def run_bs_iteration(i, ts_data, work_dir, local_corr,
-                                     clust_type, _local_conn_mat_path,
-                                     num_conn_comps, _clust_mask_corr_img,
-                                     _standardize, _detrending, k,
-                                     _local_conn, conf, _dir_path,
-                                     _conn_comps):
-                    import os
-                    import time
-                    import gc
-                    from pynets.fmri.clustools import parcellate
-                    print(f"\nBootstrapped iteration: {i}")
-                    out_path = f"{work_dir}/boot_parc_tmp_{str(i)}.nii.gz"
-
-                    boot_img = create_bs_imgs(ts_data, block_size,
-                                              _clust_mask_corr_img)
-                    try:
-                        parcellation = parcellate(boot_img, local_corr,
-                                                  clust_type,
-                                                  _local_conn_mat_path,
-                                                  num_conn_comps,
-                                                  _clust_mask_corr_img,
-                                                  _standardize,
-                                                  _detrending, k, _local_conn,
-                                                  conf, _dir_path,
-                                                  _conn_comps)
-                        parcellation.to_filename(out_path)
-                        parcellation.uncache()
-                        boot_img.uncache()
-                        gc.collect()
-                    except BaseException:
-                        boot_img.uncache()
-                        gc.collect()
-                        return None
-                    _clust_mask_corr_img.uncache()
-                    return out_path
-
-                time.sleep(random.randint(1, 5))
-                counter = 0
-                boot_parcellations = []
-                while float(counter) < float(c_boot):
-                    with Parallel(n_jobs=nthreads, max_nbytes='8000M',
-                                  backend='loky', mmap_mode='r+',
-                                  temp_folder=cache_dir,
-                                  verbose=10) as parallel:
-                        iter_bootedparcels = parallel(
-                            delayed(run_bs_iteration)(
-                                i, ts_data, runtime.cwd, nip.local_corr,
-                                nip.clust_type, nip._local_conn_mat_path,
-                                nip.num_conn_comps, nip._clust_mask_corr_img,
-                                nip._standardize, nip._detrending, nip.k,
-                                nip._local_conn, nip.conf, nip._dir_path,
-                                nip._conn_comps) for i in
-                            range(c_boot))
-
-                        boot_parcellations.extend([i for i in
-                                                   iter_bootedparcels if
-                                                   i is not None])
-                        counter = len(boot_parcellations)
-                        del iter_bootedparcels
-                        gc.collect()
-
-                print('Bootstrapped samples complete:')
-                print(boot_parcellations)
+                boot_parcellations = clustools.bootstrap_parcellate(
+                    ts_data, int(c_boot), block_size, nip.clust_type, nip.k,
+                    nip._clust_mask_corr_img, conn_comps=nip._conn_comps,
+                    local_conn=nip._local_conn, n_jobs=nthreads,
+                    ncut_cache_dir=ncut_cache_dir)
+                del ts_data
+                gc.collect()
+
+                print(f"Bootstrapped samples complete: "
+                      f"{len(boot_parcellations)}")
                 print("Creating spatially-constrained consensus "
                       "parcellation...")
                 consensus_parcellation = clustools.ensemble_parcellate(
                     boot_parcellations,
-                    int(self.inputs.k)
+                    int(self.inputs.k),
+                    mask_img=nip._clust_mask_corr_img
                 )
                 nib.save(consensus_parcellation, nip.uatlas)
-                memory.clear(warn=False)
-                shutil.rmtree(cache_dir, ignore_errors=True)
-                del parallel, memory, cache_dir
-                get_reusable_executor().shutdown(wait=True)
+                del boot_parcellations
                 gc.collect()
-
-                for i in boot_parcellations:
-                    if os.path.isfile(i):
-                        os.remove(i)
             else:
                 print(
                     "Creating spatially-constrained parcellation...")
-                out_path = f"{runtime.cwd}/{atlas}_{str(self.inputs.k)}.nii.gz"
                 func_img = nib.load(out_name_func_file)
-                parcellation = clustools.parcellate(func_img,
-                                                    self.inputs.local_corr,
-                                                    self.inputs.clust_type,
-                                                    nip._local_conn_mat_path,
-                                                    nip.num_conn_comps,
-                                                    nip._clust_mask_corr_img,
-                                                    nip._standardize,
-                                                    nip._detrending, nip.k,
-                                                    nip._local_conn,
-                                                    nip.conf, nip._dir_path,
-                                                    nip._conn_comps)
-                parcellation.to_filename(out_path)
+                parcellation = clustools.parcellate(
+                    func_img, self.inputs.local_corr, self.inputs.clust_type,
+                    nip._local_conn_mat_path, nip.num_conn_comps,
+                    nip._clust_mask_corr_img, nip._standardize,
+                    nip._detrending, nip.k, nip._local_conn, nip.conf,
+                    nip._dir_path, nip._conn_comps,
+                    ncut_cache_dir=ncut_cache_dir)
+                if parcellation is not None:
+                    nib.save(parcellation, nip.uatlas)
 
         else:
             try:
@@ -1123,6 +1049,7 @@ class _RegisterDWIInputSpec(BaseInterfaceInputSpec):
     gtab_file = File(exists=True, mandatory=True)
     dwi_file = File(exists=True, mandatory=True)
     in_dir = traits.Any()
+    anat_cache = traits.Any(mandatory=False)
     vox_size = traits.Str("2mm", mandatory=True, usedefault=True)
     template_name = traits.Str("MNI152_T1", mandatory=True, usedefault=True)
     mask = traits.Any(mandatory=False)
@@ -1303,6 +1230,8 @@ class RegisterDWI(SimpleInterface):
             vox_size=self.inputs.vox_size,
             template_name=self.inputs.template_name,
             simple=self.inputs.simple,
+            anat_cache=self.inputs.anat_cache if self.inputs.anat_cache
+            else None,
         )
 
         # Generate T1w brain mask
@@ -1543,16 +1472,6 @@ class RegisterAtlasDWI(SimpleInterface):
             copy=True,
             use_hardlink=False)
 
-        t1w_brain_mask_tmp_path = fname_presuffix(
-            self.inputs.t1w_brain_mask, suffix="_tmp", newpath=runtime.cwd
-        )
-        copyfile(
-            self.inputs.t1w_brain_mask,
-            t1w_brain_mask_tmp_path,
-            copy=True,
-            use_hardlink=False,
-        )
-
         t1_aligned_mni_tmp_path = fname_presuffix(
             self.inputs.t1_aligned_mni, suffix="_tmp", newpath=runtime.cwd
         )
@@ -1604,13 +1523,12 @@ class RegisterAtlasDWI(SimpleInterface):
         base_dir_tmp = f"{runtime.cwd}/atlas_{atlas_name}"
         os.makedirs(base_dir_tmp, exist_ok=True)
 
-        mni2dwi_xfm = f"{base_dir_tmp}{'/'}{atlas_name}" \
-                              f"{'_mni2dwi_xfm.mat'}"
+        # Transforms composed for one atlas are reused by every other atlas of
+        # the subject
+        transform_dir = f"{self.inputs.basedir_path}/dmri_reg/reg/composed"
 
         aligned_atlas_t1mni = f"{base_dir_tmp}{'/'}{atlas_name}" \
                               f"{'_t1w_mni.nii.gz'}"
-        aligned_atlas_skull = f"{base_dir_tmp}{'/'}{atlas_name}" \
-                              f"{'_t1w_skull.nii.gz'}"
         dwi_aligned_atlas = f"{base_dir_tmp}{'/'}{atlas_name}" \
                             f"{'_dwi_track.nii.gz'}"
         dwi_aligned_atlas_wmgm_int = (
@@ -1630,7 +1548,6 @@ class RegisterAtlasDWI(SimpleInterface):
             uatlas_parcels_tmp_path,
             atlas_name,
             t1w_brain_tmp_path,
-            t1w_brain_mask_tmp_path,
             mni2t1w_warp_tmp_path,
             t1_aligned_mni_tmp_path,
             ap_tmp_path,
@@ -1639,12 +1556,11 @@ class RegisterAtlasDWI(SimpleInterface):
             t1w2dwi_xfm_tmp_path,
             wm_gm_int_in_dwi_tmp_path,
             aligned_atlas_t1mni,
-            aligned_atlas_skull,
             dwi_aligned_atlas,
             dwi_aligned_atlas_wmgm_int,
             B0_mask_tmp_path,
-            mni2dwi_xfm,
             self.inputs.simple,
+            transform_dir,
         )
 
         # Correct coords and labels
@@ -1663,10 +1579,6 @@ class RegisterAtlasDWI(SimpleInterface):
                 use_hardlink=False)
 
             # Align waymask
-            waymask_in_t1w = (
-                f"{runtime.cwd}/waymask-"
-                f"{os.path.basename(self.inputs.waymask).split('.nii')[0]}_"
-                f"in_t1w.nii.gz")
             waymask_in_dwi = (
                 f"{runtime.cwd}/waymask-"
                 f"{os.path.basename(self.inputs.waymask).split('.nii')[0]}_"
@@ -1679,10 +1591,10 @@ class RegisterAtlasDWI(SimpleInterface):
                 mni2t1w_warp_tmp_path,
                 mni2t1_xfm_tmp_path,
                 t1wtissue2dwi_xfm_tmp_path,
-                waymask_in_t1w,
                 waymask_in_dwi,
                 template_tmp_path,
                 self.inputs.simple,
+                transform_dir,
             )
             time.sleep(0.5)
             os.remove(waymask_tmp_path)
@@ -1732,7 +1644,6 @@ class RegisterAtlasDWI(SimpleInterface):
             uatlas_tmp_path,
             mni2t1w_warp_tmp_path,
             mni2t1_xfm_tmp_path,
-            t1w_brain_mask_tmp_path,
             t1_aligned_mni_tmp_path,
             t1w2dwi_bbr_xfm_tmp_path,
             t1w2dwi_xfm_tmp_path,
@@ -1862,9 +1773,6 @@ class RegisterROIDWI(SimpleInterface):
             copy=True,
             use_hardlink=False)
 
-        roi_in_t1w = f"{runtime.cwd}/waymask-" \
-                     f"{os.path.basename(self.inputs.roi).split('.nii')[0]}" \
-                     f"_in_t1w.nii.gz"
         roi_in_dwi = f"{runtime.cwd}/waymask-" \
                      f"{os.path.basename(self.inputs.roi).split('.nii')[0]}" \
                      f"_in_dwi.nii.gz"
@@ -1892,7 +1800,6 @@ class RegisterROIDWI(SimpleInterface):
             roi_in_dwi = regutils.roi2dwi_align(
                 roi_file_tmp_path,
                 t1w_brain_tmp_path2,
-                roi_in_t1w,
                 roi_in_dwi,
                 ap_tmp_path,
                 mni2t1w_warp_tmp_path2,
@@ -1900,6 +1807,7 @@ class RegisterROIDWI(SimpleInterface):
                 mni2t1_xfm_tmp_path,
                 template_tmp_path,
                 self.inputs.simple,
+                f"{self.inputs.basedir_path}/dmri_reg/reg/composed",
             )
             time.sleep(0.5)
         else:
@@ -1929,6 +1837,7 @@ class _RegisterFuncInputSpec(BaseInterfaceInputSpec):
     anat_file = File(exists=True, mandatory=True)
     mask = traits.Any(mandatory=False)
     in_dir = traits.Any(mandatory=True)
+    anat_cache = traits.Any(mandatory=False)
     vox_size = traits.Str("2mm", mandatory=True, usedefault=True)
     template_name = traits.Str("MNI152_T1", mandatory=True, usedefault=True)
     force_create_mask = traits.Bool(True, usedefault=True)
@@ -2053,6 +1962,8 @@ class RegisterFunc(SimpleInterface):
             vox_size=self.inputs.vox_size,
             template_name=self.inputs.template_name,
             simple=self.inputs.simple,
+            anat_cache=self.inputs.anat_cache if self.inputs.anat_cache
+            else None,
         )
 
         # Generate T1w brain mask
@@ -2424,6 +2335,7 @@ class RegisterAtlasFunc(SimpleInterface):
                 aligned_atlas_skull,
                 aligned_atlas_gm,
                 self.inputs.simple,
+                transform_dir=f"{self.inputs.basedir_path}/reg/composed",
             )
             time.sleep(0.5)
 
@@ -2650,6 +2562,7 @@ class _TrackingInputSpec(BaseInterfaceInputSpec):
     fa_path = File(exists=True, mandatory=True)
     waymask = traits.Any(mandatory=False)
     t1w2dwi = File(exists=True, mandatory=True)
+    outdir = traits.Any(mandatory=False)
 
 
 class _TrackingOutputSpec(TraitedSpec):
@@ -2703,7 +2616,7 @@ class Tracking(SimpleInterface):
         import pkg_resources
         import yaml
         from pynets.dmri.track import (
-            reconstruction,
+            reconstruction_blockwise,
             create_density_map,
             track_ensemble,
         )
@@ -2717,8 +2630,15 @@ class Tracking(SimpleInterface):
         ) as stream:
             hardcoded_params = yaml.load(stream)
             use_life = hardcoded_params['tracking']["use_life"][0]
+            life_batch_size = \
+                hardcoded_params['tracking']["life_batch_size"][0]
             roi_neighborhood_tol = hardcoded_params['tracking']["roi_neighborhood_tol"][0]
             sphere = hardcoded_params['tracking']["sphere"][0]
+            nthreads = hardcoded_params["nthreads"][0]
+            recon_slab_size = \
+                hardcoded_params['tracking']["recon_slab_size"][0]
+            recon_compression = \
+                hardcoded_params['tracking']["recon_compression"][0]
 
         stream.close()
 
@@ -2804,37 +2724,33 @@ class Tracking(SimpleInterface):
 
         gtab = load_pickle(gtab_file_tmp_path)
 
-        # Only re-run the reconstruction if we have to
-        if not os.path.isfile(f"{namer_dir}/{op.basename(recon_path)}"):
-            import h5py
-            model, _ = reconstruction(
-                self.inputs.conn_model,
-                gtab,
-                dwi_data,
-                B0_mask_tmp_path,
-            )
-            with h5py.File(recon_path, 'w') as hf:
-                hf.create_dataset("reconstruction",
-                                  data=model.astype('float32'), dtype='f4')
-            hf.close()
-
-            copyfile(
-                recon_path,
-                f"{namer_dir}/{op.basename(recon_path)}",
-                copy=True,
-                use_hardlink=False,
-            )
-            del model
+        # Only re-run the reconstruction if no reconstruction of the same
+        # dwi, gradients, mask and model parameters is cached, irrespective
+        # of the atlas, roi or node size. The cache belongs to the output
+        # directory, since the input directory may be read-only.
+        if self.inputs.outdir:
+            recon_cache_dir = f"{self.inputs.outdir}/reconstructions"
         else:
-            print(
-                f"Found existing reconstruction with "
-                f"{self.inputs.conn_model}. Loading...")
-            copyfile(
-                f"{namer_dir}/{op.basename(recon_path)}",
-                recon_path,
-                copy=True,
-                use_hardlink=False,
-            )
+            recon_cache_dir = None
+
+        reconstruction_blockwise(
+            self.inputs.conn_model,
+            gtab,
+            dwi_data,
+            B0_mask_tmp_path,
+            recon_path,
+            nthreads=nthreads,
+            slab_size=recon_slab_size,
+            recon_cache_dir=recon_cache_dir,
+            compression=recon_compression,
+        )
+
+        copyfile(
+            recon_path,
+            f"{namer_dir}/{op.basename(recon_path)}",
+            copy=True,
+            use_hardlink=False,
+        )
 
         dwi_img.uncache()
         del dwi_data
@@ -2951,8 +2867,15 @@ class Tracking(SimpleInterface):
 
         print(Style.RESET_ALL)
 
+        # Checkpoints must survive nipype emptying the node directory before
+        # a rerun, so they are kept in the output directory
+        if self.inputs.outdir:
+            checkpoint_dir = f"{self.inputs.outdir}/tracking_checkpoints"
+        else:
+            checkpoint_dir = None
+
         # Commence Ensemble Tractography
-        streamlines = track_ensemble(
+        streamlines, density = track_ensemble(
             self.inputs.target_samples,
             labels_im_file_tmp_path_wm_gm_int,
             labels_im_file_tmp_path,
@@ -2970,7 +2893,9 @@ class Tracking(SimpleInterface):
             t1w2dwi_tmp_path, gm_in_dwi_tmp_path,
             vent_csf_in_dwi_tmp_path, wm_in_dwi_tmp_path,
             self.inputs.tiss_class,
-            runtime.cwd
+            runtime.cwd,
+            return_density=True,
+            checkpoint_dir=checkpoint_dir
         )
 
         gc.collect()
@@ -3031,7 +2956,9 @@ class Tracking(SimpleInterface):
             try:
                 streamlines = evaluate_streamline_plausibility(
                     dwi_data, gtab, mask_data, streamlines,
-                    sphere=sphere)
+                    sphere=sphere, batch_size=life_batch_size)
+                # The density accumulated while tracking no longer matches
+                density = None
             except BaseException:
                 print(f"Linear Fascicle Evaluation failed. Visually checking "
                       f"streamlines output {namer_dir}/{op.basename(streams)}"
@@ -3082,12 +3009,13 @@ class Tracking(SimpleInterface):
                 self.inputs.min_length,
                 self.inputs.error_margin,
                 namer_dir,
+                density=density,
             )
         except BaseException:
             print('Density map failed. Check tractography output.')
             dm_path = None
 
-        del streamlines
+        del streamlines, density
         dwi_img.uncache()
         gc.collect()
 
@@ -15,6 +15,34 @@ from pathlib import Path
 warnings.filterwarnings("ignore")
 
 
+def get_sphere_offsets(r, vox_dims):
+    """
+    Return the voxel offsets of a sphere of radius r mm, relative to its
+    center. Generates a cube and then discards all points outside sphere.
+
+    Parameters
+    ----------
+    r : int
+        Radius for sphere.
+    vox_dims : array/tuple
+        1D vector (x, y, z) of mm voxel resolution for sphere.
+
+    Returns
+    -------
+    offsets : array
+        An n x 3 array of (unrounded) voxel offsets that fall within a
+        spherical neighborhood of radius r.
+    """
+    r = float(r)
+    xx, yy, zz = [slice(-r / vox_dims[i], r / vox_dims[i] + 0.01, 1)
+                  for i in range(len(vox_dims))]
+    cube = np.vstack([row.ravel() for row in np.mgrid[xx, yy, zz]])
+    sphere = cube[:, np.sum(
+        np.dot(np.diag(vox_dims), cube) ** 2, 0) ** 0.5 <= r]
+
+    return sphere.T
+
+
 def get_sphere(coords, r, vox_dims, dims):
     """
     Return all points within r mm of coords. Generates a cube and then
@@ -45,13 +73,7 @@ def get_sphere(coords, r, vox_dims, dims):
      automated synthesis of human functional neuroimaging data.
      Frontiers in Neuroinformatics.
     """
-    r = float(r)
-    xx, yy, zz = [slice(-r / vox_dims[i], r / vox_dims[i] + 0.01, 1)
-                  for i in range(len(coords))]
-    cube = np.vstack([row.ravel() for row in np.mgrid[xx, yy, zz]])
-    sphere = cube[:, np.sum(
-        np.dot(np.diag(vox_dims), cube) ** 2, 0) ** 0.5 <= r]
-    sphere = np.round(sphere.T + coords)
+    sphere = np.round(get_sphere_offsets(r, vox_dims) + coords)
     neighbors = sphere[(np.min(sphere, 1) >= 0) & (
         np.max(np.subtract(sphere, dims), 1) <= -1), :].astype(int)
 
@@ -1730,7 +1730,11 @@ def dmri_connectometry(
         name="get_anisopwr_node",
     )
 
-    register_node = pe.Node(RegisterDWI(in_dir=in_dir), name="register_node")
+    # T1w derivatives are shared with the fmri workflow of a multimodal run
+    register_node = pe.Node(
+        RegisterDWI(in_dir=in_dir,
+                    anat_cache=f"{op.dirname(outdir)}/anat_tmp"),
+        name="register_node")
     register_node._n_procs = runtime_dict["register_node"][0]
     register_node._mem_gb = runtime_dict["register_node"][1]
 
@@ -1988,10 +1992,27 @@ def dmri_connectometry(
     streams2graph_node._mem_gb = runtime_dict["streams2graph_node"][1]
 
     if error_margin_list:
-        streams2graph_node.iterables = [("error_margin", error_margin_list)]
+        # Connectivity matrices for all error margins are estimated from a
+        # single pass over the streamlines, and are only then iterated over
+        select_error_margin_node = pe.Node(
+            niu.Function(
+                input_names=["conn_matrix", "error_margin_list",
+                             "error_margin"],
+                output_names=["conn_matrix", "error_margin"],
+                function=estimation.select_error_margin,
+                imports=import_list,
+            ),
+            name="select_error_margin_node",
+        )
+        select_error_margin_node.iterables = [("error_margin",
+                                               error_margin_list)]
+        select_error_margin_node.synchronize = True
         dmri_connectometry_wf.connect(
             [(inputnode, streams2graph_node,
-              [("error_margin", "error_margin")])]
+              [("error_margin_list", "error_margin")]),
+             (streams2graph_node, select_error_margin_node,
+              [("conn_matrix", "conn_matrix"),
+               ("error_margin", "error_margin_list")])]
         )
     else:
         dmri_connectometry_wf.connect(
@@ -2470,13 +2491,36 @@ def dmri_connectometry(
     else:
         atlas_join_source = None
 
-    # Connect all streams2graph_node outputs to the "thr_info" node
+    # Connect all streams2graph_node outputs to the "thr_info" node. With
+    # multiple error margins, the per-margin outputs instead come from the
+    # iterated select_error_margin_node.
+    em_connects = [("conn_matrix", "conn_matrix"),
+                   ("error_margin", "error_margin")]
+    if error_margin_list:
+        em_join_source = select_error_margin_node
+        streams2graph_connects = [
+            x for x in map_connects if x != ("thr", "thr") and
+            x not in em_connects]
+        dmri_connectometry_wf.connect(
+            [
+                (
+                    select_error_margin_node,
+                    thr_info_node,
+                    em_connects,
+                )
+            ]
+        )
+    else:
+        em_join_source = streams2graph_node
+        streams2graph_connects = [x for x in map_connects if
+                                  x != ("thr", "thr")]
+
     dmri_connectometry_wf.connect(
         [
             (
                 streams2graph_node,
                 thr_info_node,
-                [x for x in map_connects if x != ("thr", "thr")],
+                streams2graph_connects,
             )
         ]
     )
@@ -2522,7 +2566,7 @@ def dmri_connectometry(
                 join_iters_node_em = pe.JoinNode(
                     niu.IdentityInterface(fields=map_fields),
                     name="join_iters_node_em",
-                    joinsource=streams2graph_node,
+                    joinsource=em_join_source,
                     joinfield=map_fields,
                 )
                 dmri_connectometry_wf.connect(
@@ -2559,7 +2603,7 @@ def dmri_connectometry(
                 join_iters_node_em = pe.JoinNode(
                     niu.IdentityInterface(fields=map_fields),
                     name="join_iters_node_em",
-                    joinsource=streams2graph_node,
+                    joinsource=em_join_source,
                     joinfield=map_fields,
                 )
                 dmri_connectometry_wf.connect(
@@ -2592,7 +2636,7 @@ def dmri_connectometry(
                 join_iters_node_em = pe.JoinNode(
                     niu.IdentityInterface(fields=map_fields),
                     name="join_iters_node_em",
-                    joinsource=streams2graph_node,
+                    joinsource=em_join_source,
                     joinfield=map_fields,
                 )
                 dmri_connectometry_wf.connect(
@@ -2628,7 +2672,7 @@ def dmri_connectometry(
                 join_iters_node_em = pe.JoinNode(
                     niu.IdentityInterface(fields=map_fields),
                     name="join_iters_node_em",
-                    joinsource=streams2graph_node,
+                    joinsource=em_join_source,
                     joinfield=map_fields,
                 )
                 dmri_connectometry_wf.connect(
@@ -2674,11 +2718,21 @@ def dmri_connectometry(
                 (
                     streams2graph_node,
                     join_iters_node,
-                    [x for x in map_connects if x != ("thr", "thr")],
+                    streams2graph_connects,
                 ),
                 (thr_info_node, join_iters_node, [("thr", "thr")]),
             ]
         )
+        if error_margin_list:
+            dmri_connectometry_wf.connect(
+                [
+                    (
+                        select_error_margin_node,
+                        join_iters_node,
+                        em_connects,
+                    ),
+                ]
+            )
         no_iters = True
 
     # Create final thresh_diff node that performs the thresholding
@@ -3135,6 +3189,7 @@ def dmri_connectometry(
             (get_fa_node, register_node, [("fa_path", "fa_path")]),
             (get_fa_node, register_atlas_node, [("fa_path", "fa_path")]),
             (get_fa_node, run_tracking_node, [("fa_path", "fa_path")]),
+            (inputnode, run_tracking_node, [("outdir", "outdir")]),
             (register_node, run_tracking_node, [("t1w2dwi", "t1w2dwi")]),
             (
                 register_atlas_node,
@@ -3802,7 +3857,11 @@ def fmri_connectometry(
         name="check_orient_and_dims_anat_node",
     )
 
-    register_node = pe.Node(RegisterFunc(in_dir=in_dir), name="register_node")
+    # T1w derivatives are shared with the dmri workflow of a multimodal run
+    register_node = pe.Node(
+        RegisterFunc(in_dir=in_dir,
+                     anat_cache=f"{op.dirname(outdir)}/anat_tmp"),
+        name="register_node")
 
     register_node._n_procs = runtime_dict["register_node"][0]
     register_node._mem_gb = runtime_dict["register_node"][1]
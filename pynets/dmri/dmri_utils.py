@@ -95,6 +95,409 @@ def generate_sl(streamlines):
         yield sl
 
 
+def iter_streamline_chunks(streams, reference, chunk_size=10000):
+    """
+    Lazily read a tractogram file in fixed-size chunks of streamlines, so
+    that peak memory is independent of the total number of streamlines.
+
+    Parameters
+    ----------
+    streams : str
+        File path to streamline array sequence in .trk format.
+    reference : Nifti1Image
+        Reference image defining the voxel space of the streamlines.
+    chunk_size : int
+        Maximum number of streamlines yielded at a time.
+
+    Yields
+    ------
+    streamlines : list
+        List of up to `chunk_size` 2D float32 arrays of streamline points in
+        the VOXMM space (with NIFTI origin) of the reference image.
+
+    """
+    from itertools import islice
+    from dipy.io.utils import is_header_compatible
+
+    if streams.endswith(".trk") and not is_header_compatible(reference,
+                                                             streams):
+        try:
+            raise ValueError(f"Header of {streams} is not compatible with "
+                             f"the reference image.")
+        except ValueError:
+            import sys
+            sys.exit(1)
+
+    # Map RASMM streamline coordinates to VOXMM coordinates of the reference
+    voxel_sizes = np.asarray(reference.header.get_zooms()[:3],
+                             dtype=np.float32)
+    inv_affine = np.linalg.inv(reference.affine)
+
+    tractogram = nib.streamlines.load(streams, lazy_load=True).tractogram
+    streamlines = iter(tractogram.streamlines)
+    while True:
+        chunk = list(islice(streamlines, int(chunk_size)))
+        if len(chunk) == 0:
+            break
+        lengths = [len(s) for s in chunk]
+        points = nib.affines.apply_affine(
+            inv_affine, np.concatenate(chunk)).astype(np.float32)
+        points *= voxel_sizes
+        yield np.split(points, np.cumsum(lengths)[:-1])
+        del chunk, points
+
+
+def get_node_lut(atlas_data):
+    """
+    Build a lookup table from atlas label intensities to graph node indices.
+
+    Parameters
+    ----------
+    atlas_data : array
+        3D array of integer atlas parcellation labels.
+
+    Returns
+    -------
+    label_data : array
+        3D uint32 array of atlas parcellation labels.
+    node_lut : array
+        1D array indexed by label intensity, holding the 0-based index of the
+        corresponding graph node, or -1 for background/unknown labels.
+    roi_volumes : array
+        1D array of the voxel volume of each graph node.
+
+    """
+    atlas_uint16 = atlas_data.astype("uint16")
+    label_data = atlas_data.astype("uint32")
+    node_intensities = np.unique(atlas_uint16)[1:]
+    node_lut = np.full(int(label_data.max()) + 1, -1, dtype=np.intp)
+    node_lut[node_intensities] = np.arange(len(node_intensities))
+    roi_volumes = np.bincount(atlas_uint16.ravel())[node_intensities]
+    del atlas_uint16
+    return label_data, node_lut, roi_volumes
+
+
+def streamline_node_incidence(streamlines, label_data, node_lut, offsets,
+                              overlap_thr=1, batch_size=None,
+                              max_sphere_voxels=2 ** 22):
+    """
+    Label every streamline with the set of atlas nodes it intersects,
+    within a spherical margin of error around each of its points.
+
+    Parameters
+    ----------
+    streamlines : sequence
+        List/ArraySequence of 2D arrays of streamline points in voxel
+        coordinates.
+    label_data : array
+        3D uint32 array of atlas parcellation labels.
+    node_lut : array
+        1D array mapping label intensities to 0-based graph node indices,
+        with -1 denoting background/unknown labels.
+    offsets : array or list
+        An n x 3 array of sphere offsets, as returned by
+        `nodemaker.get_sphere_offsets`, or a list of such arrays (e.g. one
+        per error margin). In the latter case, every voxel in the union of
+        the spheres is labeled only once.
+    overlap_thr : int
+        Minimum number of labeled sphere voxels along a streamline required
+        to classify the streamline as a connection to that node.
+    batch_size : int
+        Number of streamlines whose points are labeled at once. Default is
+        None, which sizes each batch by `max_sphere_voxels`.
+    max_sphere_voxels : int
+        Maximum number of sphere voxels (streamline points x sphere
+        offsets) labeled at once when `batch_size` is None, which bounds
+        memory use for any error margin. A single streamline is always
+        labeled at once.
+
+    Returns
+    -------
+    incidence : csr_matrix or list
+        Sparse n_streamlines x n_nodes boolean matrix of streamline-node
+        intersections, or a list of such matrices (one per array of sphere
+        offsets) if a list of offsets was given.
+
+    """
+    from scipy.sparse import coo_matrix, vstack
+
+    multi = isinstance(offsets, (list, tuple))
+    offsets_list = list(offsets) if multi else [offsets]
+
+    # Label the union of the spheres once, and keep track of which of its
+    # offsets belong to each sphere
+    all_offsets, inverse = np.unique(np.vstack(offsets_list), axis=0,
+                                     return_inverse=True)
+    inverse = np.asarray(inverse).ravel()
+    members = []
+    start = 0
+    for off in offsets_list:
+        members.append(inverse[start:start + len(off)])
+        start += len(off)
+
+    # Split the offsets into integer parts and the rounding of their
+    # fractions, so that sphere voxels are computed in int32, with the same
+    # half-to-even rounding as np.round
+    off_floor = np.floor(all_offsets)
+    off_frac = all_offsets - off_floor
+    off_floor = off_floor.astype(np.int32)
+    off_up = (off_frac > 0.5).astype(np.int32)
+    off_half = off_frac == 0.5
+    del off_frac
+
+    dims = np.array(label_data.shape[:3], dtype=np.int32)
+    n_labels = len(node_lut)
+    n_nodes = int(node_lut.max()) + 1
+    flat_labels = label_data.ravel()
+    missing = set()
+
+    # Batches of streamlines, bounded by the number of sphere voxels that
+    # they label
+    if batch_size is None:
+        cum_points = np.cumsum([len(s) for s in streamlines])
+        max_points = max(int(max_sphere_voxels) //
+                         max(len(all_offsets), 1), 1)
+        bounds = np.unique(np.concatenate([
+            [0], np.searchsorted(cum_points,
+                                 np.arange(max_points, cum_points[-1] +
+                                           max_points, max_points)
+                                 if len(cum_points) > 0 else [],
+                                 side="right"), [len(streamlines)]]))
+        del cum_points
+    else:
+        bounds = np.unique(np.append(np.arange(0, len(streamlines),
+                                               batch_size),
+                                     len(streamlines)))
+
+    blocks = [[] for _ in offsets_list]
+    for b, b_end in zip(bounds[:-1], bounds[1:]):
+        batch = [np.asarray(s) for s in streamlines[b:b_end]]
+        lengths = np.array([len(s) for s in batch], dtype=np.intp)
+        if lengths.sum() == 0:
+            for block in blocks:
+                block.append(coo_matrix((len(batch), n_nodes), dtype=bool))
+            continue
+
+        # Map the streamline coordinates to voxel coordinates
+        inds = np.concatenate(batch).astype(np.float64) + 0.5
+        if inds.min().round(decimals=6) < 0:
+            raise IndexError("streamline has points that map to negative "
+                             "voxel indices")
+        vox_coords = inds.astype(np.int32)
+        del inds
+
+        # Label every voxel within the error margin of every point. Voxels
+        # outside of the image are treated as background.
+        sphere = vox_coords[:, None, :] + off_floor[None, :, :]
+        if off_half.any():
+            sphere += off_up + (off_half & (sphere % 2 == 1))
+        else:
+            sphere += off_up
+        in_bounds = (sphere.min(-1) >= 0) & np.all(sphere < dims, -1)
+        lab_arr = np.zeros(in_bounds.shape, dtype=flat_labels.dtype)
+        lab_arr[in_bounds] = flat_labels[np.ravel_multi_index(
+            sphere[in_bounds].T, tuple(dims))]
+        sl_ids = np.repeat(np.arange(len(batch)), lengths)
+        del sphere, in_bounds
+
+        for block, member in zip(blocks, members):
+            # Count sphere voxel hits per streamline and label
+            labs = lab_arr[:, member]
+            lab_counts = coo_matrix(
+                (np.ones(labs.size, dtype=np.int64),
+                 (np.repeat(sl_ids, labs.shape[1]), labs.ravel())),
+                shape=(len(batch), n_labels)).tocsr().tocoo()
+            keep = (lab_counts.col > 0) & (lab_counts.data >= overlap_thr)
+            rows = lab_counts.row[keep]
+            nodes = node_lut[lab_counts.col[keep]]
+
+            unknown = nodes < 0
+            if unknown.any():
+                missing.update(
+                    np.unique(lab_counts.col[keep][unknown]).tolist())
+            block.append(coo_matrix(
+                (np.ones(int(np.sum(~unknown)), dtype=bool),
+                 (rows[~unknown], nodes[~unknown])),
+                shape=(len(batch), n_nodes)))
+        del lab_arr
+
+    for lab in sorted(missing):
+        print(f"Label {lab} missing from parcellation. Check registration "
+              f"and ensure valid input parcellation file.")
+
+    incidence = [vstack(block, format="csr") if len(block) > 0 else
+                 coo_matrix((0, n_nodes), dtype=bool).tocsr()
+                 for block in blocks]
+    return incidence if multi else incidence[0]
+
+
+def streamlines_near_rois(streamlines, roi_distance, roi_tree, tol,
+                          mode="both_end"):
+    """
+    Flag the streamlines that pass within a tolerance distance of any
+    labeled atlas voxel, equivalently to dipy's `select_by_rois` with every
+    atlas label as an inclusion ROI (or to `near_roi` with a binary mask).
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        DiPy list/array-like object of streamline points in voxel
+        coordinates.
+    roi_distance : array
+        3D array of the euclidean distance from every voxel center to the
+        nearest labeled voxel center (i.e. the distance transform of the
+        atlas background).
+    roi_tree : cKDTree
+        KD-tree of the labeled voxel centers, queried only for points whose
+        proximity cannot be decided from `roi_distance` alone.
+    tol : float
+        Distance (in voxels). If a point is within this distance from the
+        center of any labeled voxel, it is considered near the ROIs. Raised
+        to the distance between the center and the corner of a voxel, as in
+        `select_by_rois`.
+    mode : str
+        One of "both_end" (both end points must be near the ROIs), "any"
+        (any point must be near the ROIs) or "all" (all points must be near
+        the ROIs).
+
+    Returns
+    -------
+    near : ndarray
+        1D boolean array with one entry per streamline.
+
+    """
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    if not isinstance(streamlines, ArraySequence):
+        streamlines = ArraySequence(streamlines)
+    tol = max(float(tol), np.sqrt(3) / 2)
+
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    near = np.zeros(len(lengths), dtype=bool)
+    if roi_tree.n == 0 or np.sum(lengths > 0) == 0:
+        return near
+    nonempty = np.flatnonzero(lengths > 0)
+
+    if mode == "both_end":
+        pt_idx = np.concatenate([offsets[nonempty],
+                                 offsets[nonempty] + lengths[nonempty] - 1])
+    elif mode == "any" or mode == "all":
+        starts = np.r_[0, np.cumsum(lengths[nonempty])[:-1]]
+        pt_idx = np.arange(int(lengths.sum())) + \
+            np.repeat(offsets[nonempty] - starts, lengths[nonempty])
+    else:
+        raise ValueError(f"Mode {mode} not supported.")
+    pts = np.asarray(streamlines._data[pt_idx], dtype=np.float64)
+
+    # Bound the distance to the ROIs by the distance of the nearest voxel
+    # center plus the offset of the point from that center
+    vox = np.floor(pts + 0.5).astype(np.intp)
+    resid = np.linalg.norm(pts - vox, axis=1)
+    in_bounds = np.all((vox >= 0) & (vox < np.array(roi_distance.shape)),
+                       axis=1)
+    vox_dist = np.full(len(pts), np.inf)
+    vox_dist[in_bounds] = roi_distance[tuple(vox[in_bounds].T)]
+    pt_near = vox_dist + resid <= tol - 1e-6
+    undecided = ~pt_near & ~(in_bounds & (vox_dist - resid > tol + 1e-6))
+
+    # Resolve the remaining points near the tolerance boundary exactly
+    if undecided.any():
+        dist, _ = roi_tree.query(pts[undecided],
+                                 distance_upper_bound=tol + 1e-6)
+        pt_near[undecided] = dist <= tol
+
+    if mode == "both_end":
+        pt_near = pt_near.reshape(2, -1)
+        near[nonempty] = pt_near[0] & pt_near[1]
+    elif mode == "any":
+        near[nonempty] = np.logical_or.reduceat(pt_near, starts)
+    else:
+        near[nonempty] = np.logical_and.reduceat(pt_near, starts)
+    return near
+
+
+def compact_streamlines(streamlines, dtype=np.float32):
+    """
+    Gather the points of a (possibly filtered) ArraySequence view into a new,
+    contiguous ArraySequence with a single allocation.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        DiPy list/array-like object of streamline points, e.g. a boolean
+        selection of a larger ArraySequence that still references its
+        buffer.
+    dtype : dtype
+        Data type of the compacted points.
+
+    Returns
+    -------
+    compacted : ArraySequence
+        ArraySequence whose buffer holds only the selected points.
+
+    """
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    starts = (np.cumsum(lengths) - lengths).astype(np.intp)
+
+    compacted = ArraySequence()
+    compacted._data = np.empty((int(lengths.sum()),) +
+                               streamlines.common_shape, dtype=dtype)
+    compacted._data[:] = streamlines._data[
+        np.arange(int(lengths.sum())) + np.repeat(offsets - starts, lengths)]
+    compacted._offsets = starts
+    compacted._lengths = lengths.copy()
+    return compacted
+
+
+def accumulate_density_map(density, streamlines):
+    """
+    Add the number of streamlines passing through each voxel to a running
+    fiber density volume, matching `dipy.tracking.utils.density_map` with an
+    identity affine.
+
+    Parameters
+    ----------
+    density : ndarray
+        3D integer fiber density volume, updated in place.
+    streamlines : ArraySequence
+        DiPy list/array-like object of streamline points in voxel
+        coordinates.
+
+    Returns
+    -------
+    density : ndarray
+        The updated fiber density volume.
+
+    """
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    if len(lengths) == 0:
+        return density
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    starts = (np.cumsum(lengths) - lengths).astype(np.intp)
+    points = streamlines._data[
+        np.arange(int(lengths.sum())) + np.repeat(offsets - starts, lengths)]
+
+    # Voxel of every point and the streamline it belongs to
+    vox = np.floor(points + 0.5).astype(np.intp)
+    sl_ids = np.repeat(np.arange(len(lengths), dtype=np.intp), lengths)
+    in_bounds = np.all((vox >= 0) & (vox < density.shape), axis=1)
+    if not np.all(in_bounds):
+        print(f"{np.sum(~in_bounds)} streamline points fall outside of the "
+              f"density volume and are ignored.")
+    lin = np.ravel_multi_index(tuple(vox[in_bounds].T), density.shape)
+
+    # Each streamline counts once per voxel that it traverses
+    pairs = np.unique(sl_ids[in_bounds] * density.size + lin)
+    density += np.bincount(pairs % density.size,
+                           minlength=density.size).reshape(
+        density.shape).astype(density.dtype)
+    return density
+
+
 def extract_b0(in_file, b0_ixs, out_path=None):
     """
     Extract the *b0* volumes from a DWI dataset.
@@ -132,9 +535,117 @@ def extract_b0(in_file, b0_ixs, out_path=None):
     return out_path
 
 
+def build_life_matrix(streamlines, gtab, vol_shape, evals=(0.001, 0, 0),
+                      batch_size=10000):
+    """
+    Build the sparse LiFE matrix of fiber contributions to the
+    diffusion-weighted signal, batch by batch of streamlines and only for the
+    voxels that the streamlines traverse.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        DiPy list/array-like object of streamline points in voxel
+        coordinates, each with at least two points.
+    gtab : Obj
+        DiPy object storing diffusion gradient information.
+    vol_shape : tuple
+        Shape of the 3D volume of the diffusion data. Points that fall
+        outside of it do not contribute to the matrix.
+    evals : tuple
+        Eigenvalues of the axially symmetric tensor used as the response of
+        each streamline node (the second and third must be equal).
+    batch_size : int
+        Number of streamlines whose node signals are computed at once.
+
+    Returns
+    -------
+    life_matrix : csr_matrix
+        Matrix of shape (n_voxels * n_dwi_directions, n_streamlines), as
+        built by `dipy.tracking.life.FiberModel.setup` with `sphere=False`.
+    vox_coords : ndarray
+        Coordinates of the voxels of the rows of `life_matrix`.
+
+    """
+    import scipy.sparse as sps
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    streamlines = ArraySequence(streamlines)
+    bvecs = gtab.bvecs[~gtab.b0s_mask]
+    bvals = gtab.bvals[~gtab.b0s_mask]
+    n_bvecs = len(bvals)
+    n_vox = int(np.prod(vol_shape))
+
+    vox_keys = []
+    fibers = []
+    signals = []
+    for start in range(0, len(streamlines), batch_size):
+        batch = streamlines[start:start + batch_size]
+        lengths = np.asarray(batch._lengths, dtype=np.intp)
+        if len(lengths) == 0:
+            continue
+        offsets = np.asarray(batch._offsets, dtype=np.intp)
+        starts = (np.cumsum(lengths) - lengths).astype(np.intp)
+        points = batch._data[np.arange(int(lengths.sum())) +
+                             np.repeat(offsets - starts, lengths)].astype(
+            np.float64)
+        sl_ids = np.repeat(np.arange(len(lengths), dtype=np.intp), lengths)
+
+        # Spatial gradient of each streamline at each of its nodes
+        grad = np.empty_like(points)
+        grad[1:-1] = (points[2:] - points[:-2]) / 2
+        ends = starts + lengths - 1
+        grad[starts] = points[starts + 1] - points[starts]
+        grad[ends] = points[ends] - points[ends - 1]
+        norm = np.linalg.norm(grad, axis=1)
+        grad[norm > 0] /= norm[norm > 0, None]
+        grad[norm == 0] = [1, 0, 0]
+
+        # Stejskal-Tanner signal of each node's tensor, demeaned per
+        # streamline
+        adc = evals[1] + (evals[0] - evals[1]) * np.dot(grad, bvecs.T) ** 2
+        node_sig = np.exp(-bvals * adc)
+        del grad, adc
+        node_sig -= (np.add.reduceat(node_sig.sum(axis=1), starts) /
+                     (lengths * n_bvecs))[sl_ids, None]
+
+        # Sum the node signals of each streamline within each voxel
+        vox = np.round(points).astype(np.intp)
+        in_bounds = np.all((vox >= 0) & (vox < vol_shape), axis=1)
+        key = (sl_ids[in_bounds] + start) * n_vox + \
+            np.ravel_multi_index(tuple(vox[in_bounds].T), vol_shape)
+        del points, vox
+        pairs, inv, counts = np.unique(key, return_inverse=True,
+                                       return_counts=True)
+        order = np.argsort(inv, kind='stable')
+        signals.append(np.add.reduceat(
+            node_sig[in_bounds][order],
+            (np.cumsum(counts) - counts).astype(np.intp), axis=0))
+        vox_keys.append(pairs % n_vox)
+        fibers.append(pairs // n_vox)
+        del node_sig, key, inv, order
+
+    if len(vox_keys) == 0:
+        return sps.csr_matrix((0, len(streamlines))), \
+            np.zeros((0, 3), dtype=np.intp)
+
+    vox_lin, rows = np.unique(np.concatenate(vox_keys), return_inverse=True)
+    del vox_keys
+    fibers = np.concatenate(fibers)
+    signals = np.concatenate(signals)
+    life_matrix = sps.csr_matrix(
+        (signals.ravel(),
+         ((rows.reshape(-1, 1) * n_bvecs + np.arange(n_bvecs)).ravel(),
+          np.repeat(fibers, n_bvecs))),
+        shape=(len(vox_lin) * n_bvecs, len(streamlines)))
+    vox_coords = np.array(np.unravel_index(vox_lin, vol_shape)).T
+
+    return life_matrix, vox_coords
+
+
 def evaluate_streamline_plausibility(dwi_data, gtab, mask_data, streamlines,
                                      affine=np.eye(4),
-                                     sphere='repulsion724'):
+                                     sphere='repulsion724', batch_size=None):
     """
     Linear Fascicle Evaluation (LiFE) takes any connectome and uses a
     forward modelling approach to predict diffusion measurements in the
@@ -150,6 +661,11 @@ def evaluate_streamline_plausibility(dwi_data, gtab, mask_data, streamlines,
        3D Brain mask.
     streamlines : ArraySequence
         DiPy list/array-like object of streamline points from tractography.
+    batch_size : int
+        If specified, the LiFE matrix is built with `build_life_matrix`
+        in batches of this many streamlines and only the signal of the voxels
+        that they traverse is extracted, rather than fitting
+        `dipy.tracking.life.FiberModel` on a masked copy of the whole DWI.
 
     Returns
     -------
@@ -164,58 +680,81 @@ def evaluate_streamline_plausibility(dwi_data, gtab, mask_data, streamlines,
     """
     import dipy.tracking.life as life
     import dipy.core.optimize as opt
-    from dipy.tracking._utils import _mapping_to_voxel
-    # from dipy.data import get_sphere
-    from dipy.tracking import utils
-    from dipy.tracking.streamline import Streamlines
+    from nibabel.streamlines.array_sequence import ArraySequence
+    from pynets.dmri.dmri_utils import build_life_matrix, compact_streamlines
 
     original_count = len(streamlines)
+    streamlines = ArraySequence(streamlines)
+    mask_data = np.asarray(mask_data, dtype=bool)
+
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    starts = (np.cumsum(lengths) - lengths).astype(np.intp)
+    points = streamlines._data[np.arange(int(lengths.sum())) +
+                               np.repeat(offsets - starts, lengths)]
 
-    streamlines_long = nib.streamlines. \
-        array_sequence.ArraySequence(
-        [
-            s
-            for s in streamlines
-            if len(s) >= float(10)
-        ]
-    )
     print('Removing streamlines with negative voxel indices...')
-    # Remove any streamlines with negative voxel indices
-    lin_T, offset = _mapping_to_voxel(np.eye(4))
-    streamlines_positive = []
-    for sl in streamlines_long:
-        inds = np.dot(sl, lin_T)
-        inds += offset
-        if not inds.min().round(decimals=6) < 0:
-            streamlines_positive.append(sl)
-    del streamlines_long
-
-    # Filter resulting streamlines by those that stay entirely
-    # inside the ROI of interest
-    mask_data = np.array(mask_data, dtype=bool, copy=False)
-    streamlines_in_brain = Streamlines(utils.target(
-        streamlines_positive, np.eye(4),
-        mask_data, include=True
-    ))
-    streamlines_in_brain = [i for i in streamlines_in_brain]
-    del streamlines_positive
+    keep = lengths >= float(10)
+    if len(points) > 0:
+        # Remove any streamlines with negative voxel indices
+        inds = points + 0.5
+        keep &= np.minimum.reduceat(inds.min(axis=1), starts).round(
+            decimals=6) >= 0
+
+        # Filter resulting streamlines by those that reach the ROI of
+        # interest
+        vox = inds.astype(np.intp)
+        in_mask = np.all((vox >= 0) & (vox < mask_data.shape), axis=1)
+        in_mask[in_mask] = mask_data[tuple(vox[in_mask].T)]
+        keep &= np.logical_or.reduceat(in_mask, starts)
+        del inds, vox, in_mask
+    del points
+    streamlines_in_brain = compact_streamlines(
+        streamlines[keep], dtype=streamlines._data.dtype)
     print('Fitting fiber model...')
 
-    # ! Remember this 4d masking function !
-    data_in_mask = np.nan_to_num(np.broadcast_to(mask_data[..., None],
-                    dwi_data.shape).astype('bool') * dwi_data)
-    # ! Remember this 4d masking function !
-
-    fiber_model = life.FiberModel(gtab)
-    fiber_fit = fiber_model.fit(data_in_mask, streamlines_in_brain,
-                                affine=affine,
-                                sphere=False)
-    # sphere = get_sphere(sphere)
-    # fiber_fit = fiber_model.fit(data_in_mask, streamlines_in_brain,
-    #                             affine=affine,
-    #                             sphere=sphere)
-    streamlines = list(np.array(streamlines_in_brain)[
-                           np.where(fiber_fit.beta > 0)[0]])
+    if batch_size is None:
+        # ! Remember this 4d masking function !
+        data_in_mask = np.nan_to_num(np.broadcast_to(mask_data[..., None],
+                        dwi_data.shape).astype('bool') * dwi_data)
+        # ! Remember this 4d masking function !
+
+        fiber_model = life.FiberModel(gtab)
+        fiber_fit = fiber_model.fit(data_in_mask,
+                                    [i for i in streamlines_in_brain],
+                                    affine=affine,
+                                    sphere=False)
+        del data_in_mask
+        # sphere = get_sphere(sphere)
+        # fiber_fit = fiber_model.fit(data_in_mask, streamlines_in_brain,
+        #                             affine=affine,
+        #                             sphere=sphere)
+        life_matrix = fiber_fit.life_matrix
+        vox_coords = fiber_fit.vox_coords
+        beta = fiber_fit.beta
+        vox_data = fiber_fit.data
+        b0_signal = fiber_fit.b0_signal
+        mean_signal = fiber_fit.mean_signal
+    else:
+        life_matrix, vox_coords = build_life_matrix(
+            streamlines_in_brain, gtab, dwi_data.shape[:3],
+            batch_size=batch_size)
+
+        # Signals of the traversed voxels only, masked as above
+        vox_idx = tuple(vox_coords.T)
+        vox_data = np.nan_to_num(dwi_data[vox_idx] *
+                                 mask_data[vox_idx][:, None])
+        b0_signal = np.mean(vox_data[:, gtab.b0s_mask], -1)
+        relative_signal = vox_data[:, ~gtab.b0s_mask] / b0_signal[:, None]
+        mean_signal = np.mean(relative_signal, -1)
+        to_fit = (relative_signal - mean_signal[:, None]).ravel()
+        to_fit[np.isnan(to_fit)] = 0
+        del relative_signal
+        beta = opt.sparse_nnls(to_fit, life_matrix)
+        del to_fit
+
+    streamlines = compact_streamlines(streamlines_in_brain[beta > 0],
+                                      dtype=streamlines_in_brain._data.dtype)
     pruned_count = len(streamlines)
     if pruned_count == 0:
         print(UserWarning('\nWarning LiFE skipped due to implausible values '
@@ -230,22 +769,20 @@ def evaluate_streamline_plausibility(dwi_data, gtab, mask_data, streamlines,
     else:
         del streamlines_in_brain
 
-    model_predict = fiber_fit.predict()
-    model_error = model_predict - fiber_fit.data
+    def predict(beta):
+        pred_weighted = np.reshape(opt.spdot(life_matrix, beta),
+                                   (vox_coords.shape[0],
+                                    np.sum(~gtab.b0s_mask)))
+        pred = np.empty((vox_coords.shape[0], gtab.bvals.shape[0]))
+        pred[..., gtab.b0s_mask] = b0_signal[:, None]
+        pred[..., ~gtab.b0s_mask] = (pred_weighted +
+                                     mean_signal[:, None]) * \
+            b0_signal[:, None]
+        return pred
+
+    model_error = predict(beta) - vox_data
     model_rmse = np.sqrt(np.mean(model_error[:, 10:] ** 2, -1))
-    beta_baseline = np.zeros(fiber_fit.beta.shape[0])
-    pred_weighted = np.reshape(opt.spdot(fiber_fit.life_matrix,
-                                         beta_baseline),
-                               (fiber_fit.vox_coords.shape[0],
-                                np.sum(~gtab.b0s_mask)))
-    mean_pred = np.empty((fiber_fit.vox_coords.shape[0],
-                          gtab.bvals.shape[0]))
-    S0 = fiber_fit.b0_signal
-    mean_pred[..., gtab.b0s_mask] = S0[:, None]
-    mean_pred[..., ~gtab.b0s_mask] = (pred_weighted +
-                                      fiber_fit.mean_signal
-                                      [:, None]) * S0[:, None]
-    mean_error = mean_pred - fiber_fit.data
+    mean_error = predict(np.zeros(beta.shape[0])) - vox_data
     mean_rmse = np.sqrt(np.mean(mean_error ** 2, -1))
     print(f"Original # Streamlines: {original_count}")
     print(f"Final # Streamlines: {pruned_count}")
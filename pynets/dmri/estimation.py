@@ -192,16 +192,11 @@ def tens_mod_est(gtab, data, B0_mask):
       application to white matter fiber tract mapping in the human brain.
 
     """
-    from dipy.reconst.dti import TensorModel
-    from dipy.data import get_sphere
-
-    sphere = get_sphere("repulsion724")
     B0_mask_data = np.nan_to_num(np.asarray(
         nib.load(B0_mask).dataobj)).astype("bool")
     print("Generating tensor model...")
-    model = TensorModel(gtab)
-    mod = model.fit(data, B0_mask_data)
-    mod_odf = mod.odf(sphere)
+    model = recon_model("tensor", gtab, data, B0_mask_data)
+    mod_odf = fit_recon_model(model, "tensor", data, B0_mask_data)
     del B0_mask_data
     return mod_odf, model
 
@@ -234,15 +229,11 @@ def csa_mod_est(gtab, data, B0_mask, sh_order=8):
       with Solid Angle Consideration.
 
     """
-    from dipy.reconst.shm import CsaOdfModel
-
     print("Fitting CSA model...")
-    model = CsaOdfModel(gtab, sh_order=sh_order)
     B0_mask_data = np.nan_to_num(np.asarray(
         nib.load(B0_mask).dataobj)).astype("bool")
-    csa_mod = model.fit(data, B0_mask_data).shm_coeff
-    # Clip any negative values
-    csa_mod = np.clip(csa_mod, 0, np.max(csa_mod, -1)[..., None])
+    model = recon_model("csa", gtab, data, B0_mask_data, sh_order=sh_order)
+    csa_mod = fit_recon_model(model, "csa", data, B0_mask_data)
     del B0_mask_data
     return csa_mod, model
 
@@ -284,31 +275,13 @@ def csd_mod_est(gtab, data, B0_mask, sh_order=8):
       2012. MRtrix: Diffusion Tractography in Crossing Fiber Regions
 
     """
-    from dipy.reconst.csdeconv import (
-        ConstrainedSphericalDeconvModel,
-        recursive_response,
-    )
-
     print("Fitting CSD model...")
     B0_mask_data = np.nan_to_num(np.asarray(
         nib.load(B0_mask).dataobj)).astype("bool")
     print("Reconstructing...")
-    response = recursive_response(
-        gtab,
-        data,
-        mask=B0_mask_data,
-        sh_order=sh_order,
-        peak_thr=0.01,
-        init_fa=0.08,
-        init_trace=0.0021,
-        iter=8,
-        convergence=0.001,
-        parallel=False
-    )
-    print(f"CSD Reponse: {response}")
-    model = ConstrainedSphericalDeconvModel(gtab, response, sh_order=sh_order)
-    csd_mod = model.fit(data, B0_mask_data).shm_coeff
-    del response, B0_mask_data
+    model = recon_model("csd", gtab, data, B0_mask_data, sh_order=sh_order)
+    csd_mod = fit_recon_model(model, "csd", data, B0_mask_data)
+    del B0_mask_data
     return csd_mod, model
 
 
@@ -343,23 +316,313 @@ def sfm_mod_est(gtab, data, B0_mask):
       models at multiple b-values with cross-validation. ISMRM 2014.
 
     """
-    from dipy.data import get_sphere
-    import dipy.reconst.sfm as sfm
-
-    sphere = get_sphere("repulsion724")
     print("Fitting SF model...")
     B0_mask_data = np.nan_to_num(np.asarray(nib.load(
         B0_mask).dataobj)).astype("bool")
     print("Reconstructing...")
-    model = sfm.SparseFascicleModel(
-        gtab, sphere=sphere, l1_ratio=0.5, alpha=0.001)
-    sf_mod = model.fit(data, mask=B0_mask_data)
-    sf_odf = sf_mod.odf(sphere)
+    model = recon_model("sfm", gtab, data, B0_mask_data)
+    sf_odf = fit_recon_model(model, "sfm", data, B0_mask_data)
 
     del B0_mask_data
     return sf_odf, model
 
 
+def recon_model_params(conn_model, sh_order=8):
+    """
+    Return the parameters with which `recon_model` instantiates a diffusion
+    reconstruction model.
+
+    Parameters
+    ----------
+    conn_model : str
+        Connectivity reconstruction method (e.g. 'csa', 'tensor', 'csd',
+        'sfm').
+    sh_order : int
+        The order of the SH model. Default is 8.
+
+    Returns
+    -------
+    params : dict
+        Dictionary of model parameters, including those of the CSD response
+        function estimation.
+
+    """
+    conn_model = conn_model.lower()
+    if conn_model == "csa":
+        params = {'sh_order': sh_order}
+    elif conn_model == "csd":
+        params = {'sh_order': sh_order,
+                  'response': {'peak_thr': 0.01, 'init_fa': 0.08,
+                               'init_trace': 0.0021, 'iter': 8,
+                               'convergence': 0.001}}
+    elif conn_model == "sfm":
+        params = {'sphere': 'repulsion724', 'l1_ratio': 0.5, 'alpha': 0.001}
+    elif conn_model == "ten" or conn_model == "tensor":
+        params = {}
+    else:
+        raise ValueError(f"Reconstruction model {conn_model} not "
+                         f"recognized.")
+
+    return params
+
+
+def recon_model(conn_model, gtab, data, B0_mask_data, sh_order=8):
+    """
+    Instantiate a diffusion reconstruction model, without fitting it.
+
+    Parameters
+    ----------
+    conn_model : str
+        Connectivity reconstruction method (e.g. 'csa', 'tensor', 'csd',
+        'sfm').
+    gtab : Obj
+        DiPy object storing diffusion gradient information.
+    data : array
+        4D numpy array of diffusion image data, used to estimate the CSD
+        response function.
+    B0_mask_data : array
+        3D boolean array of the B0 brain mask.
+    sh_order : int
+        The order of the SH model. Default is 8.
+
+    Returns
+    -------
+    model : obj
+        Connectivity reconstruction model.
+
+    """
+    from dipy.data import get_sphere
+
+    conn_model = conn_model.lower()
+    params = recon_model_params(conn_model, sh_order=sh_order)
+    if conn_model == "csa":
+        from dipy.reconst.shm import CsaOdfModel
+
+        model = CsaOdfModel(gtab, sh_order=params['sh_order'])
+    elif conn_model == "csd":
+        from dipy.reconst.csdeconv import (
+            ConstrainedSphericalDeconvModel,
+            recursive_response,
+        )
+
+        response = recursive_response(
+            gtab,
+            data,
+            mask=B0_mask_data,
+            sh_order=params['sh_order'],
+            parallel=False,
+            **params['response']
+        )
+        print(f"CSD Reponse: {response}")
+        model = ConstrainedSphericalDeconvModel(gtab, response,
+                                                sh_order=params['sh_order'])
+        del response
+    elif conn_model == "sfm":
+        import dipy.reconst.sfm as sfm
+
+        model = sfm.SparseFascicleModel(
+            gtab, sphere=get_sphere(params['sphere']),
+            l1_ratio=params['l1_ratio'], alpha=params['alpha'])
+    else:
+        from dipy.reconst.dti import TensorModel
+
+        model = TensorModel(gtab)
+
+    return model
+
+
+def fit_recon_model(model, conn_model, data, B0_mask_data):
+    """
+    Fit a diffusion reconstruction model within a mask and return the
+    coefficients used for tractography.
+
+    Parameters
+    ----------
+    model : obj
+        Connectivity reconstruction model returned by `recon_model`.
+    conn_model : str
+        Connectivity reconstruction method (e.g. 'csa', 'tensor', 'csd',
+        'sfm').
+    data : array
+        4D numpy array of diffusion image data (e.g. a slab of the volume).
+    B0_mask_data : array
+        3D boolean array of the B0 brain mask over the same voxels.
+
+    Returns
+    -------
+    mod_fit : ndarray
+        Spherical harmonic coefficients ('csa', 'csd') or ODF ('sfm',
+        'tensor') of every voxel.
+
+    """
+    from dipy.data import get_sphere
+
+    conn_model = conn_model.lower()
+    if conn_model == "csa":
+        mod_fit = model.fit(data, mask=B0_mask_data).shm_coeff
+        # Clip any negative values
+        mod_fit = np.clip(mod_fit, 0, np.max(mod_fit, -1)[..., None])
+    elif conn_model == "csd":
+        mod_fit = model.fit(data, mask=B0_mask_data).shm_coeff
+    elif conn_model == "sfm":
+        mod_fit = model.fit(data, mask=B0_mask_data).odf(
+            get_sphere("repulsion724"))
+    elif conn_model == "ten" or conn_model == "tensor":
+        mod_fit = model.fit(data, mask=B0_mask_data).odf(
+            get_sphere("repulsion724"))
+    else:
+        raise ValueError(f"Reconstruction model {conn_model} not "
+                         f"recognized.")
+
+    return mod_fit
+
+
+class StructuralConnectomeAccumulator(object):
+    """
+    Class for accumulating streamline counts, fiber lengths, and FA values
+    along the edges of a structural connectome, one batch of labeled
+    streamlines at a time.
+    """
+
+    def __init__(self, roi_volumes):
+        from scipy.sparse import csr_matrix
+
+        self.roi_volumes = np.asarray(roi_volumes, dtype=np.float64)
+        self.n_nodes = len(self.roi_volumes)
+        self.n_streamlines = 0
+        self.fa_min = np.inf
+        self.fa_max = -np.inf
+        shape = (self.n_nodes, self.n_nodes)
+        self._counts = csr_matrix(shape, dtype=np.int64)
+        self._lengths = csr_matrix(shape, dtype=np.int64)
+        self._fa = csr_matrix(shape, dtype=np.float64)
+        self._fa_n = csr_matrix(shape, dtype=np.int64)
+
+    def _edge_sums(self, incidence, weights):
+        """Sum per-streamline weights over every pair of nodes that a
+        streamline connects."""
+        from scipy.sparse import diags, triu
+
+        return triu(incidence.T @ diags(weights) @ incidence, k=1,
+                    format="csr")
+
+    def update(self, incidence, fiber_lengths, fa_values=None):
+        """
+        Fold a batch of labeled streamlines into the edge accumulators.
+
+        Parameters
+        ----------
+        incidence : csr_matrix
+            Sparse n_streamlines x n_nodes boolean matrix of streamline-node
+            intersections.
+        fiber_lengths : array
+            Number of points of each streamline.
+        fa_values : list
+            List of 1D arrays of the FA values sampled along each streamline.
+            NaN values are ignored.
+        """
+        incidence = incidence.astype(np.int64)
+        fiber_lengths = np.asarray(fiber_lengths, dtype=np.int64)
+        self.n_streamlines += incidence.shape[0]
+        self._counts += self._edge_sums(
+            incidence, np.ones(incidence.shape[0], dtype=np.int64))
+        self._lengths += self._edge_sums(incidence, fiber_lengths)
+        if fa_values is not None and len(fa_values) > 0:
+            # Only the global FA range and the raw per-streamline mean FA
+            # are retained. Since the global FA normalization is linear, it
+            # can be applied to the edge means once all batches are folded.
+            fa_values = [np.asarray(i, dtype=np.float64).ravel()
+                         for i in fa_values]
+            sl_ids = np.repeat(np.arange(len(fa_values)),
+                               [len(i) for i in fa_values])
+            fa_values = np.concatenate(fa_values)
+            fa_valid = ~np.isnan(fa_values)
+            if np.any(fa_values > 0):
+                self.fa_min = min(self.fa_min,
+                                  float(np.min(fa_values[fa_values > 0])))
+            if np.any(fa_valid):
+                self.fa_max = max(self.fa_max,
+                                  float(np.max(fa_values[fa_valid])))
+            fa_sums = np.bincount(sl_ids, weights=np.where(fa_valid,
+                                                           fa_values, 0),
+                                  minlength=incidence.shape[0])
+            fa_n = np.bincount(sl_ids, weights=fa_valid,
+                               minlength=incidence.shape[0])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                fa_means = fa_sums / fa_n
+            sl_valid = fa_n > 0
+            self._fa += self._edge_sums(incidence,
+                                        np.where(sl_valid, fa_means, 0))
+            self._fa_n += self._edge_sums(incidence,
+                                          sl_valid.astype(np.int64))
+
+    def to_matrix(self, fiber_density=True, fa_wei=True):
+        """
+        Weight the accumulated edges and return a dense connectivity matrix.
+
+        Parameters
+        ----------
+        fiber_density : bool
+            Scale fiber counts by mean fiber length relative to the volume of
+            each pair of nodes.
+        fa_wei : bool
+            Scale edge weights by the mean FA along the streamlines that
+            define each edge.
+
+        Returns
+        -------
+        conn_matrix : array
+            Adjacency matrix stored as an m x n array of nodes and edges.
+        """
+        counts = self._counts.tocoo()
+        rows, cols = counts.row, counts.col
+        weight = counts.data.astype(np.float64)
+
+        def edge_values(mat):
+            return np.asarray(mat[rows, cols], dtype=np.float64).ravel()
+
+        # Adapted from the normalized fiber-density estimation routines of
+        # Sebastian Tourbier.
+        if fiber_density is True:
+            print("Weighting edges by fiber density...")
+            # Summarize total fibers and total label volumes
+            total_fibers = float(len(weight))
+            total_volume = float(np.sum(self.roi_volumes[np.unique(rows)]))
+            edge_fiberlength_mean = edge_values(self._lengths) / weight
+            with np.errstate(divide="ignore", invalid="ignore"):
+                edge_fiber_density = (((weight / total_fibers) /
+                                       edge_fiberlength_mean) *
+                                      ((2.0 * total_volume) /
+                                       (self.roi_volumes[rows] +
+                                        self.roi_volumes[cols]))) * 1000
+
+        if fa_wei is True:
+            print("Weighting edges by FA...")
+            fa_n = edge_values(self._fa_n)
+            # Here we normalize by global FA
+            with np.errstate(divide="ignore", invalid="ignore"):
+                edge_average_fa = np.where(
+                    fa_n > 0, ((edge_values(self._fa) / fa_n) -
+                               self.fa_min) / (self.fa_max - self.fa_min),
+                    np.nan)
+
+        # Summarize weights
+        if fa_wei is True and fiber_density is True:
+            final_weight = edge_average_fa * edge_fiber_density
+        elif fiber_density is True and fa_wei is False:
+            final_weight = edge_fiber_density
+        elif fa_wei is True and fiber_density is False:
+            final_weight = edge_average_fa * weight
+        else:
+            final_weight = weight
+
+        conn_matrix = np.zeros((self.n_nodes, self.n_nodes))
+        conn_matrix[rows, cols] = final_weight
+        conn_matrix[cols, rows] = final_weight
+
+        return conn_matrix
+
+
 def streams2graph(
     atlas_mni,
     streams,
@@ -450,9 +713,11 @@ def streams2graph(
         File path to MNI-space warped FA Nifti1Image.
     min_length : int
         Minimum fiber length threshold in mm to restrict tracking.
-    error_margin : int
+    error_margin : int or list
         Euclidean margin of error for classifying a streamline as a connection
-         to an ROI. Default is 2 voxels.
+         to an ROI. Default is 2 voxels. If a list of margins is given, a
+         connectivity matrix is estimated for each of them from a single
+         pass over the streamlines.
 
     Returns
     -------
@@ -460,8 +725,9 @@ def streams2graph(
         File path to atlas parcellation Nifti1Image in T1w-warped MNI space.
     streams : str
         File path to streamline array sequence in .trk format.
-    conn_matrix : array
-        Adjacency matrix stored as an m x n array of nodes and edges.
+    conn_matrix : array or list
+        Adjacency matrix stored as an m x n array of nodes and edges, or a
+        list of such matrices (one per error margin).
     track_type : str
         Tracking algorithm used (e.g. 'local' or 'particle').
     target_samples : int
@@ -512,7 +778,7 @@ def streams2graph(
         closest (clos), boot (bootstrapped), and prob (probabilistic).
     min_length : int
         Minimum fiber length threshold in mm to restrict tracking.
-    error_margin : int
+    error_margin : int or list
         Euclidean margin of error for classifying a streamline as a connection
          to an ROI. Default is 2 voxels.
 
@@ -534,15 +800,10 @@ def streams2graph(
     import pkg_resources
     import sys
     import yaml
-    from dipy.tracking.streamline import Streamlines, values_from_volume
-    from dipy.tracking._utils import _mapping_to_voxel, _to_voxel_coordinates
-    import networkx as nx
-    from itertools import combinations
-    from collections import defaultdict
-    from pynets.core import utils, nodemaker
-    from pynets.dmri.dmri_utils import generate_sl
-    from dipy.io.streamline import load_tractogram
-    from dipy.io.stateful_tractogram import Space, Origin
+    from dipy.tracking.streamline import values_from_volume
+    from pynets.core import nodemaker
+    from pynets.dmri.dmri_utils import get_node_lut, \
+        streamline_node_incidence, iter_streamline_chunks
 
     with open(
         pkg_resources.resource_filename("pynets", "runconfig.yaml"), "r"
@@ -556,11 +817,21 @@ def streams2graph(
             "StructuralNetworkWeighting"]["overlap_thr"][0]
         roi_neighborhood_tol = \
         hardcoded_params['tracking']["roi_neighborhood_tol"][0]
+        streamline_chunk_size = \
+        hardcoded_params['tracking']["streamline_chunk_size"][0]
     stream.close()
 
     start = time.time()
 
-    if float(roi_neighborhood_tol) <= float(error_margin):
+    # Multiple error margins are estimated from a single pass over the
+    # streamlines
+    if isinstance(error_margin, (list, tuple)):
+        error_margins = list(error_margin)
+    else:
+        error_margins = [error_margin]
+
+    if float(roi_neighborhood_tol) <= max([float(i) for i in
+                                           error_margins]):
         try:
             raise ValueError('roi_neighborhood_tol preset cannot be less than '
                              'the value of the structural connectome error'
@@ -578,212 +849,67 @@ def streams2graph(
     roi_img = nib.load(atlas_mni)
     atlas_data = np.around(np.asarray(roi_img.dataobj))
     roi_zooms = roi_img.header.get_zooms()
-    roi_shape = roi_img.shape
-
-    # Read Streamlines
-    streamlines = [
-        i.astype(np.float32)
-        for i in Streamlines(
-            load_tractogram(
-                streams,
-                fa_img,
-                to_origin=Origin.NIFTI,
-                to_space=Space.VOXMM
-            ).streamlines
-        )
-    ]
-
-    # from fury import actor, window
-    # renderer = window.Renderer()
-    # template_actor = actor.contour_from_roi(roi_img.get_fdata(),
-    #                                         color=(50, 50, 50), opacity=0.05)
-    # renderer.add(template_actor)
-    # lines_actor = actor.streamtube(streamlines, window.colors.orange,
-    #                                linewidth=0.3)
-    # renderer.add(lines_actor)
-    # window.show(renderer)
 
     roi_img.uncache()
 
     if fa_wei is True:
-        fa_weights = values_from_volume(
-            np.asarray(fa_img.dataobj, dtype=np.float32),
-            streamlines, np.eye(4)
-        )
-        global_fa_weights = list(utils.flatten(fa_weights))
-        min_global_fa_wei = min([i for i in global_fa_weights if i > 0])
-        max_global_fa_wei = max(global_fa_weights)
-        fa_weights_norm = []
-        # Here we normalize by global FA
-        for val_list in fa_weights:
-            fa_weights_norm.append(
-                np.nanmean(
-                    (val_list - min_global_fa_wei)
-                    / (max_global_fa_wei - min_global_fa_wei)
-                )
-            )
-
-    # Make streamlines into generators to keep memory at a minimum
-    total_streamlines = len(streamlines)
-    sl = [generate_sl(i) for i in streamlines]
-    del streamlines
-
-    # Instantiate empty networkX graph object & dictionary and create
-    # voxel-affine mapping
-    lin_T, offset = _mapping_to_voxel(np.eye(4))
-    mx = len(np.unique(atlas_data.astype("uint16"))) - 1
-    g = nx.Graph(ecount=0, vcount=mx)
-    edge_dict = defaultdict(int)
-    node_dict = dict(
-        zip(np.unique(atlas_data.astype("uint16"))[1:], np.arange(mx) + 1))
-
-    # Add empty vertices with label volume attributes
-    for node in range(1, mx + 1):
-        g.add_node(node, roi_volume=np.sum(
-            atlas_data.astype("uint16") == node)
-                   )
-
-    # Build graph
-    pc = 0
-    bad_idxs = []
-    fiberlengths = {}
-    fa_weights_dict = {}
-    print(f"Quantifying fiber-ROI intersection for {atlas}:")
-    for ix, s in enumerate(sl):
-        # Percent counter
-        pcN = int(round(100*float(ix / total_streamlines)))
-        if pcN % 10 == 0 and ix > 0 and pcN > pc:
-            pc = pcN
-            print(f"{pcN}%")
-
-        # Map the streamlines coordinates to voxel coordinates and get labels
-        # for label_volume
-        vox_coords = _to_voxel_coordinates(Streamlines(s), lin_T, offset)
-
-        lab_coords = [
-            nodemaker.get_sphere(coord, error_margin, roi_zooms, roi_shape)
-            for coord in vox_coords
-        ]
-        [i, j, k] = np.vstack(np.array(lab_coords)).T
-
-        # get labels for label_volume
-        lab_arr = atlas_data[i, j, k]
-        # print(lab_arr)
-        endlabels = []
-        for jx, lab in enumerate(np.unique(lab_arr).astype("uint32")):
-            if (lab > 0) and (np.sum(lab_arr == lab) >= overlap_thr):
-                try:
-                    endlabels.append(node_dict[lab])
-                except BaseException:
-                    bad_idxs.append(jx)
-                    print(
-                        f"Label {lab} missing from parcellation. Check "
-                        f"registration and ensure valid input parcellation "
-                        f"file.")
-
-        edges = combinations(endlabels, 2)
-        for edge in edges:
-            # Get fiber lengths along edge
-            if fiber_density is True:
-                if not (edge[0], edge[1]) in fiberlengths.keys():
-                    fiberlengths[(edge[0], edge[1])] = [len(vox_coords)]
-                else:
-                    fiberlengths[(edge[0], edge[1])].append(len(vox_coords))
-
-            # Get FA values along edge
-            if fa_wei is True:
-                if not (edge[0], edge[1]) in fa_weights_dict.keys():
-                    fa_weights_dict[(edge[0],
-                                     edge[1])] = [fa_weights_norm[ix]]
-                else:
-                    fa_weights_dict[(edge[0],
-                                     edge[1])].append(fa_weights_norm[ix])
-
-            lst = tuple([int(node) for node in edge])
-            edge_dict[tuple(sorted(lst))] += 1
-
-        edge_list = [(k[0], k[1], count) for k, count in edge_dict.items()]
-
-        g.add_weighted_edges_from(edge_list)
-
-        del lab_coords, lab_arr, endlabels, edges, edge_list
-
-    gc.collect()
-
-    # Add fiber density attributes for each edge
-    # Adapted from the nnormalized fiber-density estimation routines of
-    # Sebastian Tourbier.
-    if fiber_density is True:
-        print("Weighting edges by fiber density...")
-        # Summarize total fibers and total label volumes
-        total_fibers = 0
-        total_volume = 0
-        u_start = -1
-        for u, v, d in g.edges(data=True):
-            total_fibers += len(d)
-            if u != u_start:
-                total_volume += g.nodes[int(u)]['roi_volume']
-            u_start = u
-
-        ix = 0
-        for u, v, d in g.edges(data=True):
-            if d['weight'] > 0:
-                edge_fiberlength_mean = np.nanmean(fiberlengths[(u, v)])
-                fiber_density = (float(((float(d['weight']) /
-                                         float(total_fibers)) /
-                       float(edge_fiberlength_mean)) *
-                      ((2.0 * float(total_volume)) /
-                       (g.nodes[int(u)]['roi_volume'] +
-                        g.nodes[int(v)]['roi_volume'])))) * 1000
-            else:
-                fiber_density = 0
-            g.edges[u, v].update({"fiber_density": fiber_density})
-            ix += 1
-
+        fa_data = np.asarray(fa_img.dataobj, dtype=np.float32)
+
+    # Read streamlines in chunks, label every streamline with the set of
+    # nodes that it intersects, and fold each chunk into the edge
+    # accumulators
+    label_data, node_lut, roi_volumes = get_node_lut(atlas_data)
+
+    # Labels without a graph node are treated as background (and reported)
+    # when streamlines are labeled, rather than deleted from labels and
+    # coords afterwards, so that both stay aligned with the rows of the
+    # connectivity matrix
+
+    offsets = [nodemaker.get_sphere_offsets(i, roi_zooms)
+               for i in error_margins]
+    accumulators = [StructuralConnectomeAccumulator(roi_volumes)
+                    for _ in error_margins]
+    print(f"Quantifying fiber-ROI intersection for {atlas}...")
+    for streamlines in iter_streamline_chunks(streams, fa_img,
+                                              streamline_chunk_size):
+        fiber_lengths = [len(s) for s in streamlines]
+        if fa_wei is True:
+            fa_values = values_from_volume(fa_data, streamlines, np.eye(4))
+        else:
+            fa_values = None
+        for accumulator, incidence in zip(accumulators,
+                                          streamline_node_incidence(
+                                              streamlines, label_data,
+                                              node_lut, offsets,
+                                              overlap_thr)):
+            accumulator.update(incidence, fiber_lengths, fa_values)
+        del streamlines, fa_values
+    print(f"Streamlines labeled: {accumulators[0].n_streamlines}")
+    del label_data
     if fa_wei is True:
-        print("Weighting edges by FA...")
-        # Add FA attributes for each edge
-        ix = 0
-        for u, v, d in g.edges(data=True):
-            if d['weight'] > 0:
-                edge_average_fa = np.nanmean(fa_weights_dict[(u, v)])
-            else:
-                edge_average_fa = np.nan
-            g.edges[u, v].update({"fa_weight": edge_average_fa})
-            ix += 1
-
-    # Summarize weights
-    if fa_wei is True and fiber_density is True:
-        for u, v, d in g.edges(data=True):
-            g.edges[u, v].update({"final_weight":
-                                      (d['fa_weight'])*d['fiber_density']})
-    elif fiber_density is True and fa_wei is False:
-        for u, v, d in g.edges(data=True):
-            g.edges[u, v].update({"final_weight": d['fiber_density']})
-    elif fa_wei is True and fiber_density is False:
-        for u, v, d in g.edges(data=True):
-            g.edges[u, v].update({"final_weight": d['fa_weight']*d['weight']})
-    else:
-        for u, v, d in g.edges(data=True):
-            g.edges[u, v].update({"final_weight": d['weight']})
+        del fa_data
+    gc.collect()
 
-    # Convert weighted graph to numpy matrix
-    conn_matrix_raw = nx.to_numpy_array(g, weight='final_weight')
+    conn_matrices = []
+    for accumulator in accumulators:
+        conn_matrix_raw = accumulator.to_matrix(fiber_density, fa_wei)
 
-    # Enforce symmetry
-    conn_matrix = np.maximum(conn_matrix_raw, conn_matrix_raw.T)
+        # Enforce symmetry
+        conn_matrices.append(np.maximum(conn_matrix_raw, conn_matrix_raw.T))
 
     print("Structural graph completed:\n", str(time.time() - start))
 
-    if len(bad_idxs) > 0:
-        bad_idxs = sorted(list(set(bad_idxs)), reverse=True)
-        for j in bad_idxs:
-            del labels[j], coords[j]
-
     coords = np.array(coords)
     labels = np.array(labels)
 
-    assert len(coords) == len(labels) == conn_matrix.shape[0]
+    assert all([len(coords) == len(labels) == i.shape[0] for i in
+                conn_matrices])
+
+    if isinstance(error_margin, (list, tuple)):
+        conn_matrix = conn_matrices
+        error_margin = error_margins
+    else:
+        conn_matrix = conn_matrices[0]
 
     return (
         atlas_mni,
@@ -812,3 +938,30 @@ def streams2graph(
         min_length,
         error_margin
     )
+
+
+def select_error_margin(conn_matrix, error_margin_list, error_margin):
+    """
+    Select the connectivity matrix estimated for a given error margin from
+    those returned by a multi-margin run of `streams2graph`.
+
+    Parameters
+    ----------
+    conn_matrix : list
+        List of adjacency matrices, one per error margin.
+    error_margin_list : list
+        List of error margins corresponding to `conn_matrix`.
+    error_margin : int
+        Euclidean margin of error for classifying a streamline as a connection
+         to an ROI.
+
+    Returns
+    -------
+    conn_matrix : array
+        Adjacency matrix stored as an m x n array of nodes and edges.
+    error_margin : int
+        Euclidean margin of error for classifying a streamline as a connection
+         to an ROI.
+    """
+    return conn_matrix[list(error_margin_list).index(error_margin)], \
+        error_margin
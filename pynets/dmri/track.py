@@ -12,6 +12,10 @@ import indexed_gzip
 
 warnings.filterwarnings("ignore")
 
+# Direction getters and tissue classifiers instantiated by each tracking
+# worker process, keyed by ensemble combination
+_tracker_cache = {}
+
 
 def reconstruction(conn_model, gtab, dwi_data, B0_mask):
     """
@@ -74,16 +78,258 @@ def reconstruction(conn_model, gtab, dwi_data, B0_mask):
     return mod_fit, mod
 
 
-def prep_tissues(
+def get_recon_chunk_shape(shape, slab_size=4, chunk_bytes=2**20):
+    """
+    Choose the HDF5 chunk shape of a 4D reconstruction dataset.
+
+    Each chunk holds every coefficient of a block of voxels spanning
+    `slab_size` axial slices, which matches both how slabs are fitted and
+    how tractography reads whole coefficient vectors of neighboring voxels.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the reconstruction dataset (x, y, z, n_coefficients).
+    slab_size : int
+        Number of axial slices per chunk.
+    chunk_bytes : int
+        Approximate size of a chunk of float32 coefficients, in bytes.
+
+    Returns
+    -------
+    chunks : tuple
+        HDF5 chunk shape.
+
+    """
+    slab_size = max(min(int(slab_size), shape[2]), 1)
+    edge = max(int(np.sqrt(chunk_bytes / (4. * shape[3] * slab_size))), 1)
+
+    return (min(edge, shape[0]), min(edge, shape[1]), slab_size, shape[3])
+
+
+def reconstruction_blockwise(conn_model, gtab, dwi_data, B0_mask,
+                             recon_path, nthreads=1, slab_size=4,
+                             recon_cache_dir=None, compression='lzf'):
+    """
+    Fit a diffusion reconstruction model slab by slab in a pool of
+    processes, writing the coefficients straight into an HDF5 file.
+
+    Parameters
+    ----------
+    conn_model : str
+        Connectivity reconstruction method (e.g. 'csa', 'tensor', 'csd',
+        'sfm').
+    gtab : Obj
+        DiPy object storing diffusion gradient information.
+    dwi_data : array
+        4D array of dwi data.
+    B0_mask : str
+        File path to B0 brain mask.
+    recon_path : str
+        File path to the HDF5 file in which the coefficients are saved as the
+        `reconstruction` dataset.
+    nthreads : int
+        Number of processes fitting slabs concurrently.
+    slab_size : int
+        Number of axial slices fitted per slab. Peak memory grows with
+        `nthreads` x `slab_size` rather than with the volume size.
+    recon_cache_dir : str
+        Directory of reconstructions keyed by a hash of their inputs and
+        model parameters. If the current reconstruction is found there, it
+        is reused instead of refitting the model; otherwise it is added.
+    compression : str
+        HDF5 compression filter of the chunked `reconstruction` dataset
+        (e.g. 'lzf' or 'gzip'), or None for no compression. Chunks entirely
+        outside of the brain mask are never allocated.
+
+    Returns
+    -------
+    recon_path : str
+        File path to the HDF5 file of reconstruction coefficients.
+
+    """
+    import os
+    import shutil
+    import h5py
+    from joblib import Parallel, delayed
+    from pynets.dmri.track import get_recon_cache_key, get_recon_chunk_shape
+    from pynets.dmri.estimation import recon_model, fit_recon_model
+
+    conn_model = conn_model.lower()
+    if conn_model not in ["csa", "csd", "sfm", "ten", "tensor"]:
+        try:
+            raise ValueError(
+                "Error: No valid reconstruction model specified. See the "
+                "`-mod` flag."
+            )
+        except ValueError:
+            import sys
+            sys.exit(0)
+
+    B0_mask_data = np.nan_to_num(np.asarray(
+        nib.load(B0_mask).dataobj)).astype("bool")
+
+    if recon_cache_dir is not None:
+        recon_key = get_recon_cache_key(conn_model, gtab, dwi_data,
+                                        B0_mask_data)
+        cached_path = f"{recon_cache_dir}/reconstruction_{recon_key}.hdf5"
+        if os.path.isfile(cached_path):
+            print(f"Found existing {conn_model} reconstruction of the same "
+                  f"inputs: {cached_path}. Loading...")
+            shutil.copyfile(cached_path, recon_path)
+            return recon_path
+
+    print(f"Fitting {conn_model} model in slabs of {slab_size} slices...")
+    model = recon_model(conn_model, gtab, dwi_data, B0_mask_data)
+
+    # Only slabs overlapping the brain mask are fitted. The rest of the
+    # dataset keeps its zero fill value.
+    slabs = [(z, min(z + slab_size, B0_mask_data.shape[2])) for z in
+             range(0, B0_mask_data.shape[2], slab_size) if
+             B0_mask_data[:, :, z:z + slab_size].any()]
+    if len(slabs) == 0:
+        slabs = [(0, min(slab_size, B0_mask_data.shape[2]))]
+
+    # Bounding box of the brain mask, so that readers can skip the
+    # background
+    if B0_mask_data.any():
+        mask_vox = np.argwhere(B0_mask_data)
+        bbox = np.stack([mask_vox.min(0), mask_vox.max(0) + 1],
+                        axis=1).ravel()
+    else:
+        bbox = np.stack([np.zeros(3, dtype=int), B0_mask_data.shape],
+                        axis=1).ravel()
+
+    with h5py.File(recon_path, 'w') as hf:
+        recon = None
+        with Parallel(n_jobs=nthreads, backend='loky') as parallel:
+            for i in range(0, len(slabs), nthreads):
+                mod_fits = parallel(
+                    delayed(fit_recon_model)(
+                        model, conn_model, dwi_data[:, :, z0:z1],
+                        B0_mask_data[:, :, z0:z1])
+                    for z0, z1 in slabs[i:i + nthreads])
+                for (z0, z1), mod_fit in zip(slabs[i:i + nthreads],
+                                             mod_fits):
+                    if recon is None:
+                        shape = B0_mask_data.shape + mod_fit.shape[-1:]
+                        recon = hf.create_dataset(
+                            "reconstruction", shape=shape, dtype='f4',
+                            fillvalue=0,
+                            chunks=get_recon_chunk_shape(shape, slab_size),
+                            compression=compression)
+                        recon.attrs['bbox'] = bbox
+                    recon[:, :, z0:z1] = mod_fit.astype('float32')
+                del mod_fits
+    hf.close()
+
+    del B0_mask_data, model
+
+    if recon_cache_dir is not None:
+        # Publish atomically, so that concurrent runs never read a partial
+        # file
+        os.makedirs(recon_cache_dir, exist_ok=True)
+        shutil.copyfile(recon_path, f"{cached_path}.{os.getpid()}.tmp")
+        os.replace(f"{cached_path}.{os.getpid()}.tmp", cached_path)
+
+    return recon_path
+
+
+def get_recon_cache_key(conn_model, gtab, dwi_data, B0_mask_data,
+                        sh_order=8):
+    """
+    Hash the inputs and parameters of a diffusion reconstruction into a key
+    that identifies its coefficients across runs.
+
+    Parameters
+    ----------
+    conn_model : str
+        Connectivity reconstruction method (e.g. 'csa', 'tensor', 'csd',
+        'sfm').
+    gtab : Obj
+        DiPy object storing diffusion gradient information.
+    dwi_data : array
+        4D array of dwi data.
+    B0_mask_data : array
+        3D boolean array of the B0 brain mask.
+    sh_order : int
+        The order of the SH model.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal SHA-256 digest.
+
+    """
+    import json
+    import hashlib
+    from pynets.dmri.estimation import recon_model_params
+
+    conn_model = conn_model.lower()
+    if conn_model == "tensor":
+        conn_model = "ten"
+
+    sha = hashlib.sha256()
+    sha.update(json.dumps({'conn_model': conn_model,
+                           'params': recon_model_params(conn_model,
+                                                        sh_order=sh_order)},
+                          sort_keys=True).encode())
+    for arr in [dwi_data, np.asarray(gtab.bvals), np.asarray(gtab.bvecs),
+                np.asarray(B0_mask_data, dtype=bool)]:
+        arr = np.ascontiguousarray(arr)
+        sha.update(f"{arr.dtype.str}{arr.shape}".encode())
+        sha.update(memoryview(arr.reshape(-1)).cast('B'))
+    sha.update(str(gtab.b0_threshold).encode())
+
+    return sha.hexdigest()
+
+
+def get_tracking_checkpoint_key(run_params, input_files):
+    """
+    Key a checkpointed ensemble tractography run by its parameters and by
+    the contents of its input files, so that its shards are only ever
+    restored for the same run on the same inputs.
+
+    Parameters
+    ----------
+    run_params : dict
+        JSON-serializable tracking parameters.
+    input_files : list
+        File paths to the tracking inputs (e.g. reconstruction, atlas, masks).
+        None entries are skipped.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal SHA-256 digest.
+
+    """
+    import json
+    import hashlib
+
+    sha = hashlib.sha256()
+    sha.update(json.dumps(run_params, sort_keys=True).encode())
+    for input_file in input_files:
+        if input_file is None:
+            sha.update(b"None")
+            continue
+        with open(input_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        f.close()
+
+    return sha.hexdigest()
+
+
+def prep_tissue_maps(
     t1_mask,
     gm_in_dwi,
     vent_csf_in_dwi,
     wm_in_dwi,
     tiss_class,
-    B0_mask,
-    cmc_step_size=0.2):
+    B0_mask):
     """
-    Estimate a tissue classifier for tractography.
+    Prepare the tissue maps from which a tissue classifier is instantiated.
 
     Parameters
     ----------
@@ -97,30 +343,20 @@ def prep_tissues(
         File path to white-matter tissue segmentation Nifti1Image.
     tiss_class : str
         Tissue classification method.
-    cmc_step_size : float
-        Step size from CMC tissue classification method.
+    B0_mask : str
+        File path to B0 brain mask.
 
     Returns
     -------
-    tiss_classifier : obj
-        Tissue classifier object.
-
-    References
-    ----------
-    .. [1] Zhang, Y., Brady, M. and Smith, S. Segmentation of Brain MR Images
-      Through a Hidden Markov Random Field Model and the
-      Expectation-Maximization Algorithm IEEE Transactions on Medical Imaging,
-      20(1): 45-56, 2001
-    .. [2] Avants, B. B., Tustison, N. J., Wu, J., Cook, P. A. and Gee, J. C.
-      An open source multivariate framework for n-tissue segmentation with
-      evaluation on public data. Neuroinformatics, 9(4): 381-400, 2011.
+    tissue_maps : list
+        List of 3D arrays consumed by `tiss_classifier_from_maps`. This is a
+        single binary mask for 'wm' and 'wb', include and exclude maps for
+        'act', and white-matter, grey-matter and CSF partial volume maps for
+        'cmc'.
+    voxel_size : float
+        Average voxel size of the T1w mask.
 
     """
-    from dipy.tracking.stopping_criterion import (
-        ActStoppingCriterion,
-        CmcStoppingCriterion,
-        BinaryStoppingCriterion,
-    )
     from nilearn.masking import intersect_masks
     from nilearn.image import math_img
 
@@ -129,8 +365,9 @@ def prep_tissues(
 
     # Load t1 mask
     mask_img = math_img("img > 0.0", img=nib.load(t1_mask, mmap=True))
+    voxel_size = np.average(mask_img.header["pixdim"][1:4])
 
-    # Load tissue maps and prepare tissue classifier
+    # Load tissue maps
     wm_img = nib.load(wm_in_dwi, mmap=True)
     wm_mask_img = math_img("img > 0.0", img=wm_img)
     gm_img = nib.load(gm_in_dwi, mmap=True)
@@ -144,11 +381,10 @@ def prep_tissues(
         background[(gm_data + wm_data +
                     vent_csf_in_dwi_data) > 0] = 0
         gm_data[background > 0] = 1
-        tiss_classifier = ActStoppingCriterion(
-            gm_data, vent_csf_in_dwi_data)
+        tissue_maps = [gm_data, vent_csf_in_dwi_data]
         del background
     elif tiss_class == "wm":
-        tiss_classifier = BinaryStoppingCriterion(
+        tissue_maps = [
             np.asarray(
                 intersect_masks(
                     [
@@ -160,18 +396,11 @@ def prep_tissues(
                     connected=False,
                 ).dataobj
             )
-        )
+        ]
     elif tiss_class == "cmc":
-        voxel_size = np.average(mask_img.header["pixdim"][1:4])
-        tiss_classifier = CmcStoppingCriterion.from_pve(
-            wm_data,
-            gm_data,
-            vent_csf_in_dwi_data,
-            step_size=cmc_step_size,
-            average_voxel_size=voxel_size,
-        )
+        tissue_maps = [wm_data, gm_data, vent_csf_in_dwi_data]
     elif tiss_class == "wb":
-        tiss_classifier = BinaryStoppingCriterion(
+        tissue_maps = [
             np.asarray(
                 intersect_masks(
                     [
@@ -179,14 +408,14 @@ def prep_tissues(
                         B0_mask_img,
                         nib.Nifti1Image(np.invert(
                             vent_csf_in_dwi_data.astype('bool')).astype(
-                            'int'),
+                            'uint8'),
                                         affine=mask_img.affine),
                     ],
                     threshold=1,
                     connected=False,
                 ).dataobj
             )
-        )
+        ]
     else:
         try:
             raise ValueError("Tissue classifier cannot be none.")
@@ -200,9 +429,290 @@ def prep_tissues(
     wm_img.uncache()
     B0_mask_img.uncache()
 
+    return tissue_maps, voxel_size
+
+
+def tiss_classifier_from_maps(tiss_class, tissue_maps, voxel_size,
+                              cmc_step_size=0.2):
+    """
+    Instantiate a tissue classifier from prepared tissue maps.
+
+    Parameters
+    ----------
+    tiss_class : str
+        Tissue classification method.
+    tissue_maps : list
+        List of 3D arrays returned by `prep_tissue_maps`.
+    voxel_size : float
+        Average voxel size of the T1w mask.
+    cmc_step_size : float
+        Step size from CMC tissue classification method.
+
+    Returns
+    -------
+    tiss_classifier : obj
+        Tissue classifier object.
+
+    """
+    from dipy.tracking.stopping_criterion import (
+        ActStoppingCriterion,
+        CmcStoppingCriterion,
+        BinaryStoppingCriterion,
+    )
+
+    if tiss_class == "act":
+        tiss_classifier = ActStoppingCriterion(
+            np.asarray(tissue_maps[0], dtype=np.float64),
+            np.asarray(tissue_maps[1], dtype=np.float64))
+    elif tiss_class == "wm" or tiss_class == "wb":
+        tiss_classifier = BinaryStoppingCriterion(
+            np.asarray(tissue_maps[0]))
+    elif tiss_class == "cmc":
+        tiss_classifier = CmcStoppingCriterion.from_pve(
+            np.asarray(tissue_maps[0], dtype=np.float64),
+            np.asarray(tissue_maps[1], dtype=np.float64),
+            np.asarray(tissue_maps[2], dtype=np.float64),
+            step_size=cmc_step_size,
+            average_voxel_size=voxel_size,
+        )
+    else:
+        try:
+            raise ValueError("Tissue classifier cannot be none.")
+        except ValueError:
+            import sys
+            sys.exit(0)
+
     return tiss_classifier
 
 
+def prep_tissues(
+    t1_mask,
+    gm_in_dwi,
+    vent_csf_in_dwi,
+    wm_in_dwi,
+    tiss_class,
+    B0_mask,
+    cmc_step_size=0.2):
+    """
+    Estimate a tissue classifier for tractography.
+
+    Parameters
+    ----------
+    t1_mask : str
+        File path to a T1w mask.
+    gm_in_dwi : str
+        File path to grey-matter tissue segmentation Nifti1Image.
+    vent_csf_in_dwi : str
+        File path to ventricular CSF tissue segmentation Nifti1Image.
+    wm_in_dwi : str
+        File path to white-matter tissue segmentation Nifti1Image.
+    tiss_class : str
+        Tissue classification method.
+    cmc_step_size : float
+        Step size from CMC tissue classification method.
+
+    Returns
+    -------
+    tiss_classifier : obj
+        Tissue classifier object.
+
+    References
+    ----------
+    .. [1] Zhang, Y., Brady, M. and Smith, S. Segmentation of Brain MR Images
+      Through a Hidden Markov Random Field Model and the
+      Expectation-Maximization Algorithm IEEE Transactions on Medical Imaging,
+      20(1): 45-56, 2001
+    .. [2] Avants, B. B., Tustison, N. J., Wu, J., Cook, P. A. and Gee, J. C.
+      An open source multivariate framework for n-tissue segmentation with
+      evaluation on public data. Neuroinformatics, 9(4): 381-400, 2011.
+
+    """
+    [tissue_maps, voxel_size] = prep_tissue_maps(
+        t1_mask, gm_in_dwi, vent_csf_in_dwi, wm_in_dwi, tiss_class, B0_mask)
+
+    return tiss_classifier_from_maps(tiss_class, tissue_maps, voxel_size,
+                                     cmc_step_size=cmc_step_size)
+
+
+def share_tracking_inputs(
+    recon_path,
+    atlas_data_wm_gm_int,
+    labels_im_file,
+    B0_mask,
+    waymask,
+    t1w2dwi,
+    gm_in_dwi,
+    vent_csf_in_dwi,
+    wm_in_dwi,
+    tiss_class,
+    cache_dir
+):
+    """
+    Load the inputs of ensemble tractography once and store them as
+    uncompressed `.npy` buffers that tracking workers can memory-map.
+
+    Parameters
+    ----------
+    recon_path : str
+        File path to diffusion reconstruction model.
+    atlas_data_wm_gm_int : str
+        File path to atlas parcellation Nifti1Image in T1w-warped native
+        diffusion space, restricted to wm-gm interface.
+    labels_im_file : str
+        File path to atlas parcellation Nifti1Image aligned to dwi space.
+    B0_mask : str
+        File path to B0 brain mask.
+    waymask : str
+        File path to tractography constraint mask in native diffusion space.
+    t1w2dwi : str
+        File path to a T1w mask in native diffusion space.
+    gm_in_dwi : str
+        File path to grey-matter tissue segmentation Nifti1Image.
+    vent_csf_in_dwi : str
+        File path to ventricular CSF tissue segmentation Nifti1Image.
+    wm_in_dwi : str
+        File path to white-matter tissue segmentation Nifti1Image.
+    tiss_class : str
+        Tissue classification method.
+    cache_dir : str
+        Directory in which the buffers are stored.
+
+    Returns
+    -------
+    tracking_inputs : dict
+        Dictionary of `.npy` file paths (and tissue classifier parameters)
+        that workers open with `np.load(..., mmap_mode='r')`. The
+        reconstruction and tissue maps only cover the bounding box of the
+        brain mask, stored as 'bbox' ([x0, x1, y0, y1, z0, z1]).
+
+    """
+    import os
+    import uuid
+    import h5py
+    from scipy.ndimage import distance_transform_edt
+
+    tracking_inputs = {'run_id': uuid.uuid4().hex}
+
+    # Coefficients are stored as float64 so that direction getters can wrap
+    # a copy-on-write memory map without making a private copy. Only the
+    # brain mask's bounding box is stored, one chunk-row of slices at a time,
+    # and tracking offsets its voxels by the corner of the box.
+    with h5py.File(recon_path, 'r') as hf:
+        recon = hf['reconstruction']
+        if 'bbox' in recon.attrs:
+            # Padded, so that streamlines reach the same zero-filled
+            # background around the brain mask as in the full volume
+            [x0, x1, y0, y1, z0, z1] = [
+                max(int(i) - 3, 0) if j % 2 == 0 else
+                min(int(i) + 3, recon.shape[j // 2])
+                for j, i in enumerate(recon.attrs['bbox'])]
+        else:
+            [x0, x1, y0, y1, z0, z1] = [0, recon.shape[0], 0,
+                                        recon.shape[1], 0, recon.shape[2]]
+        tracking_inputs['bbox'] = [x0, x1, y0, y1, z0, z1]
+        tracking_inputs['recon'] = f"{cache_dir}/reconstruction.npy"
+        mod_fit = np.lib.format.open_memmap(
+            tracking_inputs['recon'], mode='w+', dtype='float64',
+            shape=(x1 - x0, y1 - y0, z1 - z0) + recon.shape[3:])
+        step = recon.chunks[2] if recon.chunks is not None else z1 - z0
+        for z in range(z0, z1, max(step, 1)):
+            mod_fit[:, :, z - z0:min(z + step, z1) - z0] = \
+                recon[x0:x1, y0:y1, z:min(z + step, z1)]
+        mod_fit.flush()
+        del mod_fit
+    hf.close()
+
+    tracking_inputs['seeding_mask'] = f"{cache_dir}/seeding_mask.npy"
+    np.save(tracking_inputs['seeding_mask'],
+            np.asarray(nib.load(atlas_data_wm_gm_int).dataobj).astype(
+                "bool"))
+
+    tracking_inputs['atlas'] = f"{cache_dir}/atlas.npy"
+    atlas_data = np.asarray(nib.load(labels_im_file).dataobj).astype(
+        "uint16")
+    np.save(tracking_inputs['atlas'], atlas_data)
+
+    # Distance from every voxel to the nearest labeled voxel, used to filter
+    # streamlines by roi proximity for any tolerance
+    tracking_inputs['roi_distance'] = f"{cache_dir}/roi_distance.npy"
+    np.save(tracking_inputs['roi_distance'],
+            distance_transform_edt(atlas_data == 0).astype("float32"))
+    del atlas_data
+
+    tracking_inputs['B0_mask'] = f"{cache_dir}/B0_mask.npy"
+    np.save(tracking_inputs['B0_mask'],
+            np.asarray(nib.load(B0_mask).dataobj).astype("bool"))
+
+    if waymask is not None and os.path.isfile(waymask):
+        tracking_inputs['waymask'] = f"{cache_dir}/waymask.npy"
+        waymask_data = np.asarray(nib.load(waymask).dataobj).astype("bool")
+        np.save(tracking_inputs['waymask'], waymask_data)
+        tracking_inputs['waymask_distance'] = \
+            f"{cache_dir}/waymask_distance.npy"
+        np.save(tracking_inputs['waymask_distance'],
+                distance_transform_edt(~waymask_data).astype("float32"))
+        del waymask_data
+    else:
+        tracking_inputs['waymask'] = None
+
+    tracking_inputs.update(share_tissue_maps(t1w2dwi, gm_in_dwi,
+                                             vent_csf_in_dwi, wm_in_dwi,
+                                             tiss_class, B0_mask, cache_dir,
+                                             tracking_inputs['bbox']))
+
+    return tracking_inputs
+
+
+def share_tissue_maps(t1w2dwi, gm_in_dwi, vent_csf_in_dwi, wm_in_dwi,
+                      tiss_class, B0_mask, cache_dir, bbox=None):
+    """
+    Store the tissue maps of a given tissue classification method as `.npy`
+    buffers that tracking workers can memory-map.
+
+    Parameters
+    ----------
+    t1w2dwi : str
+        File path to a T1w mask in native diffusion space.
+    gm_in_dwi : str
+        File path to grey-matter tissue segmentation Nifti1Image.
+    vent_csf_in_dwi : str
+        File path to ventricular CSF tissue segmentation Nifti1Image.
+    wm_in_dwi : str
+        File path to white-matter tissue segmentation Nifti1Image.
+    tiss_class : str
+        Tissue classification method.
+    B0_mask : str
+        File path to B0 brain mask.
+    cache_dir : str
+        Directory in which the buffers are stored.
+    bbox : list
+        Bounding box ([x0, x1, y0, y1, z0, z1]) to which the tissue maps are
+        cropped. Default is None, which stores them whole.
+
+    Returns
+    -------
+    tissue_inputs : dict
+        Dictionary with the tissue classification method, the `.npy` file
+        paths of its tissue maps and the average voxel size.
+
+    """
+    [tissue_maps, voxel_size] = prep_tissue_maps(
+        t1w2dwi, gm_in_dwi, vent_csf_in_dwi, wm_in_dwi, tiss_class, B0_mask)
+
+    tissue_map_paths = []
+    for i, tissue_map in enumerate(tissue_maps):
+        tissue_map_path = f"{cache_dir}/tissue_map_{tiss_class}_{i}.npy"
+        if bbox is not None:
+            tissue_map = tissue_map[bbox[0]:bbox[1], bbox[2]:bbox[3],
+                                    bbox[4]:bbox[5]]
+        np.save(tissue_map_path, tissue_map)
+        tissue_map_paths.append(tissue_map_path)
+    del tissue_maps
+
+    return {'tiss_class': tiss_class, 'tissue_maps': tissue_map_paths,
+            'voxel_size': voxel_size}
+
+
 def create_density_map(
     dwi_img,
     dir_path,
@@ -218,6 +728,7 @@ def create_density_map(
     min_length,
     error_margin,
     namer_dir,
+    density=None,
 ):
     """
     Create a density map of the list of streamlines.
@@ -252,6 +763,9 @@ def create_density_map(
         closest (clos), boot (bootstrapped), and prob (probabilistic).
     min_length : int
         Minimum fiber length threshold in mm to restrict tracking.
+    density : ndarray
+        Precomputed 3D fiber density map of `streamlines` (e.g. as
+        accumulated by `track_ensemble`). If None, it is computed here.
 
     Returns
     -------
@@ -268,13 +782,14 @@ def create_density_map(
     from dipy.tracking import utils
 
     # Create density map
-    dm = utils.density_map(
-        streamlines,
-        affine=np.eye(4),
-        vol_dims=dwi_img.shape)
+    if density is None:
+        density = utils.density_map(
+            streamlines,
+            affine=np.eye(4),
+            vol_dims=dwi_img.shape[:3])
 
     # Save density map
-    dm_img = nib.Nifti1Image(dm.astype("float32"), dwi_img.affine)
+    dm_img = nib.Nifti1Image(density.astype("float32"), dwi_img.affine)
 
     dm_path = "%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s" % (
         namer_dir,
@@ -332,7 +847,9 @@ def track_ensemble(
     vent_csf_in_dwi,
     wm_in_dwi,
     tiss_class,
-    cache_dir
+    cache_dir,
+    return_density=False,
+    checkpoint_dir=None
 ):
     """
     Perform native-space ensemble tractography, restricted to a vector of ROI
@@ -396,11 +913,23 @@ def track_ensemble(
         Number of particles to use in the particle filter.
     min_separation_angle : float
         The minimum angle between directions [0, 90].
+    return_density : bool
+        If True, also return the fiber density map, accumulated batch by batch
+        while tracking.
+    checkpoint_dir : str
+        Directory in which the shards of checkpointed runs are kept, keyed by
+        the run parameters and the contents of the inputs. It should outlive
+        `cache_dir` (e.g. a node's working directory, which nipype empties
+        before rerunning it). Default is None, which keeps them under
+        `cache_dir`.
 
     Returns
     -------
     streamlines : ArraySequence
         DiPy list/array-like object of streamline points from tractography.
+    density : ndarray
+        3D fiber density map of `streamlines`, counting the streamlines that
+        traverse each voxel. Only returned if `return_density` is True.
 
     References
     ----------
@@ -416,11 +945,15 @@ def track_ensemble(
     import pkg_resources
     import yaml
     import shutil
+    import json
     from joblib import Parallel, delayed
     import itertools
-    from pynets.dmri.track import run_tracking
+    from pynets.dmri.track import run_tracking_timed, \
+        share_tracking_inputs, share_tissue_maps, get_batch_seed, \
+        save_tracking_shard, merge_tracking_shards, SeedBudgetScheduler, \
+        get_tracking_checkpoint_key
     from colorama import Fore, Style
-    from pynets.dmri.dmri_utils import generate_sl
+    from pynets.dmri.dmri_utils import generate_sl, accumulate_density_map
     from nibabel.streamlines.array_sequence import concatenate, ArraySequence
 
     cache_dir = f"{cache_dir}/joblib_tracking"
@@ -443,51 +976,172 @@ def track_ensemble(
             hardcoded_params['tracking']["particle_count"][0]
         min_separation_angle = \
             hardcoded_params['tracking']["min_separation_angle"][0]
+        tracking_seed = \
+            hardcoded_params['tracking']["tracking_seed"][0]
+        checkpoint_tracking = \
+            hardcoded_params['tracking']["checkpoint_tracking"][0]
+        adaptive_seed_budget = \
+            hardcoded_params['tracking']["adaptive_seed_budget"][0]
     stream.close()
 
     all_combs = list(itertools.product(step_list, curv_thr_list))
 
+    # Restore the state of an interrupted run from its last completed shard
+    run_params = {'target_samples': target_samples, 'directget': directget,
+                  'curv_thr_list': list(curv_thr_list),
+                  'step_list': list(step_list), 'track_type': track_type,
+                  'tracking_seed': tracking_seed,
+                  'n_seeds_per_iter': n_seeds_per_iter,
+                  'adaptive_seed_budget': adaptive_seed_budget,
+                  'maxcrossing': maxcrossing,
+                  'roi_neighborhood_tol': roi_neighborhood_tol,
+                  'min_length': min_length, 'tiss_class': tiss_class,
+                  'waymask': waymask is not None}
+    if checkpoint_tracking is True:
+        run_params['inputs'] = get_tracking_checkpoint_key(
+            run_params,
+            [recon_path, atlas_data_wm_gm_int, labels_im_file, waymask,
+             B0_mask, t1w2dwi, gm_in_dwi, vent_csf_in_dwi, wm_in_dwi])
+        if checkpoint_dir is None:
+            checkpoint_dir = cache_dir
+        shard_dir = f"{checkpoint_dir}/shards_{run_params['inputs'][:16]}"
+    else:
+        shard_dir = f"{cache_dir}/shards"
+    manifest = f"{shard_dir}/manifest.json"
+    state = {'params': run_params, 'iteration': 0, 'stream_counter': 0,
+             'ix': 0, 'roi_neighborhood_tol': roi_neighborhood_tol,
+             'min_length': min_length, 'tiss_class': tiss_class,
+             'shards': []}
+    if checkpoint_tracking is True:
+        if os.path.isfile(manifest):
+            with open(manifest, 'r') as f:
+                prev_state = json.load(f)
+            f.close()
+            if prev_state['params'] == run_params:
+                state = prev_state
+                print(f"Resuming ensemble tractography from iteration "
+                      f"{state['iteration']} with {state['stream_counter']} "
+                      f"streamlines...")
+            else:
+                shutil.rmtree(shard_dir, ignore_errors=True)
+        os.makedirs(shard_dir, exist_ok=True)
+    iteration = state['iteration']
+    stream_counter = state['stream_counter']
+    ix = state['ix']
+    roi_neighborhood_tol = state['roi_neighborhood_tol']
+    min_length = state['min_length']
+    tiss_class = state['tiss_class']
+
+    # Track the yield of every combination to steer seeds toward productive
+    # ones
+    scheduler = SeedBudgetScheduler(len(all_combs), n_seeds_per_iter)
+    if 'scheduler' in state:
+        scheduler.set_state(state['scheduler'])
+
+    # Fiber density is accumulated as each batch completes, so that it needs
+    # no second pass over the final tractogram
+    density = np.zeros(nib.load(B0_mask).shape[:3], dtype='int64')
+    if 'density' in state:
+        density[:] = np.load(state['density'])
+    else:
+        for shard in state['shards']:
+            accumulate_density_map(density, merge_tracking_shards([shard]))
+
+    # Load inputs once into memory-mapped buffers shared by all workers
+    tracking_inputs = share_tracking_inputs(
+        recon_path, atlas_data_wm_gm_int, labels_im_file, B0_mask, waymask,
+        t1w2dwi, gm_in_dwi, vent_csf_in_dwi, wm_in_dwi, tiss_class,
+        cache_dir)
+
     # Commence Ensemble Tractography
     start = time.time()
-    stream_counter = 0
 
     all_streams = []
-    ix = 0
-    while float(stream_counter) < float(target_samples):
-        with Parallel(n_jobs=nthreads, backend='loky',
-                      mmap_mode='r+', temp_folder=cache_dir,
-                      verbose=10) as parallel:
-            out_streams = parallel(
-                delayed(run_tracking)(
-                    i, atlas_data_wm_gm_int, recon_path,
-                    n_seeds_per_iter, directget, maxcrossing, max_length,
-                    pft_back_tracking_dist, pft_front_tracking_dist,
-                    particle_count, B0_mask, roi_neighborhood_tol,
-                    labels_im_file, waymask, min_length, track_type,
-                    min_separation_angle, sphere, t1w2dwi, gm_in_dwi,
-                    vent_csf_in_dwi, wm_in_dwi, tiss_class, cache_dir) for i in
-                all_combs)
-
-            out_streams = [i for i in out_streams if i is not None and
-                           len(i) > 0]
-
-            out_streams = concatenate(out_streams, axis=0)
+    # Workers persist across iterations so that each builds the direction
+    # getter and tissue classifier of a combination only once
+    with Parallel(n_jobs=nthreads, backend='loky',
+                  mmap_mode='r+', temp_folder=cache_dir,
+                  verbose=10) as parallel:
+        while float(stream_counter) < float(target_samples):
+            if float(ix) > len(all_combs):
+                break
+
+            if adaptive_seed_budget is True:
+                seed_budget = scheduler.allocate()
+            else:
+                seed_budget = [n_seeds_per_iter] * len(all_combs)
+
+            out = parallel(
+                delayed(run_tracking_timed)(
+                    comb, tracking_inputs, n_seeds, directget,
+                    maxcrossing, max_length, pft_back_tracking_dist,
+                    pft_front_tracking_dist, particle_count,
+                    roi_neighborhood_tol, min_length, track_type,
+                    min_separation_angle, sphere,
+                    get_batch_seed(tracking_seed, comb, iteration))
+                for comb, n_seeds in zip(all_combs, seed_budget))
+
+            scheduler.update(
+                seed_budget,
+                [len(i[0]) if i[0] is not None else 0 for i in out],
+                [i[1] for i in out])
+            if adaptive_seed_budget is True:
+                [per_seed, per_second] = scheduler.yields()
+                for comb, n_seeds, y_seed, y_second in zip(
+                        all_combs, seed_budget, per_seed, per_second):
+                    print(f"Step: {comb[0]}, Curvature: {comb[1]} -- seeds: "
+                          f"{n_seeds}, streamlines/seed: {y_seed:.3f}, "
+                          f"streamlines/sec: {y_second:.2f}")
+
+            out_streams = [i[0] for i in out if i[0] is not None and
+                           len(i[0]) > 0]
+            del out
+
+            out_streams = concatenate(out_streams, axis=0) if \
+                len(out_streams) > 0 else ArraySequence()
 
             if len(out_streams) < 100:
                 ix += 1
                 print("Fewer than 100 streamlines tracked on last iteration."
                       " loosening tolerance and anatomical constraints...")
-                if track_type != 'particle':
+                if track_type != 'particle' and tiss_class != 'wb':
                     tiss_class = 'wb'
+                    tracking_inputs.update(share_tissue_maps(
+                        t1w2dwi, gm_in_dwi, vent_csf_in_dwi, wm_in_dwi,
+                        tiss_class, B0_mask, cache_dir,
+                        tracking_inputs['bbox']))
                 roi_neighborhood_tol = float(roi_neighborhood_tol) * 1.05
                 min_length = float(min_length) * 0.95
             else:
                 ix -= 1
 
-            # Append streamline generators to prevent exponential growth
-            # in memory consumption
-            all_streams.extend([generate_sl(i) for i in out_streams])
+            accumulate_density_map(density, out_streams)
             stream_counter += len(out_streams)
+            iteration += 1
+            if checkpoint_tracking is True:
+                # Persist the batch and the loosened constraints before
+                # moving on, so that a preempted run resumes from here
+                state.update({
+                    'iteration': iteration, 'stream_counter': stream_counter,
+                    'ix': ix, 'roi_neighborhood_tol': roi_neighborhood_tol,
+                    'min_length': min_length, 'tiss_class': tiss_class,
+                    'scheduler': scheduler.get_state()})
+                if len(out_streams) > 0:
+                    state['shards'].append(save_tracking_shard(
+                        out_streams, f"{shard_dir}/shard_{iteration:05d}"))
+                prev_density = state.get('density')
+                state['density'] = f"{shard_dir}/density_{iteration:05d}.npy"
+                np.save(state['density'], density)
+                with open(f"{manifest}.tmp", 'w') as f:
+                    json.dump(state, f)
+                f.close()
+                os.replace(f"{manifest}.tmp", manifest)
+                if prev_density is not None and os.path.isfile(prev_density):
+                    os.remove(prev_density)
+            else:
+                # Append streamline generators to prevent exponential growth
+                # in memory consumption
+                all_streams.extend([generate_sl(i) for i in out_streams])
             del out_streams
 
             print(
@@ -502,179 +1156,282 @@ def track_ensemble(
             gc.collect()
             print(Style.RESET_ALL)
 
-        if float(ix) > len(all_combs):
-            break
-
-    if ix >= len(all_combs) and float(stream_counter) < float(target_samples):
+    tracking_failed = ix >= len(all_combs) and \
+        float(stream_counter) < float(target_samples)
+    if tracking_failed is True:
         print(f"Tractography failed. >{len(all_combs)} consecutive sampling "
               f"iterations with <100 streamlines. Are you using a waymask? "
               f"If so, it may be too restrictive.")
-        return ArraySequence()
+        density[:] = 0
     else:
         print("Tracking Complete: ", str(time.time() - start))
 
-    del parallel, all_combs
-    shutil.rmtree(cache_dir, ignore_errors=True)
+    del all_combs
 
-    if stream_counter != 0:
+    # A failed run falls through to the cleanup of the shared buffers and
+    # shards below with an empty tractogram
+    if tracking_failed is True:
+        streamlines = ArraySequence()
+    elif stream_counter != 0:
         print('Generating final ArraySequence...')
-        return ArraySequence([ArraySequence(i) for i in all_streams])
+        if checkpoint_tracking is True:
+            streamlines = merge_tracking_shards(state['shards'])
+        else:
+            streamlines = ArraySequence([ArraySequence(i) for i in
+                                         all_streams])
     else:
         print('No streamlines generated!')
-        return ArraySequence()
+        streamlines = ArraySequence()
 
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    shutil.rmtree(shard_dir, ignore_errors=True)
 
-def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
-                 n_seeds_per_iter, directget, maxcrossing, max_length,
-                 pft_back_tracking_dist, pft_front_tracking_dist,
-                 particle_count, B0_mask, roi_neighborhood_tol,
-                 labels_im_file, waymask, min_length, track_type,
-                 min_separation_angle, sphere, t1w2dwi, gm_in_dwi,
-                 vent_csf_in_dwi, wm_in_dwi, tiss_class, cache_dir):
+    if return_density is True:
+        return streamlines, density
+    return streamlines
 
-    import gc
+
+class SeedBudgetScheduler(object):
+    """
+    Class for allocating the seeds of each ensemble tractography iteration
+    across (step, curvature) combinations, in proportion to the streamlines
+    each combination has yielded per second of tracking.
+    """
+
+    def __init__(self, n_combinations, n_seeds_per_iter, min_share=0.25):
+        self.n_combinations = n_combinations
+        self.n_seeds_per_iter = int(n_seeds_per_iter)
+        self.total_seeds = self.n_seeds_per_iter * n_combinations
+        # Every combination keeps a minimal share of seeds so that the
+        # ensemble still samples all of them
+        self.min_seeds = max(int(np.ceil(min_share * n_seeds_per_iter)), 1)
+        self.seeds = np.zeros(n_combinations)
+        self.accepted = np.zeros(n_combinations)
+        self.seconds = np.zeros(n_combinations)
+
+    def update(self, seeds, accepted, seconds):
+        """
+        Record the seeds, accepted streamlines and tracking time of each
+        combination on the last iteration.
+        """
+        self.seeds += np.asarray(seeds, dtype=np.float64)
+        self.accepted += np.asarray(accepted, dtype=np.float64)
+        self.seconds += np.asarray(seconds, dtype=np.float64)
+
+    def yields(self):
+        """
+        Return the accepted streamlines per seed and per second of each
+        combination.
+        """
+        return self.accepted / np.maximum(self.seeds, 1), \
+            self.accepted / np.maximum(self.seconds, 1e-6)
+
+    def allocate(self):
+        """
+        Return the number of seeds of each combination on the next
+        iteration, keeping the total number of seeds per iteration fixed.
+        """
+        if np.sum(self.seconds) == 0:
+            return [self.n_seeds_per_iter] * self.n_combinations
+
+        # Add one pseudo-streamline so that unproductive combinations keep a
+        # non-zero rate
+        rates = (self.accepted + 1) / np.maximum(self.seconds, 1e-6)
+        free_seeds = self.total_seeds - self.min_seeds * self.n_combinations
+        shares = free_seeds * rates / rates.sum()
+        alloc = np.floor(shares).astype(int)
+        remainder = free_seeds - alloc.sum()
+        alloc[np.argsort(alloc - shares)[:remainder]] += 1
+
+        return (alloc + self.min_seeds).tolist()
+
+    def get_state(self):
+        """
+        Return the recorded yields as a JSON-serializable dictionary.
+        """
+        return {'seeds': self.seeds.tolist(),
+                'accepted': self.accepted.tolist(),
+                'seconds': self.seconds.tolist()}
+
+    def set_state(self, state):
+        """
+        Restore yields recorded with `get_state`.
+        """
+        self.seeds = np.asarray(state['seeds'], dtype=np.float64)
+        self.accepted = np.asarray(state['accepted'], dtype=np.float64)
+        self.seconds = np.asarray(state['seconds'], dtype=np.float64)
+
+
+def run_tracking_timed(*args, **kwargs):
+    """
+    Run `run_tracking` and return its streamlines along with the time spent
+    tracking them, in seconds.
+    """
+    import time
+    from pynets.dmri.track import run_tracking
+
+    start = time.time()
+    streamlines = run_tracking(*args, **kwargs)
+
+    return streamlines, time.time() - start
+
+
+def get_batch_seed(tracking_seed, step_curv_combinations, iteration):
+    """
+    Derive the random seed of the tracking batch of a given (step, curvature)
+    combination and iteration from a base seed, so that every batch draws a
+    reproducible random sample of the seeding mask. Batches are seeded
+    independently rather than partitioning the mask, so their seed points
+    may overlap.
+
+    Parameters
+    ----------
+    tracking_seed : int
+        Base random seed of the ensemble. If None, batches are not seeded.
+    step_curv_combinations : tuple
+        Step-size and curvature threshold of the ensemble combination.
+    iteration : int
+        Ensemble tractography iteration.
+
+    Returns
+    -------
+    batch_seed : int
+        Random seed in [0, 2**32).
+
+    """
+    import zlib
+
+    if tracking_seed is None:
+        return None
+
+    return zlib.crc32(f"{tracking_seed}_{step_curv_combinations[0]}_"
+                      f"{step_curv_combinations[1]}_{iteration}".encode())
+
+
+def save_tracking_shard(streamlines, shard_path):
+    """
+    Atomically save a batch of streamlines as an uncompressed `.npz` shard of
+    their flattened points and lengths.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        DiPy list/array-like object of streamline points from tractography.
+    shard_path : str
+        File path to the shard, without extension.
+
+    Returns
+    -------
+    shard_path : str
+        File path to the saved `.npz` shard.
+
+    """
     import os
-    import h5py
-    from dipy.tracking import utils
-    from dipy.tracking.streamline import select_by_rois
-    from dipy.tracking.local_tracking import LocalTracking, \
-        ParticleFilteringTracking
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    streamlines = ArraySequence(streamlines).copy()
+    np.savez(f"{shard_path}.tmp.npz", data=streamlines.get_data(),
+             lengths=streamlines._lengths)
+    os.replace(f"{shard_path}.tmp.npz", f"{shard_path}.npz")
+
+    return f"{shard_path}.npz"
+
+
+def merge_tracking_shards(shard_paths):
+    """
+    Concatenate tractography shards into a single ArraySequence, allocating
+    its point buffer once and filling it one shard at a time.
+
+    Parameters
+    ----------
+    shard_paths : list
+        List of file paths to `.npz` shards saved by `save_tracking_shard`.
+
+    Returns
+    -------
+    streamlines : ArraySequence
+        DiPy list/array-like object of streamline points from tractography.
+
+    """
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    lengths = []
+    for shard_path in shard_paths:
+        with np.load(shard_path) as shard:
+            lengths.append(shard['lengths'])
+    lengths = np.concatenate(lengths) if len(lengths) > 0 else \
+        np.zeros(0, dtype=np.intp)
+
+    streamlines = ArraySequence()
+    streamlines._data = np.empty((int(lengths.sum()), 3), dtype=np.float32)
+    streamlines._lengths = lengths.astype(np.intp)
+    streamlines._offsets = (np.cumsum(lengths) - lengths).astype(np.intp)
+
+    start = 0
+    for shard_path in shard_paths:
+        with np.load(shard_path) as shard:
+            data = shard['data']
+        streamlines._data[start:start + len(data)] = data
+        start += len(data)
+        del data
+
+    return streamlines
+
+
+def get_tracker(step_curv_combinations, tracking_inputs, directget,
+                min_separation_angle, sphere):
+    """
+    Fetch the direction getter and tissue classifier of a (step, curvature)
+    combination, instantiating them only the first time a worker process
+    tracks that combination.
+
+    Parameters
+    ----------
+    step_curv_combinations : tuple
+        Step-size and curvature threshold of the ensemble combination.
+    tracking_inputs : dict
+        Dictionary of memory-mapped tracking inputs returned by
+        `share_tracking_inputs`.
+    directget : str
+        The statistical approach to tracking. Options are: det (deterministic),
+        closest (clos), and prob (probabilistic).
+    min_separation_angle : float
+        The minimum angle between directions [0, 90].
+    sphere : obj
+        DiPy object for modeling diffusion directions on a sphere.
+
+    Returns
+    -------
+    dg : obj
+        DiPy direction getter.
+    tiss_classifier : obj
+        Tissue classifier object.
+
+    """
     from dipy.direction import (
         ProbabilisticDirectionGetter,
         ClosestPeakDirectionGetter,
         DeterministicMaximumDirectionGetter
     )
-    from pynets.dmri.track import prep_tissues
-    from nibabel.streamlines.array_sequence import ArraySequence
-    from nipype.utils.filemanip import copyfile, fname_presuffix
+    from pynets.dmri.track import tiss_classifier_from_maps
 
-    B0_mask_tmp_path = fname_presuffix(
-        B0_mask, suffix=f"_{step_curv_combinations}",
-        newpath=cache_dir
-    )
-    copyfile(
-        B0_mask,
-        B0_mask_tmp_path,
-        copy=True,
-        use_hardlink=False)
-
-    labels_im_file_tmp_path = fname_presuffix(
-        labels_im_file, suffix=f"_{step_curv_combinations}",
-        newpath=cache_dir
-    )
-    copyfile(
-        labels_im_file,
-        labels_im_file_tmp_path,
-        copy=True,
-        use_hardlink=False)
-
-    atlas_data_wm_gm_int_tmp_path = fname_presuffix(
-        atlas_data_wm_gm_int, suffix=f"_{step_curv_combinations}",
-        newpath=cache_dir
-    )
-    copyfile(
-        atlas_data_wm_gm_int,
-        atlas_data_wm_gm_int_tmp_path,
-        copy=True,
-        use_hardlink=False)
-
-    t1w2dwi_tmp_path = fname_presuffix(
-        t1w2dwi, suffix=f"_{step_curv_combinations}",
-        newpath=cache_dir
-    )
-    copyfile(
-        t1w2dwi,
-        t1w2dwi_tmp_path,
-        copy=True,
-        use_hardlink=False)
-
-    gm_in_dwi_tmp_path = fname_presuffix(
-        gm_in_dwi, suffix=f"_{step_curv_combinations}",
-        newpath=cache_dir
-    )
-    copyfile(
-        gm_in_dwi,
-        gm_in_dwi_tmp_path,
-        copy=True,
-        use_hardlink=False)
-
-    vent_csf_in_dwi_tmp_path = fname_presuffix(
-        vent_csf_in_dwi, suffix=f"_{step_curv_combinations}",
-        newpath=cache_dir
-    )
-    copyfile(
-        vent_csf_in_dwi,
-        vent_csf_in_dwi_tmp_path,
-        copy=True,
-        use_hardlink=False)
-
-    wm_in_dwi_tmp_path = fname_presuffix(
-        wm_in_dwi, suffix=f"_{step_curv_combinations}",
-        newpath=cache_dir
-    )
-    copyfile(
-        wm_in_dwi,
-        wm_in_dwi_tmp_path,
-        copy=True,
-        use_hardlink=False)
-
-    recon_path_tmp_path = fname_presuffix(
-        recon_path, suffix=f"_{step_curv_combinations}",
-        newpath=cache_dir
-    )
-    copyfile(
-        recon_path,
-        recon_path_tmp_path,
-        copy=True,
-        use_hardlink=False)
-
-    if waymask is not None:
-        waymask_tmp_path = fname_presuffix(
-            waymask, suffix=f"_{step_curv_combinations}",
-            newpath=cache_dir
-        )
-        copyfile(
-            waymask,
-            waymask_tmp_path,
-            copy=True,
-            use_hardlink=False)
-    else:
-        waymask_tmp_path = None
-
-    tiss_classifier = prep_tissues(
-        t1w2dwi_tmp_path,
-        gm_in_dwi_tmp_path,
-        vent_csf_in_dwi_tmp_path,
-        wm_in_dwi_tmp_path,
-        tiss_class,
-        B0_mask_tmp_path)
-
-    B0_mask_data = np.asarray(nib.load(B0_mask_tmp_path).dataobj
-                              ).astype("bool")
-    atlas_img = nib.load(labels_im_file_tmp_path)
-    atlas_data = np.array(atlas_img.dataobj).astype("uint16")
-    atlas_img.uncache()
-    atlas_data_wm_gm_int_data = np.asarray(
-        nib.load(atlas_data_wm_gm_int_tmp_path).dataobj
-    ).astype("bool").astype("int16")
-
-    # Build mask vector from atlas for later roi filtering
-    parcels = []
-    i = 0
-    intensities = [i for i in np.unique(atlas_data) if i != 0]
-    for roi_val in intensities:
-        parcels.append(atlas_data == roi_val)
-        i += 1
-
-    del atlas_data
+    # Trackers of a previous ensemble run are never reused
+    if _tracker_cache.get('run_id') != tracking_inputs['run_id']:
+        _tracker_cache.clear()
+        _tracker_cache['run_id'] = tracking_inputs['run_id']
+        _tracker_cache['recon'] = np.load(tracking_inputs['recon'],
+                                          mmap_mode='c')
 
-    parcel_vec = list(np.ones(len(parcels)).astype("bool"))
+    key = (step_curv_combinations, tracking_inputs['tiss_class'], directget)
+    if key in _tracker_cache:
+        return _tracker_cache[key]
 
-    with h5py.File(recon_path_tmp_path, 'r+') as hf:
-        mod_fit = hf['reconstruction'][:].astype('float32')
-    hf.close()
+    tiss_classifier = tiss_classifier_from_maps(
+        tracking_inputs['tiss_class'],
+        [np.load(i, mmap_mode='r') for i in tracking_inputs['tissue_maps']],
+        tracking_inputs['voxel_size'])
 
-    print("%s%s" % ("Curvature: ", step_curv_combinations[1]))
+    mod_fit = _tracker_cache['recon']
 
     # Instantiate DirectionGetter
     if directget == "prob" or directget == "probabilistic":
@@ -692,7 +1449,6 @@ def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
             min_separation_angle=min_separation_angle,
         )
     elif directget == "det" or directget == "deterministic":
-        maxcrossing = 1
         dg = DeterministicMaximumDirectionGetter.from_shcoeff(
             mod_fit,
             max_angle=float(step_curv_combinations[1]),
@@ -708,6 +1464,70 @@ def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
             import sys
             sys.exit(0)
 
+    _tracker_cache[key] = (dg, tiss_classifier)
+
+    return _tracker_cache[key]
+
+
+def get_roi_tree(tracking_inputs, roi='atlas'):
+    """
+    Fetch a KD-tree of the non-zero voxels of a shared volume, building it
+    only the first time a worker process needs it.
+
+    Parameters
+    ----------
+    tracking_inputs : dict
+        Dictionary of memory-mapped tracking inputs returned by
+        `share_tracking_inputs`.
+    roi : str
+        Key of the volume in `tracking_inputs` (e.g. 'atlas' or 'waymask').
+
+    Returns
+    -------
+    roi_tree : cKDTree
+        KD-tree of the non-zero voxel centers in voxel coordinates.
+
+    """
+    from scipy.spatial import cKDTree
+
+    key = ('roi_tree', roi, tracking_inputs['run_id'])
+    if key not in _tracker_cache:
+        _tracker_cache[key] = cKDTree(np.argwhere(
+            np.load(tracking_inputs[roi], mmap_mode='r') > 0))
+
+    return _tracker_cache[key]
+
+
+def run_tracking(step_curv_combinations, tracking_inputs, n_seeds_per_iter,
+                 directget, maxcrossing, max_length, pft_back_tracking_dist,
+                 pft_front_tracking_dist, particle_count,
+                 roi_neighborhood_tol, min_length, track_type,
+                 min_separation_angle, sphere, random_seed=None):
+
+    import gc
+    from dipy.tracking import utils
+    from dipy.tracking.local_tracking import LocalTracking, \
+        ParticleFilteringTracking
+    from pynets.dmri.track import get_tracker, get_roi_tree
+    from pynets.dmri.dmri_utils import streamlines_near_rois, \
+        compact_streamlines
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    # Map the inputs shared by track_ensemble instead of copying and
+    # decompressing them once per combination
+    B0_mask_data = np.load(tracking_inputs['B0_mask'], mmap_mode='r')
+    atlas_data_wm_gm_int_data = np.load(tracking_inputs['seeding_mask'],
+                                        mmap_mode='r')
+
+    print("%s%s" % ("Curvature: ", step_curv_combinations[1]))
+
+    # Fetch the DirectionGetter and tissue classifier of this combination
+    [dg, tiss_classifier] = get_tracker(step_curv_combinations,
+                                        tracking_inputs, directget,
+                                        min_separation_angle, sphere)
+    if directget == "det" or directget == "deterministic":
+        maxcrossing = 1
+
     print("%s%s" % ("Step: ", step_curv_combinations[0]))
 
     # Perform wm-gm interface seeding, using n_seeds at a time
@@ -716,6 +1536,7 @@ def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
         seeds_count=n_seeds_per_iter,
         seed_count_per_voxel=False,
         affine=np.eye(4),
+        random_seed=random_seed,
     )
     if len(seeds) == 0:
         print(UserWarning(
@@ -724,6 +1545,13 @@ def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
         ))
         return None
 
+    # The direction getter and tissue classifier only cover the bounding box
+    # of the brain mask, so its corner maps their voxels to those of the
+    # full volume, in which seeds and streamlines are expressed
+    bbox_affine = np.eye(4)
+    if 'bbox' in tracking_inputs:
+        bbox_affine[:3, 3] = tracking_inputs['bbox'][::2]
+
     # print(seeds)
 
     # Perform tracking
@@ -732,19 +1560,20 @@ def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
             dg,
             tiss_classifier,
             seeds,
-            np.eye(4),
+            bbox_affine,
             max_cross=int(maxcrossing),
             maxlen=int(max_length),
             step_size=float(step_curv_combinations[0]),
             fixedstep=False,
             return_all=True,
+            random_seed=random_seed,
         )
     elif track_type == "particle":
         streamline_generator = ParticleFilteringTracking(
             dg,
             tiss_classifier,
             seeds,
-            np.eye(4),
+            bbox_affine,
             max_cross=int(maxcrossing),
             step_size=float(step_curv_combinations[0]),
             maxlen=int(max_length),
@@ -752,6 +1581,7 @@ def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
             pft_front_tracking_dist=pft_front_tracking_dist,
             particle_count=particle_count,
             return_all=True,
+            random_seed=random_seed,
         )
     else:
         try:
@@ -777,18 +1607,17 @@ def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
     # characteristics
 
     try:
-        roi_proximal_streamlines = \
-            nib.streamlines.array_sequence.ArraySequence(
-                select_by_rois(
-                    roi_proximal_streamlines,
-                    affine=np.eye(4),
-                    rois=parcels,
-                    include=parcel_vec,
-                    mode="%s" % ("any" if waymask is not None else
-                                 "both_end"),
-                    tol=roi_neighborhood_tol,
-                )
+        roi_proximal_streamlines = ArraySequence(roi_proximal_streamlines)
+        roi_proximal_streamlines = roi_proximal_streamlines[
+            streamlines_near_rois(
+                roi_proximal_streamlines,
+                np.load(tracking_inputs['roi_distance'], mmap_mode='r'),
+                get_roi_tree(tracking_inputs),
+                roi_neighborhood_tol,
+                mode="%s" % ("any" if tracking_inputs['waymask'] is
+                             not None else "both_end"),
             )
+        ]
         print("%s%s" % ("Filtering by: \nNode intersection: ",
                         len(roi_proximal_streamlines)))
     except BaseException:
@@ -796,30 +1625,25 @@ def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
               'Check registrations.')
         return None
 
+    # The remaining filters select views of the tracked ArraySequence
     try:
-        roi_proximal_streamlines = nib.streamlines. \
-            array_sequence.ArraySequence(
-            [
-                s for s in roi_proximal_streamlines
-                if len(s) >= float(min_length)
-            ]
-        )
+        roi_proximal_streamlines = roi_proximal_streamlines[
+            roi_proximal_streamlines._lengths >= float(min_length)]
         print(f"Minimum fiber length >{min_length}mm: "
               f"{len(roi_proximal_streamlines)}")
     except BaseException:
         print('No streamlines remaining after minimal length criterion.')
         return None
 
-    if waymask is not None and os.path.isfile(waymask_tmp_path):
-        waymask_data = np.asarray(nib.load(waymask_tmp_path).dataobj
-                                  ).astype("bool")
+    if tracking_inputs['waymask'] is not None:
         try:
             roi_proximal_streamlines = roi_proximal_streamlines[
-                utils.near_roi(
+                streamlines_near_rois(
                     roi_proximal_streamlines,
-                    np.eye(4),
-                    waymask_data,
-                    tol=0,
+                    np.load(tracking_inputs['waymask_distance'],
+                            mmap_mode='r'),
+                    get_roi_tree(tracking_inputs, roi='waymask'),
+                    0,
                     mode="all",
                 )
             ]
@@ -829,14 +1653,11 @@ def run_tracking(step_curv_combinations, atlas_data_wm_gm_int, recon_path,
             print('No streamlines remaining in waymask\'s vacinity.')
             return None
 
-    out_streams = [s.astype("float32")
-                   for s in roi_proximal_streamlines]
+    out_streams = compact_streamlines(roi_proximal_streamlines,
+                                      dtype=np.float32)
 
     del dg, seeds, roi_proximal_streamlines, streamline_generator, \
-        atlas_data_wm_gm_int_data, mod_fit, B0_mask_data
+        atlas_data_wm_gm_int_data, B0_mask_data
     gc.collect()
 
-    try:
-        return ArraySequence(out_streams)
-    except BaseException:
-        return None
+    return out_streams
@@ -68,7 +68,8 @@ def indx_3dto1d(idx, sz):
     return idx1
 
 
-def ncut(W, nbEigenValues):
+def ncut(W, nbEigenValues, solver="auto", max_iter=None, tol=None,
+         precondition=False, cache_dir=None, return_report=False):
     """
     This function performs the first step of normalized cut spectral clustering.
     The normalized LaPlacian is calculated on the similarity matrix W, and top
@@ -86,6 +87,29 @@ def ncut(W, nbEigenValues):
     nbEigenValues : int
         Number of eigenvectors that should be calculated, this determines the
         maximum number of clusters (K) that can be derived from the result.
+    solver : str
+        Sparse eigensolver. 'arpack' (implicitly restarted Lanczos) or
+        'lobpcg' (locally optimal block preconditioned conjugate gradient,
+        which can be warm started and preconditioned). Default is 'auto',
+        which uses 'lobpcg' if cached eigenvectors or preconditioning are
+        available, and 'arpack' otherwise. If 'arpack' fails to converge,
+        'lobpcg' resumes from its partial result.
+    max_iter : int
+        Iteration cap of the eigensolver. Default is 100 for 'arpack' and 500
+        for 'lobpcg'.
+    tol : float
+        Convergence tolerance of the eigensolver. Default is 1e-6 for
+        'arpack' and the scipy default for 'lobpcg'.
+    precondition : bool
+        Precondition 'lobpcg' with algebraic multigrid on the normalized
+        LaPlacian. Requires pyamg. Default is False.
+    cache_dir : str
+        Directory in which eigenvectors are cached by the content of W and
+        reused as warm starts, e.g. when the same mask is reparcellated at
+        several K. Default is None, which disables caching.
+    return_report : bool
+        Also return a dictionary reporting the convergence of the
+        eigensolver. Default is False.
 
     Returns
     -------
@@ -93,6 +117,10 @@ def ncut(W, nbEigenValues):
         Eigenvalues from the eigen decomposition of the LaPlacian of W.
     eigen_vec :  array
         Eigenvectors from the eigen decomposition of the LaPlacian of W.
+    report : dict
+        Solver, number of iterations, largest residual norm, and whether the
+        eigensolver converged before the iteration cap. Only returned if
+        return_report is True.
 
     References
     ----------
@@ -106,20 +134,41 @@ def ncut(W, nbEigenValues):
       Proceedings Ninth
       IEEE International Conference on Computer Vision, (1), 313-319 vol.1.
       Ieee. doi: 10.1109/ICCV.2003.1238361
+    .. [4] Knyazev, A. V. (2001). Toward the optimal preconditioned
+      eigensolver: Locally optimal block preconditioned conjugate gradient
+      method. SIAM Journal on Scientific Computing, 23(2), 517-541.
+      doi: 10.1137/S1064827500366124
 
     """
-    from scipy.sparse.linalg import eigsh
-    from scipy.sparse import spdiags
+    import os
+    import hashlib
+    from scipy.sparse.linalg import eigsh, lobpcg, ArpackNoConvergence
+    from scipy.sparse import spdiags, identity
     from numpy.linalg import norm
 
     # Parameters
     offset = 0.5
-    maxiterations = 100
-    eigsErrorTolerence = 1e-6
     eps = 2.2204e-16
 
     m = np.shape(W)[1]
 
+    # Look up eigenvectors of the same W to warm start from
+    warm_start = None
+    if cache_dir is not None:
+        W = W.tocsc()
+        digest = hashlib.sha1()
+        for arr in (np.array(W.shape), W.indptr, W.indices, W.data):
+            digest.update(np.ascontiguousarray(arr).tobytes())
+        cache_path = f"{cache_dir}/ncut_{digest.hexdigest()}.npy"
+        if os.path.isfile(cache_path):
+            warm_start = np.load(cache_path)
+            print(f"Warm starting from {warm_start.shape[1]} cached "
+                  f"eigenvectors...")
+
+    if solver == "auto":
+        solver = "lobpcg" if (warm_start is not None or
+                              precondition is True) else "arpack"
+
     d = abs(W).sum(0)
     dr = 0.5 * (d - W.sum(0))
     d = d + offset * 2
@@ -131,15 +180,76 @@ def ncut(W, nbEigenValues):
     P = Dinvsqrt * (W * Dinvsqrt)
 
     # Perform the eigen decomposition
-    eigen_val, eigen_vec = eigsh(
-        P, nbEigenValues, maxiter=maxiterations, tol=eigsErrorTolerence,
-        which="LA")
+    report = {"solver": solver, "iterations": None, "converged": True}
+    if solver == "arpack":
+        v0 = warm_start[:, 0] if warm_start is not None else None
+        try:
+            eigen_val, eigen_vec = eigsh(
+                P, nbEigenValues, maxiter=100 if max_iter is None else
+                max_iter, tol=1e-6 if tol is None else tol, which="LA", v0=v0)
+        except ArpackNoConvergence as e:
+            print(f"ARPACK converged on {len(e.eigenvalues)} of "
+                  f"{nbEigenValues} eigenvectors. Resuming with LOBPCG...")
+            solver = "lobpcg"
+            report["solver"] = "arpack+lobpcg"
+            if len(e.eigenvalues) > 0:
+                warm_start = e.eigenvectors
+            tol = None
+
+    if solver == "lobpcg":
+        # Initial block of the warm start, completed with random vectors
+        rng = np.random.RandomState(42)
+        X = rng.rand(m, nbEigenValues) - 0.5
+        if warm_start is not None and warm_start.shape[0] == m:
+            n_warm = min(warm_start.shape[1], nbEigenValues)
+            X[:, :n_warm] = warm_start[:, :n_warm]
+
+        # Largest eigenvectors of P are the smallest of the normalized
+        # LaPlacian, on which the multigrid hierarchy is built
+        M = None
+        if precondition is True:
+            try:
+                from pyamg import smoothed_aggregation_solver
+                L = (identity(m, format="csr") - P).tocsr()
+                M = smoothed_aggregation_solver(
+                    L + 1e-5 * identity(m, format="csr")).aspreconditioner()
+            except ImportError:
+                print("Cannot precondition LOBPCG. pyamg not installed!")
+
+        if M is None:
+            eigen_val, eigen_vec, res_hist = lobpcg(
+                P, X, tol=tol, maxiter=500 if max_iter is None else max_iter,
+                largest=True, retResidualNormsHistory=True)
+        else:
+            eigen_val, eigen_vec, res_hist = lobpcg(
+                identity(m, format="csr") - P, X, M=M, tol=tol,
+                maxiter=500 if max_iter is None else max_iter,
+                largest=False, retResidualNormsHistory=True)
+            eigen_val = 1 - eigen_val
+        report["iterations"] = len(res_hist)
+        if tol is None:
+            tol = np.sqrt(1e-15) * m
+        report["converged"] = bool(np.max(res_hist[-1]) <= tol)
+
+    report["max_residual"] = float(np.max(norm(
+        P * eigen_vec - eigen_vec * eigen_val, axis=0)))
+    print(f"Normalized cut eigensolver ({report['solver']}): "
+          f"{nbEigenValues} eigenvectors, {report['iterations']} iterations, "
+          f"max residual {report['max_residual']:.2e}"
+          f"{'' if report['converged'] else ' (iteration cap reached)'}")
 
     # Sort the eigen_vals so that the first is the largest
     i = np.argsort(-eigen_val)
     eigen_val = eigen_val[i]
     eigen_vec = eigen_vec[:, i]
 
+    if cache_dir is not None and report["converged"] is True and (
+            warm_start is None or warm_start.shape[1] < nbEigenValues):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_dir}/.{os.getpid()}_{os.path.basename(cache_path)}"
+        np.save(tmp_path, eigen_vec.astype(np.float32))
+        os.replace(tmp_path, cache_path)
+
     # Normalize the returned eigenvectors
     eigen_vec = Dinvsqrt * np.array(eigen_vec)
     norm_ones = norm(np.ones((m, 1)))
@@ -148,7 +258,10 @@ def ncut(W, nbEigenValues):
         if eigen_vec[0, i] != 0:
             eigen_vec[:, i] = -1 * eigen_vec[:, i] * np.sign(eigen_vec[0, i])
 
-    return eigen_val, eigen_vec
+    if return_report is True:
+        return eigen_val, eigen_vec, report
+    else:
+        return eigen_val, eigen_vec
 
 
 def discretisation(eigen_vec):
@@ -199,10 +312,8 @@ def discretisation(eigen_vec):
       (1), 313-319 vol.1. Ieee. doi: 10.1109/ICCV.2003.1238361
 
     """
-    import scipy as sp
     from scipy.sparse import csc_matrix
     from scipy.linalg import LinAlgError, svd
-    from scipy import divide
 
     eps = 2.2204e-16
 
@@ -214,7 +325,7 @@ def discretisation(eigen_vec):
             np.multiply(
                 eigen_vec, eigen_vec).sum(1)))
     out_vec = np.reshape(vm, eigen_vec.shape)
-    eigen_vec = divide(eigen_vec, out_vec)
+    eigen_vec = np.divide(eigen_vec, out_vec)
 
     svd_restarts = 0
     exitLoop = 0
@@ -226,7 +337,7 @@ def discretisation(eigen_vec):
         c = np.zeros((n, 1))
         R = np.matrix(np.zeros((k, k)))
         R[:, 0] = np.reshape(
-            eigen_vec[int(sp.rand(1) * (n - 1)), :].transpose(), (k, 1)
+            eigen_vec[int(np.random.rand() * (n - 1)), :].transpose(), (k, 1)
         )
 
         for j in range(1, k):
@@ -291,7 +402,7 @@ def discretisation(eigen_vec):
         return eigenvec_discrete
 
 
-def parcellate_ncut(W, k, mask_img):
+def parcellate_ncut(W, k, mask_img, cache_dir=None):
     """
     Converts a connectivity matrix into a nifti file where each voxel
     intensity corresponds to the number of the cluster to which it belongs.
@@ -308,6 +419,9 @@ def parcellate_ncut(W, k, mask_img):
     mask_img : Nifti1Image
         3D NIFTI file containing a mask, which restricts the voxels used in
         the analysis.
+    cache_dir : str
+        Directory in which the eigenvectors of W are cached and reused as
+        warm starts when W is reparcellated at another k (see ncut).
 
     References
     ----------
@@ -320,7 +434,7 @@ def parcellate_ncut(W, k, mask_img):
     # We only have to calculate the eigendecomposition of the LaPlacian once,
     # for the largest number of clusters provided. This provides a significant
     # speedup, without any difference to the results.
-    [_, eigenvec] = ncut(W, k)
+    [_, eigenvec] = ncut(W, k, cache_dir=cache_dir)
 
     # Calculate each desired clustering result
     eigenvec_discrete = discretisation(eigenvec[:, :k])
@@ -346,11 +460,77 @@ def parcellate_ncut(W, k, mask_img):
     del a, b, W
 
     return nib.Nifti1Image(
-        imdat.astype("uint16"), mask_img.get_affine(), mask_img.get_header()
+        imdat.astype("uint16"), mask_img.affine, mask_img.header
     )
 
 
-def make_local_connectivity_scorr(func_img, clust_mask_img, thresh):
+def local_neighbor_pairs(mask):
+    """
+    Enumerate every pair of in-mask voxels that share a face, edge or corner
+    (the 27-voxel 3D neighborhood, including the voxel itself).
+
+    Parameters
+    ----------
+    mask : array
+        3D boolean array of the voxels used in the analysis.
+
+    Returns
+    -------
+    seeds : array
+        Index of the "seed" voxel of each pair, in the order of
+        np.nonzero(mask) (i.e. C-order), sorted in ascending order.
+    neighbors : array
+        Index of the neighboring voxel of each pair, in the same order.
+    """
+    from itertools import product
+
+    mask = np.asarray(mask).astype("bool")
+    m = int(np.sum(mask))
+
+    # Lookup volume of mask indices, padded by one voxel so that neighbors
+    # falling outside of the lattice resolve to -1 instead of wrapping around
+    lut = np.full(np.array(mask.shape) + 2, -1, dtype=np.int64)
+    lut[1:-1, 1:-1, 1:-1][mask] = np.arange(m)
+    x, y, z = np.nonzero(mask)
+
+    seeds = []
+    neighbors = []
+    for dx, dy, dz in product((-1, 0, 1), repeat=3):
+        ndx = lut[x + 1 + dx, y + 1 + dy, z + 1 + dz]
+        inmask = ndx >= 0
+        seeds.append(np.nonzero(inmask)[0])
+        neighbors.append(ndx[inmask])
+
+    seeds = np.concatenate(seeds)
+    neighbors = np.concatenate(neighbors)
+    order = np.lexsort((neighbors, seeds))
+
+    return seeds[order], neighbors[order]
+
+
+def zscore_rows(X):
+    """
+    Z-score each row of a 2D array, setting rows without variance to zero.
+
+    Parameters
+    ----------
+    X : array
+        A 2D numpy array (e.g. num_voxels x num_timepoints).
+
+    Returns
+    -------
+    X : array
+        The z-scored array, such that the mean of the elementwise product of
+        two rows is their Pearson correlation coefficient.
+    """
+    X = X - np.mean(X, axis=1, keepdims=True)
+    X_s = np.std(X, axis=1, keepdims=True)
+    X_s[X_s == 0] = np.inf
+    return X / X_s
+
+
+def make_local_connectivity_scorr(func_img, clust_mask_img, thresh,
+                                  block_size=None, rank=None, n_jobs=1):
     """
     Constructs a spatially constrained connectivity matrix from a fMRI dataset.
     The weights w_ij of the connectivity matrix W correspond to the
@@ -369,6 +549,21 @@ def make_local_connectivity_scorr(func_img, clust_mask_img, thresh):
     thresh : str
         Threshold value, correlation coefficients lower than this value
         will be removed from the matrix (set to zero).
+    block_size : int
+        Number of seed voxels processed per block. Memory use per block
+        grows with block_size x the number of voxels in the mask, or with
+        block_size x rank if `rank` is specified. Default is 64, or 4096 if
+        `rank` is specified.
+    rank : int
+        If specified, the z-scored time series are projected onto the
+        leading `rank` components of their truncated SVD and the spatial
+        correlation between FC maps is computed in that reduced space,
+        without ever forming the FC maps. Results are exact whenever `rank`
+        is at least the number of timepoints. Default is None, which
+        computes the FC maps explicitly.
+    n_jobs : int
+        Number of threads across which blocks of seed voxels are processed.
+        Default is 1.
 
     Returns
     -------
@@ -385,155 +580,92 @@ def make_local_connectivity_scorr(func_img, clust_mask_img, thresh):
 
     """
     from scipy.sparse import csc_matrix
-    from scipy import prod
-    from itertools import product
-    from pynets.fmri.clustools import indx_1dto3d, indx_3dto1d
-
-    neighbors = np.array(
-        sorted(
-            sorted(
-                sorted(
-                    [list(x) for x in list(set(product({-1, 0, 1},
-                                                       repeat=3)))],
-                    key=lambda k: (k[0]),
-                ),
-                key=lambda k: (k[1]),
-            ),
-            key=lambda k: (k[2]),
-        )
-    )
-
-    # Read in the mask
-    msz = clust_mask_img.shape
-
-    # Convert the 3D mask array into a 1D vector
-    mskdat = np.reshape(
-        np.asarray(
-            clust_mask_img.dataobj).astype("bool"),
-        prod(msz))
-
-    # Determine the 1D coordinates of the non-zero
-    # elements of the mask
-    iv = np.nonzero(mskdat)[0]
-    sz = func_img.shape
-
-    # Reshape fmri data to a num_voxels x num_timepoints array
-    func_data = func_img.get_fdata(dtype=np.float32)
-    imdat = np.reshape(func_data, (prod(sz[:3]), sz[3]))
-    del func_data
-
-    # Mask the datset to only the in-mask voxels
-    imdat = imdat[iv, :]
-    imdat_sz = imdat.shape
-
-    # Z-score fmri time courses, this makes calculation of the
-    # correlation coefficient a simple matrix product
-    imdat_s = np.tile(np.std(imdat, 1), (imdat_sz[1], 1)).T
-
-    # Replace 0 with really large number to avoid div by zero
-    imdat_s[imdat_s == 0] = 1000000
-    imdat_m = np.tile(np.mean(imdat, 1), (imdat_sz[1], 1)).T
-    imdat = (imdat - imdat_m) / imdat_s
-
-    # Set values with no variance to zero
-    imdat[imdat_s == 0] = 0
-    imdat[np.isnan(imdat)] = 0
-
-    # Remove voxels with zero variance, do this here
-    # so that the mapping will be consistent across
-    # subjects
-    vndx = np.nonzero(np.var(imdat, 1) != 0)[0]
-    iv = iv[vndx]
-    m = len(iv)
-    print(m, " # of non-zero valued or non-zero variance voxels in the mask")
-
-    # Construct a sparse matrix from the mask
-    msk = csc_matrix(
-        (vndx + 1, (iv, np.zeros(m))), shape=(prod(msz), 1), dtype=np.float32
-    )
-
-    sparse_i = []
-    sparse_j = []
-    sparse_w = [[]]
-
-    for i in range(0, m):
-        if i % 1000 == 0:
-            print("voxel #", i)
-
-        # Convert index into 3D and calculate neighbors, then convert resulting
-        # 3D indices into 1D
-        ndx1d = indx_3dto1d(indx_1dto3d(iv[i], sz[:-1]) + neighbors, sz[:-1])
-
-        # Convert 1D indices into masked versions
-        ondx1d = msk[ndx1d].todense()
-
-        # Exclude indices not in the mask
-        ndx1d = ndx1d[np.nonzero(ondx1d)[0]].flatten()
-        ondx1d = np.array(ondx1d[np.nonzero(ondx1d)[0]])
-        ondx1d = ondx1d.flatten() - 1
-
-        # Keep track of the index corresponding to the "seed"
-        nndx = np.nonzero(ndx1d == iv[i])[0]
-
-        # Extract the time courses corresponding to the "seed"
-        # and 3D neighborhood voxels
-        tc = np.array(imdat[ondx1d.astype("int"), :])
-
-        # Ensure that the "seed" has variance, if not just skip it
-        if np.var(tc[nndx, :]) == 0:
-            continue
-
-        # Calculate functional connectivity maps for "seed"
-        # and 3D neighborhood voxels
-        R = np.corrcoef(np.dot(tc, imdat.T) / (sz[3] - 1))
-
-        if np.linalg.matrix_rank(R) == 1:
-            R = np.reshape(R, (1, 1))
-
-        # Set nans to 0
-        R[np.isnan(R)] = 0
-
-        # Set values below thresh to 0
-        R[R < thresh] = 0
-
-        # Calculate the spatial correlation between FC maps
-        if np.linalg.matrix_rank(R) == 0:
-            R = np.reshape(R, (1, 1))
-
-        # Keep track of the indices and the correlation weights
-        # to construct sparse connectivity matrix
-        sparse_i = np.append(sparse_i, ondx1d, 0)
-        sparse_j = np.append(sparse_j, (ondx1d[nndx]) * np.ones(len(ondx1d)))
-        sparse_w = np.append(sparse_w, R[nndx, :], 1)
-
-    # Ensure that the weight vector is the correct shape
-    sparse_w = np.reshape(sparse_w, prod(np.shape(sparse_w)))
-
-    # Concatenate the i, j, and w_ij vectors
-    outlist = sparse_i
-    outlist = np.append(outlist, sparse_j)
-    outlist = np.append(outlist, sparse_w)
-
-    # Calculate the number of non-zero weights in the connectivity matrix
-    n = len(outlist) / 3
-
-    # Reshape the 1D vector read in from infile in to a 3xN array
-    outlist = np.reshape(outlist, (3, int(n)))
-
-    m = max(max(outlist[0, :]), max(outlist[1, :])) + 1
+    from joblib import Parallel, delayed
+    from pynets.fmri.clustools import local_neighbor_pairs, zscore_rows
+
+    mask = np.asarray(clust_mask_img.dataobj).astype("bool")
+
+    # Mask the dataset to a num_voxels x num_timepoints array and z-score the
+    # time courses, which makes the correlation coefficient a matrix product
+    imdat = zscore_rows(func_img.get_fdata(dtype=np.float32)[mask])
+
+    # Voxels with zero variance are kept as zero rows, so that W has a row
+    # for every voxel of the mask, but they are left out of the FC maps
+    m = imdat.shape[0]
+    vndx = np.any(imdat != 0, axis=1)
+    imdat_v = np.ascontiguousarray(imdat[vndx])
+    n_v = imdat_v.shape[0]
+    print(n_v, " # of non-zero valued or non-zero variance voxels in the mask")
+
+    seeds, neighbors = local_neighbor_pairs(mask)
+    sparse_w = np.zeros(len(seeds), dtype=np.float32)
+
+    if rank is None:
+        def block_weights(start, stop):
+            # Calculate the whole brain FC maps of the seeds in the block and
+            # of their 3D neighborhood voxels, once per voxel
+            ndx, inv = np.unique(
+                np.concatenate([seeds[start:stop], neighbors[start:stop]]),
+                return_inverse=True)
+            fc = zscore_rows(np.dot(imdat[ndx], imdat_v.T))
+
+            # Calculate the spatial correlation between FC maps
+            n_pairs = stop - start
+            sparse_w[start:stop] = np.einsum(
+                "ij,ij->i", fc[inv[:n_pairs]], fc[inv[n_pairs:]]) / n_v
+    else:
+        # The FC map of voxel i is imdat @ imdat[i], so once each map is
+        # centered across voxels, the covariance between the FC maps of
+        # voxels i and j is imdat[i] @ (Xc.T @ Xc) @ imdat[j], where Xc is
+        # imdat centered across voxels. With Xc = U S V.T, the spatial
+        # correlation is the cosine between rows of imdat @ V S.
+        imdat_c = imdat_v - np.mean(imdat_v, axis=0)
+        evals, evecs = np.linalg.eigh(
+            np.dot(imdat_c.T.astype("float64"), imdat_c))
+        del imdat_c
+        evals, evecs = evals[::-1][:rank], evecs[:, ::-1][:, :rank]
+        keep = evals > evals[0] * 1e-10
+        print(f"Projecting onto {np.sum(keep)} singular vectors...")
+        proj = np.dot(imdat, (evecs[:, keep] *
+                              np.sqrt(evals[keep])).astype(np.float32))
+        proj_n = np.linalg.norm(proj, axis=1, keepdims=True)
+        proj_n[proj_n == 0] = np.inf
+        proj = proj / proj_n
+        del proj_n
+
+        def block_weights(start, stop):
+            # Calculate the spatial correlation between FC maps in the
+            # reduced space
+            sparse_w[start:stop] = np.sum(
+                np.multiply(proj[seeds[start:stop]],
+                            proj[neighbors[start:stop]]), axis=1)
+
+    # Seeds are sorted, so each block of seeds maps to a contiguous run of
+    # pairs
+    if block_size is None:
+        block_size = 64 if rank is None else 4096
+    bounds = np.searchsorted(seeds, np.arange(0, m + block_size, block_size))
+    Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(block_weights)(start, stop)
+        for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop)
+
+    # Set values below thresh to 0
+    sparse_w[sparse_w < thresh] = 0
+    nzndx = np.nonzero(sparse_w)[0]
 
     W = csc_matrix(
-        (outlist[2, :], (outlist[0, :], outlist[1, :])),
-        shape=(int(m), int(m)),
+        (sparse_w[nzndx], (neighbors[nzndx], seeds[nzndx])),
+        shape=(m, m),
         dtype=np.float32,
     )
 
-    del imdat, msk, mskdat, outlist, m, sparse_i, sparse_j, sparse_w
+    del imdat, imdat_v, mask, seeds, neighbors, sparse_w
 
     return W
 
 
-def make_local_connectivity_tcorr(func_img, clust_mask_img, thresh):
+def make_local_connectivity_tcorr(func_img, clust_mask_img, thresh,
+                                  block_size=2048):
     """
     Constructs a spatially constrained connectivity matrix from a fMRI dataset.
     The weights w_ij of the connectivity matrix W correspond to the
@@ -551,6 +683,9 @@ def make_local_connectivity_tcorr(func_img, clust_mask_img, thresh):
     thresh : str
         Threshold value, correlation coefficients lower than this value
         will be removed from the matrix (set to zero).
+    block_size : int
+        Number of seed voxels whose neighborhood correlations are computed
+        at once.
 
     Returns
     -------
@@ -567,160 +702,383 @@ def make_local_connectivity_tcorr(func_img, clust_mask_img, thresh):
 
     """
     from scipy.sparse import csc_matrix
-    from scipy import prod
-    from itertools import product
-    from pynets.fmri.clustools import indx_1dto3d, indx_3dto1d
-
-    # Index array used to calculate 3D neigbors
-    neighbors = np.array(
-        sorted(
-            sorted(
-                sorted(
-                    [list(x) for x in list(set(product({-1, 0, 1},
-                                                       repeat=3)))],
-                    key=lambda k: (k[0]),
-                ),
-                key=lambda k: (k[1]),
-            ),
-            key=lambda k: (k[2]),
-        )
-    )
-
-    # Read in the mask
-    msz = np.shape(np.asarray(clust_mask_img.dataobj).astype("bool"))
+    from pynets.fmri.clustools import local_neighbor_pairs, zscore_rows
 
-    # Convert the 3D mask array into a 1D vector
-    mskdat = np.reshape(
-        np.asarray(
-            clust_mask_img.dataobj).astype("bool"),
-        prod(msz))
-
-    # Determine the 1D coordinates of the non-zero elements of the mask
-    iv = np.nonzero(mskdat)[0]
-    m = len(iv)
+    mask = np.asarray(clust_mask_img.dataobj).astype("bool")
+    seeds, neighbors = local_neighbor_pairs(mask)
+    m = int(np.sum(mask))
     print(f"\nTotal non-zero voxels in the mask: {m}\n")
-    sz = func_img.shape
 
-    # Reshape fmri data to a num_voxels x num_timepoints array
-    func_data = func_img.get_fdata(dtype=np.float32)
-    imdat = np.reshape(func_data, (prod(sz[:3]), sz[3]))
-    del func_data
+    # Mask the dataset to a num_voxels x num_timepoints array and z-score the
+    # time courses, which makes the correlation coefficient a matrix product.
+    # Voxels without variance are zeroed, so their weights drop out below.
+    imdat = zscore_rows(func_img.get_fdata(dtype=np.float32)[mask])
+    n_tp = imdat.shape[1]
+
+    # Calculate the correlation between each seed and its 3D neighborhood,
+    # one block of seeds at a time
+    sparse_w = np.zeros(len(seeds), dtype=np.float32)
+    bounds = np.searchsorted(seeds, np.arange(0, m + block_size, block_size))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        sparse_w[start:stop] = np.einsum(
+            "ij,ij->i", imdat[seeds[start:stop]],
+            imdat[neighbors[start:stop]]) / n_tp
+
+    # Set values below thresh to 0 and keep only the non-zero weights
+    sparse_w[sparse_w < thresh] = 0
+    nzndx = np.nonzero(sparse_w)[0]
+    print(f"{len(nzndx)} non-zero weights in the connectivity matrix")
 
-    # Construct a sparse matrix from the mask
-    msk = csc_matrix(
-        (list(range(1, m + 1)), (iv, np.zeros(m))),
-        shape=(prod(sz[:-1]), 1),
+    W = csc_matrix(
+        (sparse_w[nzndx], (neighbors[nzndx], seeds[nzndx])),
+        shape=(m, m),
         dtype=np.float32,
     )
-    sparse_i = []
-    sparse_j = []
-    sparse_w = []
-
-    negcount = 0
-
-    # Loop over all of the voxels in the mask
-    print("Voxels:")
-    for i in range(0, m):
-        if i % 1000 == 0:
-            print(str(i))
-        # Calculate the voxels that are in the 3D neighborhood of the center
-        # voxel
-        ndx1d = indx_3dto1d(indx_1dto3d(iv[i], sz[:-1]) + neighbors, sz[:-1])
-
-        # Restrict the neigborhood using the mask
-        ondx1d = msk[ndx1d].todense()
-        ndx1d = ndx1d[np.nonzero(ondx1d)[0]].flatten()
-        ondx1d = np.array(ondx1d[np.nonzero(ondx1d)[0]]).flatten()
-
-        # Determine the index of the seed voxel in the neighborhood
-        nndx = np.nonzero(ndx1d == iv[i])[0]
-
-        # Extract the timecourses for all of the voxels in the neighborhood
-        tc = np.array(imdat[ndx1d.astype("int"), :])
-
-        # Ensure that the "seed" has variance, if not just skip it
-        if np.var(tc[nndx, :]) == 0:
+
+    del imdat, mask, seeds, neighbors, sparse_w
+
+    return W
+
+
+def block_bootstrap_indices(n_timepoints, block_size, random_state=None):
+    """
+    Generate the timepoint indices of a circular-block-bootstrap sample [1]_.
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of timepoints of the time-series.
+    block_size : int
+        Size of the bootstrapped blocks.
+    random_state : int or RandomState
+        Seed or random number generator used to draw the block offsets.
+
+    Returns
+    -------
+    indices : array
+        Indices of the bootstrapped timepoints, of length n_timepoints.
+
+    References
+    ----------
+    .. [1] P. Bellec; G. Marrelec; H. Benali, A bootstrap test to investigate
+      changes in brain connectivity for functional MRI. Statistica Sinica,
+      special issue on Statistical Challenges and Advances in Brain Science,
+      2008, 18: 1253-1268.
+
+    """
+    from sklearn.utils import check_random_state
+
+    rng = check_random_state(random_state)
+    block_size = max(1, int(block_size))
+    n_blocks = int(np.ceil(float(n_timepoints) / block_size))
+    offsets = np.floor(rng.rand(n_blocks) * n_timepoints).astype("int64")
+    indices = (offsets[:, np.newaxis] + np.arange(block_size)).flatten()
+    return np.mod(indices[:n_timepoints], n_timepoints)
+
+
+def parcellate_ts(ts_data, clust_type, k, mask_img, conn_comps=None,
+                  local_conn=None, n_components=200, random_state=42,
+                  ncut_cache_dir=None):
+    """
+    Cluster the voxels of a 2D masked time-series directly, without
+    unmasking it into an image.
+
+    Parameters
+    ----------
+    ts_data : array
+        A (timepoints x voxels) array of cleaned time-series, with voxels in
+        the order of np.nonzero(mask_img).
+    clust_type : str
+        Clustering method. One of 'kmeans', 'rena', 'ward', 'complete',
+        'average', 'single', or 'ncut'.
+    k : int
+        Numbers of clusters that will be generated.
+    mask_img : Nifti1Image
+        3D NIFTI file containing the mask of ts_data.
+    conn_comps : Nifti1Image
+        4D NIFTI file of the connected components of mask_img. If it contains
+        more than one component, 'kmeans' and 'rena' cluster each component
+        separately, with k allocated proportionally to their size.
+    local_conn : Compressed Sparse Matrix
+        Spatially constrained local connectivity matrix (see
+        make_local_connectivity_tcorr). Required for 'ncut', and used as the
+        connectivity of agglomerative methods if it matches the mask.
+        Otherwise, the voxel lattice is used.
+    n_components : int
+        Number of components of the randomized SVD onto which the voxel
+        time-series are reduced before clustering.
+    random_state : int
+        Seed of the SVD and of the 'kmeans' initialization.
+    ncut_cache_dir : str
+        Directory in which 'ncut' eigenvectors are cached (see ncut).
+
+    Returns
+    -------
+    labels : array
+        Cluster label of each voxel, numbered from 1. Voxels of discarded
+        connected components are labeled 0.
+    """
+    from scipy.sparse import issparse
+    from sklearn.utils.extmath import randomized_svd
+    from pynets.core.utils import proportional
+
+    mask = np.asarray(mask_img.dataobj).astype("bool")
+    m = int(np.sum(mask))
+
+    if clust_type == "ncut":
+        ncut_img = parcellate_ncut(local_conn, k, mask_img,
+                                   cache_dir=ncut_cache_dir)
+        return np.asarray(ncut_img.dataobj)[mask].astype("int32")
+
+    if conn_comps is not None and len(conn_comps.shape) == 4 and \
+            conn_comps.shape[-1] > 1 and clust_type in ["kmeans", "rena"]:
+        comps = np.asarray(conn_comps.dataobj)[mask] > 0
+    else:
+        comps = np.ones((m, 1), dtype=bool)
+    k_list = proportional(k, list(np.sum(comps, axis=0))) \
+        if comps.shape[1] > 1 else [k]
+
+    labels = np.zeros(m, dtype="int32")
+    for i in range(comps.shape[1]):
+        if comps.shape[1] > 1 and k_list[i] < 5:
+            print(f"Only {k_list[i]} voxels in component. Discarding...")
             continue
+        ndx = np.nonzero(comps[:, i])[0]
+
+        # Reduce the voxel time-series with a randomized SVD
+        n_comp = min(n_components, ts_data.shape[0], len(ndx))
+        _, s, vt = randomized_svd(ts_data[:, ndx], n_comp,
+                                  random_state=random_state)
+        components = (s[:, np.newaxis] * vt).T
+
+        if clust_type == "kmeans":
+            from sklearn.cluster import MiniBatchKMeans
+
+            est = MiniBatchKMeans(n_clusters=k_list[i], init="k-means++",
+                                  n_init=3, random_state=random_state + i)
+            comp_labels = est.fit(components).labels_
+        elif clust_type == "rena":
+            from nilearn.regions import ReNA
+
+            comp_mask = np.zeros(mask.shape, dtype="uint8")
+            comp_mask[tuple(np.array(np.nonzero(mask))[:, ndx])] = 1
+            est = ReNA(nib.Nifti1Image(comp_mask, mask_img.affine),
+                       n_clusters=k_list[i], scaling=False, n_iter=10)
+            comp_labels = est.fit(components.T).labels_
+        else:
+            from sklearn.cluster import AgglomerativeClustering
+            from sklearn.feature_extraction import image
 
-        # Calculate the correlation between all of the voxel TCs
-        R = np.corrcoef(tc)
+            if issparse(local_conn) and local_conn.shape == (m, m):
+                connectivity = local_conn
+            else:
+                connectivity = image.grid_to_graph(
+                    n_x=mask.shape[0], n_y=mask.shape[1], n_z=mask.shape[2],
+                    mask=mask)
+            est = AgglomerativeClustering(n_clusters=k_list[i],
+                                          connectivity=connectivity,
+                                          linkage=clust_type)
+            comp_labels = est.fit(components).labels_
 
-        if np.linalg.matrix_rank(R) == 1:
-            R = np.reshape(R, (1, 1))
+        labels[ndx] = comp_labels + np.max(labels) + 1
 
-        # Set nans to 0
-        R[np.isnan(R)] = 0
+    return labels
 
-        # Set values below thresh to 0
-        R[R < thresh] = 0
 
-        if np.linalg.matrix_rank(R) == 0:
-            R = np.reshape(R, (1, 1))
+def bootstrap_labels(ts_path, indices, clust_type, k, mask_img, conn_comps,
+                     local_conn, random_state, ncut_cache_dir=None):
+    """
+    Cluster one bootstrap sample of a memory-mapped masked time-series.
+    See bootstrap_parcellate.
+    """
+    import gc
+
+    ts_data = np.load(ts_path, mmap_mode="r")
+    try:
+        labels = parcellate_ts(np.asarray(ts_data[indices]), clust_type, k,
+                               mask_img, conn_comps=conn_comps,
+                               local_conn=local_conn,
+                               random_state=random_state,
+                               ncut_cache_dir=ncut_cache_dir)
+    except Exception as e:
+        print(f"Bootstrapped iteration failed: {e}")
+        labels = None
+    del ts_data
+    gc.collect()
+    return labels
+
+
+def bootstrap_parcellate(ts_data, c_boot, block_size, clust_type, k,
+                         mask_img, conn_comps=None, local_conn=None,
+                         n_jobs=1, random_state=None, ncut_cache_dir=None):
+    """
+    Cluster circular-block-bootstrap samples of a masked time-series in
+    parallel.
 
-        # Extract just the correlations with the seed TC
-        R = R[nndx, :].flatten()
+    The time-series is written once to a single memory-mapped buffer that
+    every worker maps read-only, so that each iteration only draws its
+    bootstrap indices and clusters the resampled 2D matrix.
 
-        # Set NaN values to 0
-        negcount = negcount + sum(R < 0)
+    Parameters
+    ----------
+    ts_data : array
+        A (timepoints x voxels) array of cleaned time-series, with voxels in
+        the order of np.nonzero(mask_img).
+    c_boot : int
+        Number of bootstrapped iterations.
+    block_size : int
+        Size of the bootstrapped blocks.
+    clust_type : str
+        Clustering method (see parcellate_ts).
+    k : int
+        Numbers of clusters that will be generated.
+    mask_img : Nifti1Image
+        3D NIFTI file containing the mask of ts_data.
+    conn_comps : Nifti1Image
+        4D NIFTI file of the connected components of mask_img.
+    local_conn : Compressed Sparse Matrix
+        Spatially constrained local connectivity matrix.
+    n_jobs : int
+        Number of parallel workers.
+    random_state : int
+        Seed of the bootstrap indices and of the clustering of each
+        bootstrapped iteration.
+    ncut_cache_dir : str
+        Directory in which 'ncut' eigenvectors are cached (see ncut).
 
-        # Determine the non-zero correlations (matrix weights) and add their
-        # indices and values to the list
-        nzndx = np.nonzero(R)[0]
-        if len(nzndx) > 0:
-            sparse_i = np.append(sparse_i, ondx1d[nzndx] - 1, 0)
-            sparse_j = np.append(sparse_j,
-                                 (ondx1d[nndx] - 1) * np.ones(len(nzndx)))
-            sparse_w = np.append(sparse_w, R[nzndx], 0)
+    Returns
+    -------
+    boot_labels : list
+        Label vectors of the successful bootstrapped iterations.
+    """
+    import gc
+    import shutil
+    import tempfile
+    from joblib import Parallel, delayed
+    from sklearn.utils import check_random_state
+    from pynets.fmri.clustools import bootstrap_labels
 
-    # Concatenate the i, j and w_ij into a single vector
-    outlist = sparse_i
-    outlist = np.append(outlist, sparse_j)
-    outlist = np.append(outlist, sparse_w)
+    rng = check_random_state(random_state)
+    cache_dir = tempfile.mkdtemp()
+    ts_path = f"{cache_dir}/ts_data.npy"
+    ts_mmap = np.lib.format.open_memmap(ts_path, mode="w+", dtype=np.float32,
+                                        shape=ts_data.shape)
+    ts_mmap[:] = ts_data
+    ts_mmap.flush()
+    del ts_mmap
+
+    boot_labels = []
+    try:
+        while len(boot_labels) < c_boot:
+            n_iter = c_boot - len(boot_labels)
+            # Each iteration draws its bootstrap indices and the seed of its
+            # clustering from rng
+            iter_args = [(block_bootstrap_indices(ts_data.shape[0],
+                                                  block_size, rng),
+                          rng.randint(2 ** 31)) for _ in range(n_iter)]
+            iter_labels = Parallel(n_jobs=n_jobs, backend="loky", verbose=10)(
+                delayed(bootstrap_labels)(
+                    ts_path, indices, clust_type, k, mask_img, conn_comps,
+                    local_conn, iter_seed, ncut_cache_dir)
+                for indices, iter_seed in iter_args)
+            iter_labels = [i for i in iter_labels if i is not None]
+            if len(iter_labels) == 0:
+                print("No bootstrapped iteration succeeded.")
+                break
+            boot_labels.extend(iter_labels)
+            gc.collect()
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
 
-    # Calculate the number of non-zero weights in the connectivity matrix
-    n = len(outlist) / 3
+    return boot_labels
 
-    # Reshape the 1D vector read in from infile in to a 3xN array
-    outlist = np.reshape(outlist, (3, int(n)))
 
-    m = max(max(outlist[0, :]), max(outlist[1, :])) + 1
+def coassignment_matrix(boot_labels, mask):
+    """
+    Accumulate how often neighboring voxels are assigned to the same cluster
+    across an ensemble of parcellations.
 
-    W = csc_matrix(
-        (outlist[2, :], (outlist[0, :], outlist[1, :])),
-        shape=(int(m), int(m)),
-        dtype=np.float32,
-    )
+    Co-assignment is only counted between each voxel and the 27 voxels in its
+    3D neighborhood, so memory and time grow with the number of voxels, and
+    not with the number of parcellations.
 
-    del imdat, msk, mskdat, outlist, m, sparse_i, sparse_j, sparse_w
+    Parameters
+    ----------
+    boot_labels : list
+        Label vectors of each parcellation, with voxels in the order of
+        np.nonzero(mask). Voxels labeled 0 are unassigned.
+    mask : array
+        3D boolean array of the voxels that were parcellated.
 
-    return W
+    Returns
+    -------
+    W : Compressed Sparse Matrix
+        A Scipy sparse matrix, with weights corresponding to the fraction of
+        parcellations in which voxel i and voxel j share a cluster.
+    """
+    from scipy.sparse import csc_matrix
+    from pynets.fmri.clustools import local_neighbor_pairs
 
+    seeds, neighbors = local_neighbor_pairs(mask)
+    m = int(np.sum(mask))
 
-def ensemble_parcellate(infiles, k):
-    from sklearn.feature_extraction import image
+    counts = np.zeros(len(seeds), dtype=np.float32)
+    for labels in boot_labels:
+        labels = np.asarray(labels)
+        counts += (labels[seeds] == labels[neighbors]) & (labels[seeds] > 0)
+    counts /= len(boot_labels)
 
-    # Read in the files, convert them to similarity matrices, and then average
-    # them
-    for i, file_ in enumerate(infiles):
+    # A voxel is always co-assigned with itself, which also keeps voxels that
+    # were never assigned from having zero degree
+    counts[seeds == neighbors] = 1
+    nzndx = np.nonzero(counts)[0]
 
-        img = nib.load(file_)
+    return csc_matrix(
+        (counts[nzndx], (neighbors[nzndx], seeds[nzndx])),
+        shape=(m, m),
+        dtype=np.float32,
+    )
 
-        img_data = img.get_fdata().astype("int16")
 
-        shape = img.shape
-        conn = image.grid_to_graph(
-            n_x=shape[0], n_y=shape[1], n_z=shape[2], mask=img_data
-        )
+def ensemble_parcellate(infiles, k, mask_img=None):
+    """
+    Derive a consensus parcellation from an ensemble of parcellations by
+    normalized cut clustering of their voxel co-assignment matrix.
 
-        if i == 0:
-            W = conn
-        else:
-            W = W + conn
+    Parameters
+    ----------
+    infiles : list
+        Label vectors of each parcellation (see bootstrap_parcellate) if
+        mask_img is specified. Otherwise, file paths of the parcellations.
+    k : int
+        Numbers of clusters that will be generated.
+    mask_img : Nifti1Image
+        3D NIFTI file containing the mask of the label vectors.
 
-    # compute the average
-    W = W / len(infiles)
+    Returns
+    -------
+    out_img : Nifti1Image
+        Consensus parcellation.
+    """
+    from pynets.fmri.clustools import coassignment_matrix
 
-    out_img = parcellate_ncut(W, k, img)
+    if mask_img is not None:
+        boot_labels = infiles
+    else:
+        # Only parcellation files need to be read, and are masked by every
+        # voxel assigned in any of them
+        imgs = [nib.load(file_) for file_ in infiles]
+        img_data = [np.asarray(img.dataobj).astype("int32") for img in imgs]
+        mask = np.any(np.array(img_data) > 0, axis=0)
+        mask_img = nib.Nifti1Image(mask.astype("uint16"), imgs[0].affine,
+                                   imgs[0].header)
+        boot_labels = [labels[mask] for labels in img_data]
+        del imgs, img_data
+
+    W = coassignment_matrix(
+        boot_labels, np.asarray(mask_img.dataobj).astype("bool"))
+
+    out_img = parcellate_ncut(W, k, mask_img)
     out_img.set_data_dtype(np.uint16)
 
     return out_img
@@ -884,7 +1242,8 @@ class NiParcellate(object):
 
         return self.atlas
 
-    def create_local_clustering(self, overwrite, r_thresh, min_region_size=80):
+    def create_local_clustering(self, overwrite, r_thresh, min_region_size=80,
+                                scorr_rank=None, n_jobs=1):
         """
         API for performing any of a variety of clustering routines available
          through NiLearn.
@@ -969,7 +1328,7 @@ class NiParcellate(object):
                     elif self.local_corr == "scorr":
                         self._local_conn = make_local_connectivity_scorr(
                             self._func_img, self._clust_mask_corr_img,
-                            thresh=r_thresh)
+                            thresh=r_thresh, rank=scorr_rank, n_jobs=n_jobs)
                     else:
                         try:
                             raise ValueError(
@@ -1010,15 +1369,33 @@ class NiParcellate(object):
         return
 
     def prep_boot(self, blocklength=1):
+        """
+        Mask, detrend, standardize and denoise the time-series once, ahead
+        of bootstrapping, and determine the bootstrap block size.
+        """
         from nilearn.masking import apply_mask
+        from nilearn.signal import clean
 
         ts_data = apply_mask(self._func_img, self._clust_mask_corr_img)
+
+        if self.conf is not None:
+            import pandas as pd
+
+            confounds = pd.read_csv(self.conf, sep="\t")
+            confounds = confounds.fillna(confounds.mean()).values
+        else:
+            confounds = None
+
+        ts_data = clean(ts_data, detrend=self._detrending,
+                        standardize=self._standardize,
+                        confounds=confounds).astype(np.float32)
         return ts_data, int(int(np.sqrt(ts_data.shape[0])) * blocklength)
 
 
 def parcellate(func_boot_img, local_corr, clust_type, _local_conn_mat_path,
                num_conn_comps, _clust_mask_corr_img, _standardize,
-               _detrending, k, _local_conn, conf, _dir_path, _conn_comps):
+               _detrending, k, _local_conn, conf, _dir_path, _conn_comps,
+               ncut_cache_dir=None):
     """
     API for performing any of a variety of clustering routines available
     through NiLearn.
@@ -1120,7 +1497,7 @@ def parcellate(func_boot_img, local_corr, clust_type, _local_conn_mat_path,
 
     elif clust_type == "ncut":
         out_img = parcellate_ncut(
-            _local_conn, k, _clust_mask_corr_img
+            _local_conn, k, _clust_mask_corr_img, cache_dir=ncut_cache_dir
         )
         out_img.set_data_dtype(np.uint16)
         print(
@@ -9,6 +9,7 @@ import os
 import numpy as np
 import indexed_gzip
 import nibabel as nib
+from contextlib import contextmanager
 from nipype.utils.filemanip import fname_presuffix
 import warnings
 
@@ -95,12 +96,157 @@ def deep_skull_strip(t1w_data, t1w_brain_mask, img):
     return t1w_brain_mask
 
 
+def get_anat_cache_dir(anat_cache, t1w, mask=None):
+    """
+    Get the directory in which the anatomical derivatives of a T1w image
+    (brain mask, tissue maps and white-matter edges) are cached, keyed by the
+    content hash of the T1w image and of the brain mask provided for it.
+    The dMRI and fMRI workflows of a subject share this directory.
+
+    Parameters
+    ----------
+    anat_cache : str
+        Root directory of the anatomical cache.
+    t1w : str
+        File path to the T1w image.
+    mask : str
+        Optional file path to a brain mask for the T1w image.
+
+    Returns
+    -------
+    cache_dir : str
+        Path to the cache directory of the T1w image.
+
+    """
+    import hashlib
+    import os.path as op
+
+    sha = hashlib.sha1()
+    for img_file in [t1w, mask]:
+        if img_file is None or not op.isfile(img_file):
+            sha.update(b"none")
+            continue
+        # Hash the image itself, since copies of the same T1w (e.g. in
+        # separate working directories) can differ in their gzip headers
+        img = nib.load(img_file)
+        sha.update(np.asarray(img.shape).tobytes())
+        sha.update(img.affine.tobytes())
+        sha.update(np.ascontiguousarray(img.dataobj).tobytes())
+        img.uncache()
+
+    cache_dir = f"{anat_cache}/t1w_{sha.hexdigest()[:16]}"
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+@contextmanager
+def lock_anat_cache(cache_dir):
+    """
+    Hold an exclusive lock on an anatomical cache directory, so that
+    concurrent workflows compute each derivative once and wait for it
+    otherwise.
+    """
+    import fcntl
+
+    with open(f"{cache_dir}/.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield cache_dir
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def gen_mask_cached(t1w, mask, anat_cache):
+    """
+    Skull-strip a T1w image with `gen_mask` once per subject, caching the
+    result by the content hash of the T1w image and mask.
+
+    Returns
+    -------
+    cache_dir : str
+        Path to the cache directory of the T1w image.
+    t1w_brain : str
+        File path to the cached T1w brain image.
+    t1w_brain_mask : str
+        File path to the cached T1w brain mask.
+
+    """
+    import shutil
+    import os.path as op
+
+    cache_dir = get_anat_cache_dir(anat_cache, t1w, mask)
+    t1w_head = f"{cache_dir}/t1w_head.nii.gz"
+    t1w_brain = f"{cache_dir}/t1w_brain.nii.gz"
+    t1w_brain_mask = f"{cache_dir}/t1w_brain_mask.nii.gz"
+
+    with lock_anat_cache(cache_dir):
+        if op.isfile(t1w_brain) and op.isfile(t1w_brain_mask):
+            print(f"Using cached T1w brain mask from {cache_dir}...")
+        else:
+            shutil.copyfile(t1w, t1w_head)
+            gen_mask(t1w_head, t1w_brain, mask)
+    return cache_dir, t1w_brain, t1w_brain_mask
+
+
+def segment_t1w_cached(cache_dir):
+    """
+    Segment the cached T1w brain image of `cache_dir` with `segment_t1w`
+    once per subject.
+
+    Returns
+    -------
+    out : dict
+        File paths to the cached WM, GM and CSF probability maps.
+
+    """
+    import os.path as op
+
+    basename = f"{cache_dir}/t1w_seg"
+    out = {"wm_prob": f"{basename}_pve_2.nii.gz",
+           "gm_prob": f"{basename}_pve_1.nii.gz",
+           "csf_prob": f"{basename}_pve_0.nii.gz"}
+
+    with lock_anat_cache(cache_dir):
+        if all(op.isfile(i) for i in out.values()):
+            print(f"Using cached tissue segmentation from {cache_dir}...")
+        else:
+            segment_t1w(f"{cache_dir}/t1w_brain.nii.gz", basename)
+    return out
+
+
+def get_wm_contour_cached(cache_dir, thr):
+    """
+    Threshold the cached WM probability map of `cache_dir` and extract its
+    edge with `get_wm_contour` once per subject and threshold.
+
+    Returns
+    -------
+    wm_mask_thr : str
+        File path to the cached thresholded WM mask.
+    wm_edge : str
+        File path to the cached WM edge.
+
+    """
+    import os.path as op
+    from nilearn.image import math_img
+
+    wm_prob = segment_t1w_cached(cache_dir)["wm_prob"]
+    wm_mask_thr = f"{cache_dir}/t1w_wm_thr-{thr}.nii.gz"
+    wm_edge = f"{cache_dir}/t1w_wm_edge_thr-{thr}.nii.gz"
+
+    with lock_anat_cache(cache_dir):
+        if not (op.isfile(wm_mask_thr) and op.isfile(wm_edge)):
+            math_img(f"img > {thr}", img=nib.load(wm_prob)).to_filename(
+                wm_mask_thr)
+            get_wm_contour(wm_prob, wm_mask_thr, wm_edge)
+    return wm_mask_thr, wm_edge
+
+
 def atlas2t1w2dwi_align(
     uatlas,
     uatlas_parcels,
     atlas,
     t1w_brain,
-    t1w_brain_mask,
     mni2t1w_warp,
     t1_aligned_mni,
     ap_path,
@@ -109,18 +255,18 @@ def atlas2t1w2dwi_align(
     t1w2dwi_xfm,
     wm_gm_int_in_dwi,
     aligned_atlas_t1mni,
-    aligned_atlas_skull,
     dwi_aligned_atlas,
     dwi_aligned_atlas_wmgm_int,
     B0_mask,
-    mni2dwi_xfm,
     simple,
+    transform_dir=None,
 ):
     """
     A function to perform atlas alignment atlas --> T1 --> dwi.
     Tries nonlinear registration first, and if that fails, does a linear
     registration instead. For this to succeed, must first have called
-    t1w2dwi_align.
+    t1w2dwi_align. The atlas is resampled into dwi space once, through
+    transforms composed and cached per subject in `transform_dir`.
     """
     import time
     from nilearn.image import resample_to_img
@@ -148,41 +294,44 @@ def atlas2t1w2dwi_align(
     )
     nib.save(uatlas_res_template, aligned_atlas_t1mni)
 
+    # With the native registration backend, intermediate images are passed
+    # between steps in memory instead of being written to disk
+    in_memory = regutils.get_registration_backend() == "native"
+    if in_memory:
+        atlas_in = uatlas_res_template
+        atlas_out = None
+    else:
+        atlas_in = aligned_atlas_t1mni
+        atlas_out = dwi_aligned_atlas
+
     if simple is False:
         try:
-            regutils.apply_warp(
-                t1w_brain,
-                aligned_atlas_t1mni,
-                aligned_atlas_skull,
-                warp=mni2t1w_warp,
-                interp="nn",
-                sup=True,
-                mask=t1w_brain_mask,
-            )
-            time.sleep(0.5)
-
-            # Apply linear transformation from template to dwi space
-            regutils.applyxfm(ap_path, aligned_atlas_skull, t1w2dwi_bbr_xfm,
-                              dwi_aligned_atlas, interp="nearestneighbour")
+            graph = regutils.dwi_transform_graph(
+                transform_dir, t1_aligned_mni, t1w_brain, ap_path,
+                mni2t1w_warp, mni2t1_xfm, t1w2dwi_bbr_xfm)
+            [atlas_img] = graph.resample_labels([atlas_in], "mni", "dwi",
+                                                [atlas_out])
             time.sleep(0.5)
         except BaseException:
             print(
                 "Warning: Atlas is not in correct dimensions, or input is low"
                 " quality,\nusing linear template registration.")
 
-            combine_xfms(mni2t1_xfm, t1w2dwi_bbr_xfm, mni2dwi_xfm)
-            time.sleep(0.5)
-            regutils.applyxfm(ap_path, aligned_atlas_t1mni, mni2dwi_xfm,
-                              dwi_aligned_atlas, interp="nearestneighbour")
+            graph = regutils.dwi_transform_graph(
+                transform_dir, t1_aligned_mni, t1w_brain, ap_path,
+                mni2t1w_warp, mni2t1_xfm, t1w2dwi_bbr_xfm, simple=True)
+            [atlas_img] = graph.resample_labels([atlas_in], "mni", "dwi",
+                                                [atlas_out])
             time.sleep(0.5)
     else:
-        combine_xfms(mni2t1_xfm, t1w2dwi_xfm, mni2dwi_xfm)
-        time.sleep(0.5)
-        regutils.applyxfm(ap_path, aligned_atlas_t1mni, mni2dwi_xfm,
-                          dwi_aligned_atlas, interp="nearestneighbour")
+        graph = regutils.dwi_transform_graph(
+            transform_dir, t1_aligned_mni, t1w_brain, ap_path,
+            mni2t1w_warp, mni2t1_xfm, t1w2dwi_xfm, simple=True)
+        [atlas_img] = graph.resample_labels([atlas_in], "mni", "dwi",
+                                            [atlas_out])
         time.sleep(0.5)
 
-    atlas_img = nib.load(dwi_aligned_atlas)
+    atlas_img = regutils.load_img(atlas_img)
     wm_gm_img = nib.load(wm_gm_int_in_dwi)
     wm_gm_mask_img = math_img("img > 0", img=wm_gm_img)
     atlas_mask_img = math_img("img > 0", img=atlas_img)
@@ -199,19 +348,26 @@ def atlas2t1w2dwi_align(
         connected=False
     )
 
-    nib.save(atlas_img_corr, dwi_aligned_atlas)
-    nib.save(dwi_aligned_atlas_wmgm_int_img, dwi_aligned_atlas_wmgm_int)
+    if in_memory:
+        nib.save(regutils.apply_mask_to_image(atlas_img_corr, B0_mask, None),
+                 dwi_aligned_atlas)
+        nib.save(regutils.apply_mask_to_image(dwi_aligned_atlas_wmgm_int_img,
+                                              B0_mask, None),
+                 dwi_aligned_atlas_wmgm_int)
+    else:
+        nib.save(atlas_img_corr, dwi_aligned_atlas)
+        nib.save(dwi_aligned_atlas_wmgm_int_img, dwi_aligned_atlas_wmgm_int)
 
-    dwi_aligned_atlas = regutils.apply_mask_to_image(dwi_aligned_atlas,
-                                                     B0_mask,
-                                                     dwi_aligned_atlas)
+        dwi_aligned_atlas = regutils.apply_mask_to_image(dwi_aligned_atlas,
+                                                         B0_mask,
+                                                         dwi_aligned_atlas)
 
-    time.sleep(0.5)
+        time.sleep(0.5)
 
-    dwi_aligned_atlas_wmgm_int = regutils.apply_mask_to_image(
-        dwi_aligned_atlas_wmgm_int,  B0_mask, dwi_aligned_atlas_wmgm_int)
+        dwi_aligned_atlas_wmgm_int = regutils.apply_mask_to_image(
+            dwi_aligned_atlas_wmgm_int,  B0_mask, dwi_aligned_atlas_wmgm_int)
 
-    time.sleep(0.5)
+        time.sleep(0.5)
     final_dat = atlas_img_corr.get_fdata()
     unique_a = sorted(set(np.array(final_dat.flatten().tolist())))
 
@@ -237,7 +393,6 @@ def atlas2t1w2dwi_align(
 def roi2dwi_align(
     roi,
     t1w_brain,
-    roi_in_t1w,
     roi_in_dwi,
     ap_path,
     mni2t1w_warp,
@@ -245,10 +400,12 @@ def roi2dwi_align(
     mni2t1_xfm,
     template,
     simple,
+    transform_dir=None,
 ):
     """
     A function to perform alignment of a waymask from
-    MNI space --> T1w --> dwi.
+    MNI space --> T1w --> dwi, in a single resampling through transforms
+    composed and cached per subject in `transform_dir`.
     """
     import time
     from pynets.registration import reg_utils as regutils
@@ -263,16 +420,13 @@ def roi2dwi_align(
     roi_res = f"{roi.split('.nii')[0]}_res.nii.gz"
     nib.save(roi_img_res, roi_res)
 
-    # Apply warp or transformer resulting from the inverse MNI->T1w created
-    # earlier
-    if simple is False:
-        regutils.apply_warp(t1w_brain, roi, roi_in_t1w, warp=mni2t1w_warp)
-    else:
-        regutils.applyxfm(t1w_brain, roi, mni2t1_xfm, roi_in_t1w)
-
+    # Apply the warp or transform resulting from the inverse MNI->T1w created
+    # earlier, followed by the transform from t1w to native dwi space
+    graph = regutils.dwi_transform_graph(transform_dir, template, t1w_brain,
+                                         ap_path, mni2t1w_warp, mni2t1_xfm,
+                                         t1wtissue2dwi_xfm, simple)
+    graph.resample(roi_res, "mni", "dwi", roi_in_dwi)
     time.sleep(0.5)
-    # Apply transform from t1w to native dwi space
-    regutils.applyxfm(ap_path, roi_in_t1w, t1wtissue2dwi_xfm, roi_in_dwi)
 
     return roi_in_dwi
 
@@ -284,22 +438,21 @@ def waymask2dwi_align(
     mni2t1w_warp,
     mni2t1_xfm,
     t1wtissue2dwi_xfm,
-    waymask_in_t1w,
     waymask_in_dwi,
     template,
     simple,
+    transform_dir=None,
 ):
     """
     A function to perform alignment of a waymask from
-    MNI space --> T1w --> dwi.
+    MNI space --> T1w --> dwi, in a single resampling through transforms
+    composed and cached per subject in `transform_dir`.
     """
     import time
     from nilearn.image import math_img
     from pynets.registration import reg_utils as regutils
     from nilearn.image import resample_to_img
 
-    # Apply warp or transformer resulting from the inverse MNI->T1w created
-    # earlier
     waymask_img = nib.load(waymask)
     template_img = nib.load(template)
 
@@ -309,22 +462,12 @@ def waymask2dwi_align(
     waymask_res = f"{waymask.split('.nii')[0]}_res.nii.gz"
     nib.save(waymask_img_res, waymask_res)
 
-    if simple is False:
-        regutils.apply_warp(
-            t1w_brain,
-            waymask_res,
-            waymask_in_t1w,
-            warp=mni2t1w_warp)
-    else:
-        regutils.applyxfm(t1w_brain, waymask_res, mni2t1_xfm, waymask_in_t1w)
-
-    time.sleep(0.5)
-    # Apply transform from t1w to native dwi space
-    regutils.applyxfm(
-        ap_path,
-        waymask_in_t1w,
-        t1wtissue2dwi_xfm,
-        waymask_in_dwi)
+    # Apply the warp or transform resulting from the inverse MNI->T1w created
+    # earlier, followed by the transform from t1w to native dwi space
+    graph = regutils.dwi_transform_graph(transform_dir, template, t1w_brain,
+                                         ap_path, mni2t1w_warp, mni2t1_xfm,
+                                         t1wtissue2dwi_xfm, simple)
+    graph.resample(waymask_res, "mni", "dwi", waymask_in_dwi)
 
     time.sleep(0.5)
 
@@ -459,10 +602,13 @@ def atlas2t1w_align(
     aligned_atlas_skull,
     aligned_atlas_gm,
     simple,
-    gm_fail_tol=5
+    gm_fail_tol=5,
+    transform_dir=None,
 ):
     """
-    A function to perform atlas alignment from atlas --> T1w.
+    A function to perform atlas alignment from atlas --> T1w. The atlas is
+    resampled through a voxel index mapping cached per subject in
+    `transform_dir`, which is reused by every other atlas.
     """
     import time
     from pynets.registration import reg_utils as regutils
@@ -488,29 +634,27 @@ def atlas2t1w_align(
     )
     nib.save(uatlas_res_template, aligned_atlas_t1mni)
 
+    graph = regutils.TransformGraph(transform_dir, {"mni": t1_aligned_mni,
+                                                    "t1w": t1w_brain})
     if simple is False:
         try:
-            regutils.apply_warp(
-                t1w_brain,
-                aligned_atlas_t1mni,
-                aligned_atlas_skull,
-                warp=mni2t1w_warp,
-                interp="nn",
-                sup=True,
-                mask=t1w_brain_mask,
-            )
+            graph.add_edge("mni", "t1w", warp=mni2t1w_warp)
+            graph.resample_labels([aligned_atlas_t1mni], "mni", "t1w",
+                                  [aligned_atlas_skull])
             time.sleep(0.5)
         except BaseException:
             print(
                 "Warning: Atlas is not in correct dimensions, or input is low "
                 "quality,\nusing linear template registration.")
 
-            regutils.applyxfm(t1w_brain, aligned_atlas_t1mni, mni2t1_xfm,
-                              aligned_atlas_skull, interp="nearestneighbour")
+            graph.add_edge("mni", "t1w", xfm=mni2t1_xfm)
+            graph.resample_labels([aligned_atlas_t1mni], "mni", "t1w",
+                                  [aligned_atlas_skull])
             time.sleep(0.5)
     else:
-        regutils.applyxfm(t1w_brain, aligned_atlas_t1mni, mni2t1_xfm,
-                          aligned_atlas_skull, interp="nearestneighbour")
+        graph.add_edge("mni", "t1w", xfm=mni2t1_xfm)
+        graph.resample_labels([aligned_atlas_t1mni], "mni", "t1w",
+                              [aligned_atlas_skull])
         time.sleep(0.5)
 
     # aligned_atlas_gm = regutils.apply_mask_to_image(aligned_atlas_skull,
@@ -601,6 +745,7 @@ def align(
     sch=None,
     wmseg=None,
     init=None,
+    backend=None,
 ):
     """
     Aligns two images using linear registration (FSL's FLIRT).
@@ -634,8 +779,28 @@ def align(
         init : str
             File path to a transformation matrix in .xfm format to use as an
             initial guess for the alignment.
+        backend : str
+            'fsl' or 'native'. Defaults to the `registration_backend` in
+            runconfig.yaml. The native backend optimizes mutual information
+            with dipy, and falls back to FLIRT for boundary-based
+            registration (`wmseg`), schedule files, and other costs.
 
     """
+    from pynets.registration.reg_utils import get_registration_backend, \
+        align_native, save_xfm
+
+    if backend is None:
+        backend = get_registration_backend()
+    if backend == "native" and wmseg is None and sch is None and \
+            cost in ["mutualinfo", None]:
+        [xfm_mat, out_img] = align_native(inp, ref, dof=dof, init=init,
+                                          interp=interp)
+        if xfm is not None:
+            save_xfm(xfm_mat, xfm)
+        if out is not None:
+            nib.save(out_img, out)
+        return
+
     cmd = f"flirt -in {inp} -ref {ref}"
     if xfm is not None:
         cmd += f" -omat {xfm}"
@@ -712,7 +877,8 @@ def align_nonlinear(
     return
 
 
-def applyxfm(ref, inp, xfm, aligned, interp="trilinear", dof=6):
+def applyxfm(ref, inp, xfm, aligned, interp="trilinear", dof=6,
+             backend=None):
     """
     Aligns two images with a given transform.
 
@@ -732,8 +898,25 @@ def applyxfm(ref, inp, xfm, aligned, interp="trilinear", dof=6):
             Interpolation method to use. Default is trilinear.
         dof : int
             Number of degrees of freedom to use in the alignment.
+        backend : str
+            'fsl' or 'native'. Defaults to the `registration_backend` in
+            runconfig.yaml. With the native backend, `ref`, `inp` and `xfm`
+            may also be images and arrays in memory, and the aligned image is
+            returned instead of saved if `aligned` is None.
 
     """
+    from pynets.registration.reg_utils import get_registration_backend, \
+        resample_fsl
+
+    if backend is None:
+        backend = get_registration_backend()
+    if backend == "native":
+        aligned_img = resample_fsl(inp, ref, xfm=xfm, interp=interp)
+        if aligned is None:
+            return aligned_img
+        nib.save(aligned_img, aligned)
+        return
+
     cmd = f"flirt -in {inp} -ref {ref} -out {aligned} -init {xfm} -interp" \
           f" {interp} -dof {dof} -applyxfm"
     print(cmd)
@@ -749,7 +932,9 @@ def apply_warp(
         xfm=None,
         mask=None,
         interp=None,
-        sup=False):
+        sup=False,
+        backend=None,
+        postmat=None):
     """
     Applies a warp to a Nifti1Image which transforms the image to the
     reference space used in generating the warp.
@@ -775,13 +960,40 @@ def apply_warp(
             Interpolation method to use.
         sup : bool
             Intermediary supersampling of output. Default is False.
+        backend : str
+            'fsl' or 'native'. Defaults to the `registration_backend` in
+            runconfig.yaml. The native backend applies displacement fields
+            (e.g. from `inverse_warp`) without supersampling, accepts images
+            in memory, and returns the output image instead of saving it if
+            `out` is None. It falls back to applywarp for FNIRT coefficient
+            files.
+        postmat : str
+            Optional file path to a transformation matrix in .xfm format to
+            apply after the warp.
 
     """
+    from pynets.registration.reg_utils import get_registration_backend, \
+        resample_fsl, is_displacement_field
+
+    if backend is None:
+        backend = get_registration_backend()
+    if backend == "native" and (warp is None or
+                                is_displacement_field(warp)):
+        out_img = resample_fsl(inp, ref, xfm=xfm, warp=warp,
+                               interp="trilinear" if interp is None
+                               else interp, mask=mask, postmat=postmat)
+        if out is None:
+            return out_img
+        nib.save(out_img, out)
+        return
+
     cmd = f"applywarp --ref={ref} --in={inp} --out={out}"
     if xfm is not None:
         cmd += f" --premat={xfm}"
     if warp is not None:
         cmd += f" --warp={warp}"
+    if postmat is not None:
+        cmd += f" --postmat={postmat}"
     if mask is not None:
         cmd += f" --mask={mask}"
     if interp is not None:
@@ -793,7 +1005,7 @@ def apply_warp(
     return
 
 
-def inverse_warp(ref, out, warp):
+def inverse_warp(ref, out, warp, backend=None):
     """
     Generates the inverse of a warp from a reference image space to the input
     image used in generating the warp.
@@ -809,15 +1021,29 @@ def inverse_warp(ref, out, warp):
         warp : str
             File path to input Nifti1Image output for the nonlinear warp
             following alignment.
+        backend : str
+            'fsl' or 'native'. Defaults to the `registration_backend` in
+            runconfig.yaml. The native backend inverts displacement fields
+            in-process, and falls back to invwarp for FNIRT coefficient
+            files.
 
     """
+    from pynets.registration.reg_utils import get_registration_backend, \
+        invert_warp_fsl, is_displacement_field
+
+    if backend is None:
+        backend = get_registration_backend()
+    if backend == "native" and is_displacement_field(warp):
+        nib.save(invert_warp_fsl(warp, ref), out)
+        return
+
     cmd = f"invwarp --warp={warp} --out={out} --ref={ref}"
     print(cmd)
     os.system(cmd)
     return
 
 
-def combine_xfms(xfm1, xfm2, xfmout):
+def combine_xfms(xfm1, xfm2, xfmout, backend=None):
     """
     A function to combine two transformations, and output the resulting
     transformation.
@@ -830,38 +1056,940 @@ def combine_xfms(xfm1, xfm2, xfmout):
             File path to the second transformation.
         xfmout : str
             File path to the output transformation.
+        backend : str
+            'fsl' or 'native'. Defaults to the `registration_backend` in
+            runconfig.yaml.
 
     """
+    from pynets.registration.reg_utils import get_registration_backend, \
+        load_xfm, save_xfm
+
+    if backend is None:
+        backend = get_registration_backend()
+    if backend == "native":
+        # Same operand order as `convert_xfm -concat xfm1 xfm2`
+        save_xfm(load_xfm(xfm1) @ load_xfm(xfm2), xfmout)
+        return
+
     cmd = f"convert_xfm -omat {xfmout} -concat {xfm1} {xfm2}"
     print(cmd)
     os.system(cmd)
     return
 
 
-def invert_xfm(in_mat, out_mat):
+def invert_xfm(in_mat, out_mat, backend=None):
     import os
+    from pynets.registration.reg_utils import get_registration_backend, \
+        load_xfm, save_xfm
+
+    if backend is None:
+        backend = get_registration_backend()
+    if backend == "native":
+        return save_xfm(np.linalg.inv(load_xfm(in_mat)), out_mat)
+
     cmd = f"convert_xfm -omat {out_mat} -inverse {in_mat}"
     print(cmd)
     os.system(cmd)
     return out_mat
 
 
-def apply_mask_to_image(input, mask, output):
+def apply_mask_to_image(input, mask, output, backend=None):
     import os
+    from pynets.registration.reg_utils import get_registration_backend, \
+        mask_img
+
+    if backend is None:
+        backend = get_registration_backend()
+    if backend == "native":
+        out_img = mask_img(input, mask)
+        if output is None:
+            return out_img
+        nib.save(out_img, output)
+        return output
+
     cmd = f"fslmaths {input} -mas {mask} {output}"
     print(cmd)
     os.system(cmd)
     return output
 
 
-def get_wm_contour(wm_map, mask, wm_edge):
+def get_wm_contour(wm_map, mask, wm_edge, backend=None):
     import os
+    from pynets.registration.reg_utils import get_registration_backend, \
+        wm_contour_img
+
+    if backend is None:
+        backend = get_registration_backend()
+    if backend == "native":
+        nib.save(wm_contour_img(wm_map, mask), wm_edge)
+        return wm_edge
+
     cmd = f"fslmaths {wm_map} -edge -bin -mas {mask} {wm_edge}"
     print(cmd)
     os.system(cmd)
     return wm_edge
 
 
+def get_registration_backend():
+    """
+    Get the registration backend set in runconfig.yaml: 'fsl' to run the FSL
+    command-line tools, or 'native' to run the supported operations
+    in-process with nibabel, dipy and scipy.
+    """
+    import pkg_resources
+    import yaml
+
+    with open(
+        pkg_resources.resource_filename("pynets", "runconfig.yaml"), "r"
+    ) as stream:
+        hardcoded_params = yaml.load(stream)
+        try:
+            backend = hardcoded_params["registration_backend"][0]
+        except KeyError:
+            backend = "fsl"
+    stream.close()
+
+    if backend not in ["fsl", "native"]:
+        try:
+            raise ValueError(f"Registration backend {backend} not "
+                             f"recognized! Options are 'fsl' and 'native'.")
+        except ValueError:
+            import sys
+            sys.exit(1)
+    return backend
+
+
+def load_img(img):
+    """
+    Return a Nifti1Image, loading it if given a file path.
+    """
+    if isinstance(img, str):
+        return nib.load(img)
+    return img
+
+
+def load_xfm(xfm):
+    """
+    Return a 4x4 FSL transformation matrix, loading it if given a file path.
+    """
+    if isinstance(xfm, str):
+        return np.loadtxt(xfm)
+    return np.asarray(xfm, dtype=np.float64)
+
+
+def save_xfm(xfm, out_mat):
+    """
+    Save a 4x4 transformation matrix in FSL's text format.
+    """
+    np.savetxt(out_mat, xfm, fmt="%.10f", delimiter="  ")
+    return out_mat
+
+
+def fsl_scaled_vox(img):
+    """
+    Get the affine from voxel coordinates of an image to FSL's scaled-voxel
+    coordinates, in which FLIRT matrices and FNIRT displacement fields are
+    expressed. The x axis is flipped for images with a neurological
+    (positive determinant) voxel-to-world affine.
+    """
+    img = load_img(img)
+    zooms = np.asarray(img.header.get_zooms()[:3], dtype=np.float64)
+    scaled = np.diag(np.append(zooms, 1.0))
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        scaled[0, 0] = -zooms[0]
+        scaled[0, 3] = (img.shape[0] - 1) * zooms[0]
+    return scaled
+
+
+def fsl_xfm_to_world(xfm, inp, ref):
+    """
+    Convert an FSL matrix mapping `inp` to `ref` into the world-space affine
+    that maps points of `ref` onto points of `inp` (dipy's AffineMap
+    convention).
+    """
+    inp = load_img(inp)
+    ref = load_img(ref)
+    return inp.affine @ np.linalg.inv(fsl_scaled_vox(inp)) @ \
+        np.linalg.inv(load_xfm(xfm)) @ fsl_scaled_vox(ref) @ \
+        np.linalg.inv(ref.affine)
+
+
+def world_to_fsl_xfm(affine, inp, ref):
+    """
+    Convert a world-space affine mapping points of `ref` onto points of `inp`
+    into the FSL matrix mapping `inp` to `ref`.
+    """
+    inp = load_img(inp)
+    ref = load_img(ref)
+    return fsl_scaled_vox(ref) @ np.linalg.inv(ref.affine) @ \
+        np.linalg.inv(affine) @ inp.affine @ \
+        np.linalg.inv(fsl_scaled_vox(inp))
+
+
+def is_displacement_field(warp):
+    """
+    Check whether a warp is a displacement field that can be applied
+    in-process, rather than one of FSL's spline or DCT coefficient files.
+    """
+    warp = load_img(warp)
+    # FSL_CUBIC_SPLINE_COEFFICIENTS, FSL_DCT_COEFFICIENTS,
+    # FSL_QUADRATIC_SPLINE_COEFFICIENTS and their TOPUP counterparts
+    coef_codes = [2007, 2008, 2009, 2016, 2017]
+    return len(warp.shape) == 4 and warp.shape[3] == 3 and \
+        int(warp.header.get("intent_code", 0)) not in coef_codes
+
+
+def get_interp_order(interp):
+    """
+    Map FSL interpolation names to spline orders.
+    """
+    if interp in ["nearestneighbour", "nn"]:
+        return 0
+    elif interp in ["spline", "sinc"]:
+        return 3
+    else:
+        return 1
+
+
+def resample_fsl(inp, ref, xfm=None, warp=None, interp="trilinear",
+                 mask=None, slab_size=16, postmat=None):
+    """
+    Resample an image onto the grid of a reference image through an FSL
+    matrix and/or displacement field, in memory. This is the in-process
+    equivalent of `flirt -applyxfm` (with `xfm`) and `applywarp` (with
+    `warp`, where `xfm` is the premat and `postmat` the postmat).
+
+    Parameters
+    ----------
+        inp : str or Nifti1Image
+            Input image to resample.
+        ref : str or Nifti1Image
+            Reference image defining the output grid.
+        xfm : str or ndarray
+            FSL matrix mapping `inp` to `ref`.
+        warp : str or Nifti1Image
+            FSL relative displacement field, in mm, mapping `ref` to `inp`.
+        interp : str
+            FSL interpolation name.
+        mask : str or Nifti1Image
+            Optional mask in reference space outside of which the output is
+            zeroed.
+        slab_size : int
+            Number of output slices resampled at once.
+        postmat : str or ndarray
+            FSL matrix applied after `warp`.
+
+    Returns
+    -------
+        out_img : Nifti1Image
+            Resampled image, with the geometry of `ref` and the data type of
+            `inp`.
+
+    """
+    from scipy.ndimage import map_coordinates
+
+    inp = load_img(inp)
+    ref = load_img(ref)
+    in_data = np.asarray(inp.dataobj)
+    order = get_interp_order(interp)
+    ref_shape = ref.shape[:3]
+
+    # Reference voxels -> reference scaled mm, and (pre-warp) scaled mm of
+    # the input -> input voxels
+    ref_to_fsl = fsl_scaled_vox(ref)
+    fsl_to_in = np.linalg.inv(fsl_scaled_vox(inp))
+    if xfm is not None:
+        fsl_to_in = fsl_to_in @ np.linalg.inv(load_xfm(xfm))
+    if postmat is not None:
+        ref_to_fsl = np.linalg.inv(load_xfm(postmat)) @ ref_to_fsl
+    if warp is not None:
+        warp = load_img(warp)
+        warp_data = np.asarray(warp.dataobj, dtype=np.float32)
+        fsl_to_warp = np.linalg.inv(fsl_scaled_vox(warp))
+        # A field defined on the output grid (e.g. one precomposed by
+        # TransformGraph) is read directly instead of being interpolated
+        on_ref_grid = postmat is None and \
+            warp_data.shape[:3] == ref_shape and \
+            np.allclose(warp.affine, ref.affine)
+
+    out_data = np.zeros(ref_shape + in_data.shape[3:], dtype=np.float64)
+    for z0 in range(0, ref_shape[2], slab_size):
+        z1 = min(z0 + slab_size, ref_shape[2])
+        vox = np.indices((ref_shape[0], ref_shape[1], z1 - z0),
+                         dtype=np.float64).reshape(3, -1)
+        vox[2] += z0
+        coords = ref_to_fsl[:3, :3] @ vox + ref_to_fsl[:3, 3:]
+        if warp is not None and on_ref_grid:
+            coords = coords + warp_data[:, :, z0:z1].reshape(-1, 3).T
+        elif warp is not None:
+            warp_vox = fsl_to_warp[:3, :3] @ coords + fsl_to_warp[:3, 3:]
+            coords = coords + np.stack([
+                map_coordinates(warp_data[..., i], warp_vox, order=1,
+                                mode="nearest") for i in range(3)])
+        coords = fsl_to_in[:3, :3] @ coords + fsl_to_in[:3, 3:]
+        slab_shape = (ref_shape[0], ref_shape[1], z1 - z0)
+        if in_data.ndim == 3:
+            out_data[:, :, z0:z1] = map_coordinates(
+                in_data, coords, output=np.float64, order=order,
+                mode="constant", cval=0).reshape(slab_shape)
+        else:
+            for vol in range(in_data.shape[3]):
+                out_data[:, :, z0:z1, vol] = map_coordinates(
+                    in_data[..., vol], coords, output=np.float64,
+                    order=order, mode="constant", cval=0).reshape(slab_shape)
+
+    if mask is not None:
+        mask_data = np.asarray(load_img(mask).dataobj) > 0
+        out_data[~mask_data] = 0
+    if np.issubdtype(in_data.dtype, np.integer):
+        out_data = np.round(out_data)
+
+    out_img = nib.Nifti1Image(out_data.astype(in_data.dtype), ref.affine,
+                              header=ref.header)
+    out_img.set_data_dtype(in_data.dtype)
+    return out_img
+
+
+def invert_warp_fsl(warp, ref, n_iter=20, slab_size=16):
+    """
+    Invert an FSL relative displacement field by fixed-point iteration, in
+    memory. This is the in-process equivalent of `invwarp`.
+
+    Parameters
+    ----------
+        warp : str or Nifti1Image
+            FSL relative displacement field, in mm, to invert.
+        ref : str or Nifti1Image
+            Image defining the grid of the inverse field (the input space of
+            `warp`).
+        n_iter : int
+            Number of fixed-point iterations.
+        slab_size : int
+            Number of output slices inverted at once.
+
+    Returns
+    -------
+        inv_warp_img : Nifti1Image
+            Inverse relative displacement field on the grid of `ref`.
+
+    """
+    from scipy.ndimage import map_coordinates
+
+    warp = load_img(warp)
+    ref = load_img(ref)
+    warp_data = np.asarray(warp.dataobj, dtype=np.float32)
+    fsl_to_warp = np.linalg.inv(fsl_scaled_vox(warp))
+    ref_to_fsl = fsl_scaled_vox(ref)
+    ref_shape = ref.shape[:3]
+
+    inv_data = np.zeros(ref_shape + (3,), dtype=np.float32)
+    for z0 in range(0, ref_shape[2], slab_size):
+        z1 = min(z0 + slab_size, ref_shape[2])
+        vox = np.indices((ref_shape[0], ref_shape[1], z1 - z0),
+                         dtype=np.float64).reshape(3, -1)
+        vox[2] += z0
+        target = ref_to_fsl[:3, :3] @ vox + ref_to_fsl[:3, 3:]
+
+        # Find y such that y + warp(y) = x, for every point x of the grid
+        y = target.copy()
+        for _ in range(n_iter):
+            warp_vox = fsl_to_warp[:3, :3] @ y + fsl_to_warp[:3, 3:]
+            y = target - np.stack([
+                map_coordinates(warp_data[..., i], warp_vox, order=1,
+                                mode="nearest") for i in range(3)])
+        inv_data[:, :, z0:z1] = (y - target).T.reshape(
+            (ref_shape[0], ref_shape[1], z1 - z0, 3))
+
+    inv_warp_img = nib.Nifti1Image(inv_data, ref.affine)
+    # FSL_FNIRT_DISPLACEMENT_FIELD
+    inv_warp_img.header.set_intent(2006)
+    return inv_warp_img
+
+
+def mask_img(inp, mask):
+    """
+    Zero an image outside of a mask, in memory. This is the in-process
+    equivalent of `fslmaths -mas`.
+    """
+    inp = load_img(inp)
+    data = np.asarray(inp.dataobj)
+    mask_data = np.asarray(load_img(mask).dataobj) > 0
+    out_data = data.copy()
+    out_data[~mask_data] = 0
+    return nib.Nifti1Image(out_data, inp.affine, header=inp.header)
+
+
+def wm_contour_img(wm_map, mask):
+    """
+    Binarized edge strength of a white-matter map within a mask, in memory.
+    This is the in-process equivalent of `fslmaths -edge -bin -mas`.
+    """
+    from scipy.ndimage import sobel
+
+    wm_map = load_img(wm_map)
+    data = np.asarray(wm_map.dataobj, dtype=np.float32)
+    edge = np.zeros(data.shape, dtype=np.float32)
+    for axis in range(3):
+        edge += sobel(data, axis=axis, mode="constant") ** 2
+    # Edge strength is only defined for voxels with a full neighborhood
+    edge[[0, -1], :, :] = 0
+    edge[:, [0, -1], :] = 0
+    edge[:, :, [0, -1]] = 0
+    out_data = ((edge > 0) & (np.asarray(load_img(mask).dataobj) > 0))
+    return nib.Nifti1Image(out_data.astype(data.dtype), wm_map.affine,
+                           header=wm_map.header)
+
+
+def align_native(inp, ref, dof=12, init=None, interp=None):
+    """
+    Linear registration by mutual information with dipy, the in-process
+    equivalent of FLIRT's `-cost mutualinfo`.
+
+    Parameters
+    ----------
+        inp : str or Nifti1Image
+            Input image to align.
+        ref : str or Nifti1Image
+            Reference image.
+        dof : int
+            Degrees of freedom: 3 (translation), 6 (rigid) or 12 (affine).
+        init : str or ndarray
+            Optional FSL matrix to use as an initial guess.
+        interp : str
+            FSL interpolation name of the output image.
+
+    Returns
+    -------
+        xfm : ndarray
+            FSL matrix mapping `inp` to `ref`.
+        out_img : Nifti1Image
+            `inp` resampled onto the grid of `ref`.
+
+    """
+    from dipy.align.imaffine import (
+        MutualInformationMetric,
+        AffineRegistration,
+        transform_centers_of_mass,
+    )
+    from dipy.align.transforms import (
+        TranslationTransform3D,
+        RigidTransform3D,
+        AffineTransform3D,
+    )
+
+    inp = load_img(inp)
+    ref = load_img(ref)
+    static = np.asarray(ref.dataobj, dtype=np.float32)
+    moving = np.asarray(inp.dataobj, dtype=np.float32)
+
+    if init is not None:
+        starting_affine = fsl_xfm_to_world(init, inp, ref)
+    else:
+        starting_affine = transform_centers_of_mass(
+            static, ref.affine, moving, inp.affine).affine
+
+    affine_reg = AffineRegistration(
+        metric=MutualInformationMetric(32, None), level_iters=[10, 10, 5],
+        sigmas=[3.0, 1.0, 0.0], factors=[4, 2, 1])
+    transforms = [TranslationTransform3D()]
+    if dof is None or dof > 3:
+        transforms.append(RigidTransform3D())
+    if dof is None or dof > 6:
+        transforms.append(AffineTransform3D())
+    for transform in transforms:
+        starting_affine = affine_reg.optimize(
+            static, moving, transform, None, ref.affine, inp.affine,
+            starting_affine=starting_affine).affine
+
+    xfm = world_to_fsl_xfm(starting_affine, inp, ref)
+    return xfm, resample_fsl(inp, ref, xfm=xfm, interp=interp)
+
+
+class TransformGraph(object):
+    """
+    A per-subject graph of the transforms between named spaces (e.g. 'mni',
+    't1w' and 'dwi'). Transforms along a path of edges are composed once and
+    cached, keyed by source space, target space and the content of the
+    transforms they were composed from, so that every image moved between
+    two spaces is resampled with a single interpolation.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory in which composed transforms are stored. Defaults to a
+        temporary directory.
+    spaces : dict
+        File paths to the reference image defining the grid of each space,
+        keyed by space name.
+
+    """
+
+    def __init__(self, cache_dir, spaces):
+        import tempfile
+
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.spaces = spaces
+        self.edges = {}
+
+    def add_edge(self, source, target, xfm=None, warp=None):
+        """
+        Add the transform from `source` to `target` space, following the
+        conventions of applywarp: `xfm` is an FSL matrix (the premat, if a
+        `warp` is given) and `warp` a relative displacement field or FNIRT
+        coefficient file on the grid of `target`.
+        """
+        for space in [source, target]:
+            if space not in self.spaces:
+                try:
+                    raise ValueError(f"Space {space} has no reference "
+                                     f"image!")
+                except ValueError:
+                    import sys
+                    sys.exit(1)
+        self.edges[(source, target)] = {"source": source, "target": target,
+                                        "xfm": xfm, "warp": warp}
+
+    def path(self, source, target):
+        """
+        Get the edges along the shortest path from `source` to `target`.
+        """
+        from collections import deque
+
+        previous = {source: None}
+        queue = deque([source])
+        while len(queue) > 0:
+            space = queue.popleft()
+            for (src, tgt) in self.edges:
+                if src == space and tgt not in previous:
+                    previous[tgt] = src
+                    queue.append(tgt)
+
+        if target not in previous:
+            try:
+                raise ValueError(f"No transform from {source} to {target} "
+                                 f"space!")
+            except ValueError:
+                import sys
+                sys.exit(1)
+
+        edges = []
+        space = target
+        while previous[space] is not None:
+            edges.insert(0, self.edges[(previous[space], space)])
+            space = previous[space]
+        return edges
+
+    def compose(self, source, target):
+        """
+        Compose the transforms from `source` to `target` space.
+
+        Returns
+        -------
+        xfm : str
+            File path to the FSL matrix mapping `source` to `target`, if
+            every transform along the path is linear, otherwise None.
+        warp : str
+            File path to the relative displacement field on the grid of
+            `target` mapping it onto `source`, if any transform along the
+            path is nonlinear, otherwise None.
+
+        """
+        edges = self.path(source, target)
+        if all(edge["warp"] is None for edge in edges):
+            return self._compose_xfms([edge["xfm"] for edge in edges],
+                                      f"{source}2{target}"), None
+
+        ref = self.spaces[target]
+        transforms = [tf for edge in edges for tf in [edge["xfm"],
+                                                      edge["warp"]]]
+        warp = f"{self.cache_dir}/{source}2{target}_" \
+               f"{self._digest(transforms, ref)}_warp.nii.gz"
+        if not os.path.isfile(warp):
+            print(f"Composing the {source} --> {target} transform...")
+            self._save(compose_warps(edges, ref), warp)
+        return None, warp
+
+    def resample(self, inp, source, target, out=None, interp="trilinear",
+                 sup=False, backend=None):
+        """
+        Resample an image from `source` to `target` space with a single
+        interpolation. A path through a single warp is applied with
+        applywarp's premat and postmat, and other paths through their
+        composed transform.
+
+        Parameters
+        ----------
+        inp : str or Nifti1Image
+            Image in `source` space. Must be a file path with the FSL
+            backend.
+        source : str
+            Name of the space of `inp`.
+        target : str
+            Name of the space to resample `inp` into.
+        out : str
+            File path to the output Nifti1Image. If None, the output image is
+            returned instead (native backend only).
+        interp : str
+            Interpolation method to use ('nn', 'trilinear' or 'spline').
+        sup : bool
+            Intermediary supersampling of output, with the FSL backend.
+            Default is False.
+        backend : str
+            'fsl' or 'native'. Defaults to the `registration_backend` in
+            runconfig.yaml.
+
+        Returns
+        -------
+        out : str or Nifti1Image
+            File path to the output image, or the output image itself if
+            `out` is None.
+
+        """
+        from pynets.registration.reg_utils import get_registration_backend, \
+            is_displacement_field, applyxfm, apply_warp
+
+        if backend is None:
+            backend = get_registration_backend()
+        ref = self.spaces[target]
+        edges = self.path(source, target)
+        warps = [i for i, edge in enumerate(edges) if edge["warp"] is not None]
+
+        if len(warps) == 1 and (backend == "fsl" or
+                                not is_displacement_field(
+                                    edges[warps[0]]["warp"])):
+            warp_edge = edges[warps[0]]
+            premat = self._compose_xfms(
+                [edge["xfm"] for edge in edges[:warps[0] + 1]],
+                f"{source}2{warp_edge['source']}")
+            postmat = self._compose_xfms(
+                [edge["xfm"] for edge in edges[warps[0] + 1:]],
+                f"{warp_edge['target']}2{target}")
+            out_img = apply_warp(ref, inp, out, warp=warp_edge["warp"],
+                                 xfm=premat, postmat=postmat, interp=interp,
+                                 sup=sup, backend=backend)
+        else:
+            xfm, warp = self.compose(source, target)
+            if warp is None:
+                out_img = applyxfm(ref, inp, xfm, out,
+                                   interp="nearestneighbour"
+                                   if interp == "nn" else interp,
+                                   backend=backend)
+            else:
+                out_img = apply_warp(ref, inp, out, warp=warp, interp=interp,
+                                     sup=sup, backend=backend)
+
+        if out is None:
+            return out_img
+        return out
+
+    def label_index(self, source, target, slab_size=16):
+        """
+        Map every voxel of `target` space to its nearest voxel of `source`
+        space through the composed transform. The mapping is cached, so that
+        resampling label volumes between the two spaces is a lookup.
+
+        Returns
+        -------
+        index : str
+            File path to an array with the flat index into the grid of
+            `source` of each voxel of the grid of `target` (both in C order),
+            or -1 for voxels mapped outside of it.
+
+        """
+        xfm, warp = self.compose(source, target)
+        src = load_img(self.spaces[source])
+        ref = load_img(self.spaces[target])
+        index_file = f"{self.cache_dir}/{source}2{target}_" \
+                     f"{self._digest([xfm, warp], src)}_" \
+                     f"{self._digest([], ref)}_index.npy"
+        if os.path.isfile(index_file):
+            return index_file
+
+        src_shape = np.asarray(src.shape[:3])
+        ref_shape = ref.shape[:3]
+        ref_to_fsl = fsl_scaled_vox(ref)
+        fsl_to_src = np.linalg.inv(fsl_scaled_vox(src))
+        if xfm is not None:
+            fsl_to_src = fsl_to_src @ np.linalg.inv(load_xfm(xfm))
+        else:
+            # The composed field is defined on the grid of `target`
+            warp_data = np.asarray(load_img(warp).dataobj, dtype=np.float32)
+
+        index = np.zeros(ref_shape, dtype=np.int64)
+        for z0 in range(0, ref_shape[2], slab_size):
+            z1 = min(z0 + slab_size, ref_shape[2])
+            vox = np.indices((ref_shape[0], ref_shape[1], z1 - z0),
+                             dtype=np.float64).reshape(3, -1)
+            vox[2] += z0
+            coords = ref_to_fsl[:3, :3] @ vox + ref_to_fsl[:3, 3:]
+            if xfm is None:
+                coords = coords + warp_data[:, :, z0:z1].reshape(-1, 3).T
+            coords = fsl_to_src[:3, :3] @ coords + fsl_to_src[:3, 3:]
+            # Same rounding and bounds as map_coordinates with order=0
+            src_vox = np.floor(coords + 0.5).astype(np.int64)
+            inside = np.all((coords >= 0) & (coords <= src_shape[:, None] - 1),
+                            axis=0)
+            slab_index = np.full(src_vox.shape[1], -1, dtype=np.int64)
+            slab_index[inside] = np.ravel_multi_index(src_vox[:, inside],
+                                                      src.shape[:3])
+            index[:, :, z0:z1] = slab_index.reshape(
+                (ref_shape[0], ref_shape[1], z1 - z0))
+
+        self._save(index, index_file)
+        return index_file
+
+    def resample_labels(self, inps, source, target, outs=None,
+                        backend=None):
+        """
+        Resample label volumes (e.g. parcellations) from `source` to `target`
+        space together, by nearest neighbour. The label volumes are stacked
+        and gathered through a single voxel index mapping, which is computed
+        once and cached, so that each further atlas costs only a lookup.
+        Paths through FNIRT coefficient files are resampled one volume at a
+        time with applywarp instead.
+
+        Parameters
+        ----------
+        inps : list
+            File paths to (or Nifti1Images of) the label volumes, on the grid
+            of the reference image of `source`.
+        source : str
+            Name of the space of `inps`.
+        target : str
+            Name of the space to resample `inps` into.
+        outs : list
+            File paths to the output Nifti1Images. The output images are
+            returned instead for outputs (or a list) that are None.
+        backend : str
+            'fsl' or 'native', for paths that cannot use the index mapping.
+            Defaults to the `registration_backend` in runconfig.yaml.
+
+        Returns
+        -------
+        outs : list
+            File paths to the output images, or the output images themselves
+            for outputs that are None.
+
+        """
+        from pynets.registration.reg_utils import is_displacement_field
+
+        if not all(is_displacement_field(edge["warp"]) for edge in
+                   self.path(source, target) if edge["warp"] is not None):
+            if outs is None:
+                outs = [None] * len(inps)
+            return [self.resample(inp, source, target, out, interp="nn",
+                                  sup=True, backend=backend)
+                    for inp, out in zip(inps, outs)]
+
+        src = load_img(self.spaces[source])
+        ref = load_img(self.spaces[target])
+        imgs = [load_img(inp) for inp in inps]
+        for img in imgs:
+            if img.shape[:3] != src.shape[:3] or \
+                    not np.allclose(img.affine, src.affine):
+                try:
+                    raise ValueError(f"Label volumes must be on the grid of "
+                                     f"the {source} reference image!")
+                except ValueError:
+                    import sys
+                    sys.exit(1)
+
+        index = np.load(self.label_index(source, target)).ravel()
+        outside = index < 0
+        labels = np.stack([np.asarray(img.dataobj).ravel() for img in imgs],
+                          axis=-1)
+        out_data = labels[np.where(outside, 0, index)]
+        out_data[outside] = 0
+
+        out_imgs = []
+        for i, img in enumerate(imgs):
+            dtype = img.get_data_dtype()
+            out_img = nib.Nifti1Image(
+                out_data[:, i].reshape(ref.shape[:3]).astype(dtype),
+                ref.affine, header=ref.header)
+            out_img.set_data_dtype(dtype)
+            out_imgs.append(out_img)
+
+        if outs is None:
+            return out_imgs
+        for out_img, out in zip(out_imgs, outs):
+            if out is not None:
+                nib.save(out_img, out)
+        return [out_img if out is None else out for out_img, out in
+                zip(out_imgs, outs)]
+
+    def _compose_xfms(self, xfms, name):
+        """
+        Save the product of FSL matrices, applied in the order given, to the
+        cache.
+        """
+        xfms = [xfm for xfm in xfms if xfm is not None]
+        if len(xfms) == 0:
+            return None
+
+        xfm_out = f"{self.cache_dir}/{name}_{self._digest(xfms)}_xfm.mat"
+        if not os.path.isfile(xfm_out):
+            xfm = np.eye(4)
+            for xfm_step in xfms:
+                xfm = load_xfm(xfm_step) @ xfm
+            self._save(xfm, xfm_out)
+        return xfm_out
+
+    def _save(self, obj, out):
+        """
+        Atomically save a matrix or image to the cache, which may be shared by
+        concurrent processes.
+        """
+        tmp = f"{self.cache_dir}/.{os.getpid()}_{os.path.basename(out)}"
+        if out.endswith(".npy"):
+            np.save(tmp, obj)
+        elif isinstance(obj, np.ndarray):
+            save_xfm(obj, tmp)
+        else:
+            nib.save(obj, tmp)
+        os.replace(tmp, out)
+
+    @staticmethod
+    def _digest(transforms, ref=None):
+        """
+        Hash the content of a sequence of transforms, and optionally the grid
+        of a reference image.
+        """
+        import hashlib
+
+        sha = hashlib.sha1()
+        for tf in transforms:
+            if tf is None:
+                sha.update(b"none")
+            elif isinstance(tf, str):
+                with open(tf, "rb") as f:
+                    for block in iter(lambda: f.read(2 ** 20), b""):
+                        sha.update(block)
+            elif isinstance(tf, nib.Nifti1Image):
+                sha.update(np.ascontiguousarray(tf.dataobj).tobytes())
+                sha.update(tf.affine.tobytes())
+            else:
+                sha.update(load_xfm(tf).tobytes())
+        if ref is not None:
+            ref = load_img(ref)
+            sha.update(np.asarray(ref.shape[:3]).tobytes())
+            sha.update(ref.affine.tobytes())
+        return sha.hexdigest()[:16]
+
+
+def compose_warps(edges, ref, slab_size=16):
+    """
+    Compose a chain of FSL matrices and relative displacement fields into a
+    single relative displacement field.
+
+    Parameters
+    ----------
+        edges : list
+            Transforms in the order they are applied, each a dict with an
+            `xfm` (premat) and/or a `warp`, following the conventions of
+            applywarp.
+        ref : str or Nifti1Image
+            Image defining the grid of the composed field (the output space
+            of the last transform).
+        slab_size : int
+            Number of output slices composed at once.
+
+    Returns
+    -------
+        warp_img : Nifti1Image
+            Relative displacement field on the grid of `ref`.
+
+    """
+    from scipy.ndimage import map_coordinates
+
+    ref = load_img(ref)
+    ref_to_fsl = fsl_scaled_vox(ref)
+    ref_shape = ref.shape[:3]
+
+    # Points of the output grid are pulled back through the transforms in
+    # reverse order
+    steps = []
+    for edge in reversed(edges):
+        warp_data = None
+        fsl_to_warp = None
+        inv_xfm = None
+        if edge["warp"] is not None:
+            warp = load_img(edge["warp"])
+            warp_data = np.asarray(warp.dataobj, dtype=np.float32)
+            fsl_to_warp = np.linalg.inv(fsl_scaled_vox(warp))
+        if edge["xfm"] is not None:
+            inv_xfm = np.linalg.inv(load_xfm(edge["xfm"]))
+        steps.append((warp_data, fsl_to_warp, inv_xfm))
+
+    warp_out = np.zeros(ref_shape + (3,), dtype=np.float32)
+    for z0 in range(0, ref_shape[2], slab_size):
+        z1 = min(z0 + slab_size, ref_shape[2])
+        vox = np.indices((ref_shape[0], ref_shape[1], z1 - z0),
+                         dtype=np.float64).reshape(3, -1)
+        vox[2] += z0
+        target = ref_to_fsl[:3, :3] @ vox + ref_to_fsl[:3, 3:]
+
+        coords = target.copy()
+        for warp_data, fsl_to_warp, inv_xfm in steps:
+            if warp_data is not None:
+                warp_vox = fsl_to_warp[:3, :3] @ coords + fsl_to_warp[:3, 3:]
+                coords = coords + np.stack([
+                    map_coordinates(warp_data[..., i], warp_vox, order=1,
+                                    mode="nearest") for i in range(3)])
+            if inv_xfm is not None:
+                coords = inv_xfm[:3, :3] @ coords + inv_xfm[:3, 3:]
+        warp_out[:, :, z0:z1] = (coords - target).T.reshape(
+            (ref_shape[0], ref_shape[1], z1 - z0, 3))
+
+    warp_img = nib.Nifti1Image(warp_out, ref.affine)
+    # FSL_FNIRT_DISPLACEMENT_FIELD
+    warp_img.header.set_intent(2006)
+    return warp_img
+
+
+def dwi_transform_graph(transform_dir, template, t1w_brain, ap_path,
+                        mni2t1w_warp, mni2t1_xfm, t1w2dwi_xfm, simple=False):
+    """
+    Build the graph of a subject's template (MNI) --> T1w --> dwi transforms.
+
+    Parameters
+    ----------
+        transform_dir : str
+            Directory in which composed transforms are cached.
+        template : str
+            File path to the template image defining MNI space.
+        t1w_brain : str
+            File path to the T1w brain image.
+        ap_path : str
+            File path to the anisotropic power image defining dwi space.
+        mni2t1w_warp : str
+            File path to the MNI --> T1w warp.
+        mni2t1_xfm : str
+            File path to the linear MNI --> T1w transformation matrix.
+        t1w2dwi_xfm : str
+            File path to the T1w --> dwi transformation matrix.
+        simple : bool
+            Use the linear MNI --> T1w transform instead of the warp.
+
+    Returns
+    -------
+        graph : TransformGraph
+
+    """
+    graph = TransformGraph(transform_dir, {"mni": template,
+                                           "t1w": t1w_brain,
+                                           "dwi": ap_path})
+    if simple is False:
+        graph.add_edge("mni", "t1w", warp=mni2t1w_warp)
+    else:
+        graph.add_edge("mni", "t1w", xfm=mni2t1_xfm)
+    graph.add_edge("t1w", "dwi", xfm=t1w2dwi_xfm)
+    return graph
+
+
 def vdc(n, vox_size):
     vdc, denom = 0, 1
     while n:
@@ -871,6 +1999,57 @@ def vdc(n, vox_size):
     return vdc
 
 
+def deform_streamlines(ref_grid_aff, mapping, streams_in_curr_grid,
+                       chunk_size=100000):
+    """
+    Displace streamlines by the forward field of a SyN mapping, interpolating
+    the field at the points of a chunk of streamlines at a time.
+
+    Parameters
+    ----------
+    ref_grid_aff : array
+        4x4 affine of the voxel grid of the displacement field.
+    mapping : DiffeomorphicMap
+        SyN mapping from `wm_syn`.
+    streams_in_curr_grid : ArraySequence
+        Streamlines in the coordinates of `ref_grid_aff`.
+    chunk_size : int
+        Number of streamlines deformed at once.
+
+    Returns
+    -------
+    streams_deformed : ArraySequence
+        Deformed streamlines. Each point of a streamline is displaced by the
+        sum of the displacements interpolated along that streamline.
+
+    """
+    from dipy.tracking.streamline import values_from_volume
+    from nibabel.streamlines.array_sequence import ArraySequence
+    from pynets.dmri.dmri_utils import compact_streamlines
+
+    streams_in_curr_grid = ArraySequence(streams_in_curr_grid)
+    forward_field = mapping.get_forward_field()
+
+    streams_deformed = ArraySequence()
+    for i in range(0, len(streams_in_curr_grid), chunk_size):
+        chunk = compact_streamlines(streams_in_curr_grid[i:i + chunk_size],
+                                    dtype=np.float64)
+        if len(chunk._data) == 0:
+            streams_deformed.extend(chunk)
+            continue
+
+        # One trilinear interpolation of the field for every point in the
+        # chunk, passed as a single (1, n_points, 3) array
+        displacements = values_from_volume(forward_field, chunk._data[None],
+                                           ref_grid_aff)[0]
+        chunk._data += np.repeat(
+            np.add.reduceat(displacements, chunk._offsets, axis=0),
+            chunk._lengths, axis=0)
+        streams_deformed.extend(chunk)
+
+    return streams_deformed
+
+
 def warp_streamlines(
     adjusted_affine,
     ref_grid_aff,
@@ -878,41 +2057,113 @@ def warp_streamlines(
     warped_fa_img,
     streams_in_curr_grid,
     brain_mask,
+    streams_deformed=None,
+    chunk_size=100000,
 ):
     from dipy.tracking import utils
-    from dipy.tracking.streamline import (
-        values_from_volume,
-        transform_streamlines,
-        Streamlines,
-    )
-
-    # Deform streamlines, isocenter, and remove streamlines outside brain
-    streams_in_brain = [
-        sum(d, s)
-        for d, s in zip(
-            values_from_volume(
-                mapping.get_forward_field(), streams_in_curr_grid, ref_grid_aff
-            ),
-            streams_in_curr_grid,
-        )
-    ]
-    streams_final_filt = Streamlines(
-        utils.target_line_based(
-            transform_streamlines(
-                transform_streamlines(
-                    streams_in_brain,
-                    np.linalg.inv(adjusted_affine)),
-                np.linalg.inv(
-                    warped_fa_img.affine),
-            ),
-            np.eye(4),
-            brain_mask,
-            include=True,
-        ))
+    from dipy.tracking.streamline import Streamlines
+    from nibabel.streamlines.array_sequence import ArraySequence
+    from pynets.registration.reg_utils import deform_streamlines
+
+    # Deform streamlines, isocenter, and remove streamlines outside brain.
+    # The deformation does not depend on the isocenter, so callers that try
+    # several isocenters can pass it precomputed.
+    if streams_deformed is None:
+        streams_deformed = deform_streamlines(ref_grid_aff, mapping,
+                                              streams_in_curr_grid,
+                                              chunk_size=chunk_size)
+    to_vox = np.linalg.inv(warped_fa_img.affine) @ \
+        np.linalg.inv(adjusted_affine)
+
+    streams_final_filt = Streamlines()
+    for i in range(0, len(streams_deformed), chunk_size):
+        chunk = ArraySequence(streams_deformed[i:i + chunk_size]).copy()
+        chunk._data = chunk._data @ to_vox[:3, :3].T + to_vox[:3, 3]
+        streams_final_filt.extend(utils.target_line_based(
+            [sl for sl in chunk], np.eye(4), brain_mask, include=True))
 
     return streams_final_filt
 
 
+def save_warped_streamlines(streamlines, reference_img, streams_path,
+                            vol_dims, chunk_size=100000):
+    """
+    Write streamlines in VOXMM space to a .trk file one chunk at a time,
+    dropping streamlines with coordinates outside of the reference volume, and
+    accumulate their fiber density map in the same pass.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        Streamlines in the VOXMM space of `reference_img`.
+    reference_img : Nifti1Image
+        Reference image of the tractogram.
+    streams_path : str
+        File path of the .trk file to save.
+    vol_dims : tuple
+        Shape of the fiber density map.
+    chunk_size : int
+        Number of streamlines processed at once.
+
+    Returns
+    -------
+    n_streamlines : int
+        Number of streamlines saved.
+    density : ndarray
+        Fiber density map of the saved streamlines, computed from their
+        VOXMM coordinates.
+
+    """
+    from nibabel.streamlines import LazyTractogram, TrkFile
+    from dipy.io.utils import create_tractogram_header, get_reference_info
+    from pynets.dmri.dmri_utils import accumulate_density_map, \
+        compact_streamlines
+
+    [affine, dimensions, voxel_sizes, voxel_order] = \
+        get_reference_info(reference_img)
+    density = np.zeros(vol_dims[:3], dtype='int64')
+    n_streamlines = [0]
+
+    def generate_chunks():
+        for i in range(0, len(streamlines), chunk_size):
+            chunk = compact_streamlines(streamlines[i:i + chunk_size],
+                                        dtype=streamlines._data.dtype)
+            if len(chunk) == 0:
+                continue
+
+            # Remove streamlines with negative voxel indices
+            keep = np.minimum.reduceat(
+                (chunk._data + 0.5).min(axis=1),
+                chunk._offsets).round(decimals=6) >= 0
+
+            # Remove streamlines outside of the bounding box of the reference
+            vox = chunk._data / voxel_sizes + 0.5
+            keep &= ~np.logical_or.reduceat(
+                np.any(vox < 1e-3, axis=1) |
+                np.any(vox > np.asarray(dimensions) - 1e-3, axis=1),
+                chunk._offsets)
+            del vox
+            chunk = compact_streamlines(chunk[keep], dtype=chunk._data.dtype)
+            if len(chunk) == 0:
+                continue
+
+            accumulate_density_map(density, chunk)
+            n_streamlines[0] += len(chunk)
+
+            # VOXMM to RASMM
+            chunk._data = (chunk._data / voxel_sizes) @ affine[:3, :3].T + \
+                affine[:3, 3]
+            for sl in chunk:
+                yield sl
+
+    header = create_tractogram_header(TrkFile, affine, dimensions,
+                                      voxel_sizes, voxel_order)
+    TrkFile(LazyTractogram(generate_chunks, affine_to_rasmm=np.eye(4)),
+            header=header).save(streams_path)
+
+    return n_streamlines[0], density
+
+
 def rescale_affine_to_center(input_affine, voxel_dims=[1, 1, 1],
                              target_center_coords=None):
     """
@@ -207,10 +207,7 @@ def direct_streamline_norm(
     from pynets.registration.reg_utils import vdc
     from nilearn.image import resample_to_img
     from dipy.io.streamline import load_tractogram
-    from dipy.tracking import utils
-    from dipy.tracking._utils import _mapping_to_voxel
-    from dipy.io.stateful_tractogram import Space, StatefulTractogram, Origin
-    from dipy.io.streamline import save_tractogram
+    from dipy.io.stateful_tractogram import Space, Origin
 
     # from pynets.core.utils import missing_elements
 
@@ -220,6 +217,8 @@ def direct_streamline_norm(
         try:
             hardcoded_params = yaml.load(stream)
             run_dsn = hardcoded_params['tracking']["DSN"][0]
+            streamline_chunk_size = \
+                hardcoded_params['tracking']["streamline_chunk_size"][0]
         except FileNotFoundError:
             import sys
             print("Failed to parse runconfig.yaml")
@@ -349,6 +348,11 @@ def direct_streamline_norm(
         ref_grid_aff = vox_size * np.eye(4)
         ref_grid_aff[3][3] = 1
 
+        # The SyN deformation is shared by all isocenter configurations
+        streams_deformed = regutils.deform_streamlines(
+            ref_grid_aff, mapping, streams_in_curr_grid,
+            chunk_size=streamline_chunk_size)
+
         streams_final_filt = []
         i = 0
         # Test for various types of voxel-grid configurations
@@ -371,34 +375,20 @@ def direct_streamline_norm(
             adjusted_affine[1][3] = adjusted_affine[1][3] * combs[i][1]
             adjusted_affine[2][3] = adjusted_affine[2][3] * combs[i][2]
 
-            streams_final_filt = regutils.warp_streamlines(adjusted_affine,
-                                                           ref_grid_aff,
-                                                           mapping,
-                                                           warped_fa_img,
-                                                           streams_in_curr_grid,
-                                                           brain_mask)
+            streams_final_filt = regutils.warp_streamlines(
+                adjusted_affine, ref_grid_aff, mapping, warped_fa_img,
+                streams_in_curr_grid, brain_mask, streams_deformed,
+                streamline_chunk_size)
 
             i += 1
 
-        # Remove streamlines with negative voxel indices
-        lin_T, offset = _mapping_to_voxel(np.eye(4))
-        streams_final_filt_final = []
-        for sl in streams_final_filt:
-            inds = np.dot(sl, lin_T)
-            inds += offset
-            if not inds.min().round(decimals=6) < 0:
-                streams_final_filt_final.append(sl)
-
-        # Save streamlines
-        stf = StatefulTractogram(
-            streams_final_filt_final,
-            reference=uatlas_mni_img,
-            space=Space.VOXMM,
-            origin=Origin.NIFTI,
-        )
-        stf.remove_invalid_streamlines()
-        streams_final_filt_final = stf.streamlines
-        save_tractogram(stf, streams_mni, bbox_valid_check=True)
+        del streams_deformed
+
+        # Save streamlines and their MNI density map, one chunk at a time
+        [n_streamlines, density] = regutils.save_warped_streamlines(
+            streams_final_filt, uatlas_mni_img, streams_mni,
+            warped_fa_shape, chunk_size=streamline_chunk_size)
+        print(f"Saved {n_streamlines} streamlines in MNI space.")
         warped_fa_img.uncache()
 
         # DSN QC plotting
@@ -406,17 +396,8 @@ def direct_streamline_norm(
         # streams_warp_png) plot_gen.show_template_bundles(streamlines,
         # fa_path, streams_warp_png)
 
-        # Create and save MNI density map
-        nib.save(
-            nib.Nifti1Image(
-                utils.density_map(
-                    streams_final_filt_final,
-                    affine=np.eye(4),
-                    vol_dims=warped_fa_shape),
-                warped_fa_affine,
-            ),
-            density_mni,
-        )
+        nib.save(nib.Nifti1Image(density, warped_fa_affine), density_mni)
+        del density
 
         # Map parcellation from native space back to MNI-space and create an
         # 'uncertainty-union' parcellation with original mni-space uatlas
@@ -462,8 +443,6 @@ def direct_streamline_norm(
             warped_uatlas_img_res_data,
             uatlas_mni_data,
             overlap_mask,
-            stf,
-            streams_final_filt_final,
             streams_final_filt,
             streams_in_curr_grid,
             brain_mask,
@@ -540,11 +519,14 @@ class DmriReg(object):
         vox_size,
         template_name,
         simple,
+        anat_cache=None,
     ):
         import pkg_resources
         import os.path as op
 
         self.simple = simple
+        self.anat_cache = anat_cache
+        self.anat_cache_dir = None
         self.ap_path = ap_path
         self.fa_path = fa_path
         self.B0_mask = B0_mask
@@ -559,6 +541,7 @@ class DmriReg(object):
         self.reg_path_mat = f"{self.reg_path}{'/mats'}"
         self.reg_path_warp = f"{self.reg_path}{'/warps'}"
         self.reg_path_img = f"{self.reg_path}{'/imgs'}"
+        self.reg_path_composed = f"{self.reg_path}{'/composed'}"
         self.t12mni_xfm_init = f"{self.reg_path_mat}{'/xfm_t1w2mni_init.mat'}"
         self.t12mni_xfm = f"{self.reg_path_mat}{'/xfm_t1w2mni.mat'}"
         self.mni2t1_xfm = f"{self.reg_path_mat}{'/xfm_mni2t1.mat'}"
@@ -629,7 +612,6 @@ class DmriReg(object):
             f"{'_vent_csf_in_dwi.nii.gz'}"
         )
         self.vent_mask_mni = f"{self.reg_path_img}{'/vent_mask_mni.nii.gz'}"
-        self.vent_mask_t1w = f"{self.reg_path_img}{'/vent_mask_t1w.nii.gz'}"
         self.input_mni = pkg_resources.resource_filename(
             "pynets", f"templates/{self.template_name}_{vox_size}.nii.gz"
         )
@@ -652,9 +634,6 @@ class DmriReg(object):
         self.corpuscallosum = pkg_resources.resource_filename(
             "pynets", f"templates/CorpusCallosum_{vox_size}.nii.gz"
         )
-        self.corpuscallosum_mask_t1w = (
-            f"{self.reg_path_img}{'/CorpusCallosum_t1wmask.nii.gz'}"
-        )
         self.corpuscallosum_dwi = f"{self.reg_path_img}" \
                                   f"{'/CorpusCallosum_dwi.nii.gz'}"
 
@@ -665,6 +644,7 @@ class DmriReg(object):
             self.reg_path_mat,
             self.reg_path_warp,
             self.reg_path_img,
+            self.reg_path_composed,
         ]
         for i in range(len(reg_dirs)):
             if not op.isdir(reg_dirs[i]):
@@ -672,10 +652,18 @@ class DmriReg(object):
 
     def gen_mask(self, mask):
         import os.path as op
+        import shutil
 
-        if op.isfile(self.t1w_brain) is False:
-            import shutil
+        if self.anat_cache is not None:
+            # Skull-strip once per subject, and share the result with the
+            # other workflows of a multimodal run
+            [self.anat_cache_dir, t1w_brain, t1w_brain_mask] = \
+                regutils.gen_mask_cached(self.t1w, mask, self.anat_cache)
+            shutil.copyfile(t1w_brain, self.t1w_brain)
+            shutil.copyfile(t1w_brain_mask, self.t1w_brain_mask)
+            return
 
+        if op.isfile(self.t1w_brain) is False:
             shutil.copyfile(self.t1w, self.t1w_head)
 
         [self.t1w_brain, self.t1w_brain_mask] = regutils.gen_mask(
@@ -693,6 +681,7 @@ class DmriReg(object):
         import shutil
 
         # Segment the t1w brain into probability maps
+        cached_tissue = False
         if (
             wm_mask_existing is not None
             and gm_mask_existing is not None
@@ -711,7 +700,12 @@ class DmriReg(object):
                 overwrite=False)
         else:
             try:
-                maps = regutils.segment_t1w(self.t1w_brain, self.map_name)
+                if self.anat_cache_dir is not None:
+                    maps = regutils.segment_t1w_cached(self.anat_cache_dir)
+                    cached_tissue = True
+                else:
+                    maps = regutils.segment_t1w(self.t1w_brain,
+                                                self.map_name)
                 time.sleep(0.5)
                 wm_mask = maps["wm_prob"]
                 gm_mask = maps["gm_prob"]
@@ -724,15 +718,23 @@ class DmriReg(object):
                 )
                 sys.exit(1)
 
-        # Threshold WM to binary in dwi space
-        t_img = nib.load(wm_mask)
-        mask = math_img("img > 0.20", img=t_img)
-        mask.to_filename(self.wm_mask_thr)
-
-        # Extract wm edge
-        self.wm_edge = regutils.get_wm_contour(wm_mask, self.wm_mask_thr,
-                                               self.wm_edge)
-        time.sleep(0.5)
+        if cached_tissue is True:
+            # Reuse the WM edge of the shared segmentation
+            [wm_mask_thr, wm_edge] = regutils.get_wm_contour_cached(
+                self.anat_cache_dir, 0.20)
+            shutil.copyfile(wm_mask_thr, self.wm_mask_thr)
+            shutil.copyfile(wm_edge, self.wm_edge)
+        else:
+            # Threshold WM to binary in dwi space
+            t_img = nib.load(wm_mask)
+            mask = math_img("img > 0.20", img=t_img)
+            mask.to_filename(self.wm_mask_thr)
+
+            # Extract wm edge
+            self.wm_edge = regutils.get_wm_contour(wm_mask,
+                                                   self.wm_mask_thr,
+                                                   self.wm_edge)
+            time.sleep(0.5)
         shutil.copyfile(wm_mask, self.wm_mask)
         shutil.copyfile(gm_mask, self.gm_mask)
         shutil.copyfile(csf_mask, self.csf_mask)
@@ -923,6 +925,23 @@ class DmriReg(object):
 
         return
 
+    def transform_graph(self):
+        """
+        Get the graph of MNI --> T1w --> DWI transforms, which caches their
+        compositions in the subject's registration directory. For this to
+        succeed, must first have called both t1w2mni_align and t1w2dwi_align.
+        """
+        return regutils.dwi_transform_graph(
+            self.reg_path_composed,
+            self.input_mni_brain,
+            self.t1w_brain,
+            self.ap_path,
+            self.mni2t1w_warp,
+            self.mni2t1_xfm,
+            self.t1wtissue2dwi_xfm,
+            self.simple,
+        )
+
     def tissue2dwi_align(self):
         """
         A function to perform alignment of ventricle ROI's from MNI
@@ -975,48 +994,22 @@ class DmriReg(object):
             self.vent_mask_mni,
         )
         time.sleep(0.5)
-        if self.simple is False:
-            # Apply warp resulting from the inverse MNI->T1w created earlier
-            regutils.apply_warp(
-                self.t1w_brain,
-                self.vent_mask_mni,
-                self.vent_mask_t1w,
-                warp=self.mni2t1w_warp,
-                interp="nn",
-                sup=True,
-            )
-            time.sleep(0.5)
-            try:
-                nib.load(self.corpuscallosum)
-            except indexed_gzip.ZranError as e:
-                print(e,
-                      f"\nCannot load Corpus Callosum ROI. Do you have "
-                      f"git-lfs installed?")
-                sys.exit(1)
-
-            regutils.apply_warp(
-                self.t1w_brain,
-                self.corpuscallosum,
-                self.corpuscallosum_mask_t1w,
-                warp=self.mni2t1w_warp,
-                interp="nn",
-                sup=True,
-            )
+        try:
+            nib.load(self.corpuscallosum)
+        except indexed_gzip.ZranError as e:
+            print(e,
+                  f"\nCannot load Corpus Callosum ROI. Do you have "
+                  f"git-lfs installed?")
+            sys.exit(1)
 
-        else:
-            regutils.applyxfm(
-                self.vent_mask_mni,
-                self.t1w_brain,
-                self.mni2t1_xfm,
-                self.vent_mask_t1w)
-            time.sleep(0.5)
-            regutils.applyxfm(
-                self.corpuscallosum,
-                self.t1w_brain,
-                self.mni2t1_xfm,
-                self.corpuscallosum_mask_t1w,
-            )
-            time.sleep(0.5)
+        # Resample the MNI rois to dwi space in one step, through the
+        # composed MNI->T1w->dwi transform
+        graph = self.transform_graph()
+        graph.resample(self.vent_mask_mni, "mni", "dwi", self.vent_mask_dwi)
+        time.sleep(0.5)
+        graph.resample(self.corpuscallosum, "mni", "dwi",
+                       self.corpuscallosum_dwi)
+        time.sleep(0.5)
 
         # Applyxfm tissue maps to dwi space
         if self.t1w_brain_mask is not None:
@@ -1027,12 +1020,6 @@ class DmriReg(object):
                 self.t1w_brain_mask_in_dwi,
             )
             time.sleep(0.5)
-        regutils.applyxfm(
-            self.ap_path,
-            self.vent_mask_t1w,
-            self.t1wtissue2dwi_xfm,
-            self.vent_mask_dwi)
-        time.sleep(0.5)
         regutils.applyxfm(
             self.ap_path,
             self.csf_mask,
@@ -1048,14 +1035,6 @@ class DmriReg(object):
         )
         time.sleep(0.5)
 
-        regutils.applyxfm(
-            self.ap_path,
-            self.corpuscallosum_mask_t1w,
-            self.t1wtissue2dwi_xfm,
-            self.corpuscallosum_dwi,
-        )
-        time.sleep(0.5)
-
         # Threshold WM to binary in dwi space
         thr_img = nib.load(self.wm_in_dwi)
         thr_img = math_img("img > 0.10", img=thr_img)
@@ -1135,11 +1114,14 @@ class FmriReg(object):
             anat_file,
             vox_size,
             template_name,
-            simple):
+            simple,
+            anat_cache=None):
         import os.path as op
         import pkg_resources
 
         self.t1w = anat_file
+        self.anat_cache = anat_cache
+        self.anat_cache_dir = None
         self.vox_size = vox_size
         self.template_name = template_name
         self.t1w_name = "t1w"
@@ -1149,6 +1131,7 @@ class FmriReg(object):
         self.reg_path_mat = f"{self.reg_path}{'/mats'}"
         self.reg_path_warp = f"{self.reg_path}{'/warps'}"
         self.reg_path_img = f"{self.reg_path}{'/imgs'}"
+        self.reg_path_composed = f"{self.reg_path}{'/composed'}"
         self.t1w2epi_xfm = f"{self.reg_path_mat}{'/t1w2epi_xfm.mat'}"
         self.t12mni_xfm_init = f"{self.reg_path_mat}{'/xfm_t1w2mni.mat'}"
         self.t12mni_xfm = f"{self.reg_path_mat}{'/xfm_t1w2mni.mat'}"
@@ -1195,6 +1178,7 @@ class FmriReg(object):
             self.reg_path_mat,
             self.reg_path_warp,
             self.reg_path_img,
+            self.reg_path_composed,
         ]
         for i in range(len(reg_dirs)):
             if not op.isdir(reg_dirs[i]):
@@ -1202,9 +1186,18 @@ class FmriReg(object):
 
     def gen_mask(self, mask):
         import os.path as op
+        import shutil
+
+        if self.anat_cache is not None:
+            # Skull-strip once per subject, and share the result with the
+            # other workflows of a multimodal run
+            [self.anat_cache_dir, t1w_brain, t1w_brain_mask] = \
+                regutils.gen_mask_cached(self.t1w, mask, self.anat_cache)
+            shutil.copyfile(t1w_brain, self.t1w_brain)
+            shutil.copyfile(t1w_brain_mask, self.t1w_brain_mask)
+            return
 
         if op.isfile(self.t1w_brain) is False:
-            import shutil
             shutil.copyfile(self.t1w, self.t1w_head)
         [self.t1w_brain, self.t1w_brain_mask] = regutils.gen_mask(
             self.t1w_head, self.t1w_brain, mask
@@ -1216,8 +1209,10 @@ class FmriReg(object):
         A function to segment and threshold tissue types from T1w.
         """
         import time
+        import shutil
 
         # Segment the t1w brain into probability maps
+        cached_tissue = False
         if (
             wm_mask_existing is not None
             and gm_mask_existing is not None
@@ -1232,7 +1227,12 @@ class FmriReg(object):
                 overwrite=False)
         else:
             try:
-                maps = regutils.segment_t1w(self.t1w_brain, self.map_name)
+                if self.anat_cache_dir is not None:
+                    maps = regutils.segment_t1w_cached(self.anat_cache_dir)
+                    cached_tissue = True
+                else:
+                    maps = regutils.segment_t1w(self.t1w_brain,
+                                                self.map_name)
                 gm_mask = maps["gm_prob"]
                 wm_mask = maps["wm_prob"]
             except RuntimeError:
@@ -1261,8 +1261,14 @@ class FmriReg(object):
                                                     self.wm_mask)
         # Extract wm edge
         time.sleep(0.5)
-        self.wm_edge = regutils.get_wm_contour(wm_mask, self.wm_mask_thr,
-                                               self.wm_edge)
+        if cached_tissue is True:
+            # Reuse the WM edge of the shared segmentation
+            shutil.copyfile(regutils.get_wm_contour_cached(
+                self.anat_cache_dir, 0.50)[1], self.wm_edge)
+        else:
+            self.wm_edge = regutils.get_wm_contour(wm_mask,
+                                                   self.wm_mask_thr,
+                                                   self.wm_edge)
 
         return
 
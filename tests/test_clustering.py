@@ -48,6 +48,110 @@ def test_indx_3dto1d():
     assert z is not None
 
 
+def test_local_neighbor_pairs():
+    """
+    Test for local_neighbor_pairs functionality
+    """
+    mask = np.zeros((4, 4, 4), dtype=bool)
+    mask[0, 0, :] = True
+    mask[3, 3, 3] = True
+
+    seeds, neighbors = clustools.local_neighbor_pairs(mask)
+
+    # Neighbors never wrap around the edges of the lattice
+    assert np.all(np.diff(seeds) >= 0)
+    assert 4 not in neighbors[seeds < 4]
+    assert np.sum(seeds == 0) == 2
+    assert np.sum(seeds == 1) == 3
+    assert np.sum(seeds == 4) == 1
+
+
+@pytest.mark.parametrize("local_corr", ['tcorr', 'scorr'])
+def test_make_local_connectivity_synthetic(local_corr):
+    """
+    Test the vectorized local connectivity against per-voxel correlations
+    """
+    from itertools import product
+
+    rng = np.random.RandomState(42)
+    shape = (5, 6, 7)
+    mask = rng.rand(*shape) > 0.3
+    func_data = rng.randn(*shape, 30).astype("float32")
+    # Voxels without variance stay in W as zero rows
+    zero_var = np.argwhere(mask)[[0, 10]]
+    func_data[tuple(zero_var.T)] = 1
+    func_img = nib.Nifti1Image(func_data, np.eye(4))
+    mask_img = nib.Nifti1Image(mask.astype("uint8"), np.eye(4))
+
+    if local_corr == 'tcorr':
+        W = clustools.make_local_connectivity_tcorr(func_img, mask_img,
+                                                    thresh=0.1, block_size=7)
+        maps = func_data[mask]
+    else:
+        W = clustools.make_local_connectivity_scorr(func_img, mask_img,
+                                                    thresh=0.1, block_size=7)
+        valid = np.std(func_data[mask], axis=1) > 0
+        maps = np.zeros((np.sum(mask), np.sum(valid)))
+        maps[valid] = np.corrcoef(func_data[mask][valid])
+
+        # Projection onto a full-rank SVD basis is exact
+        W_svd = clustools.make_local_connectivity_scorr(
+            func_img, mask_img, thresh=0.1, block_size=7, rank=30, n_jobs=2)
+        assert np.allclose(W_svd.toarray(), W.toarray(), atol=1e-4)
+
+    idx = -np.ones(shape, dtype=int)
+    idx[mask] = np.arange(np.sum(mask))
+    W_ref = np.zeros(W.shape)
+    for coord in np.argwhere(mask):
+        for offset in product((-1, 0, 1), repeat=3):
+            nb = coord + offset
+            if np.any(nb < 0) or np.any(nb >= shape) or idx[tuple(nb)] < 0:
+                continue
+            i, j = idx[tuple(nb)], idx[tuple(coord)]
+            if np.std(maps[i]) == 0 or np.std(maps[j]) == 0:
+                continue
+            r = np.corrcoef(maps[i], maps[j])[0, 1]
+            W_ref[i, j] = r if r >= 0.1 else 0
+
+    assert W.shape == (np.sum(mask), np.sum(mask))
+    assert np.allclose(W.toarray(), W_ref, atol=1e-5)
+    assert W[:, idx[tuple(zero_var[0])]].nnz == 0
+
+
+def test_ncut_solvers(tmp_path):
+    """
+    Test the sparse eigensolvers and warm starts of ncut
+    """
+    rng = np.random.RandomState(42)
+    mask = np.ones((10, 10, 10), dtype=bool)
+    labels = np.indices(mask.shape)[0] // 5 * 2 + \
+        np.indices(mask.shape)[1] // 5
+    func_data = (rng.randn(4, 40)[labels] +
+                 0.5 * rng.randn(*mask.shape, 40)).astype("float32")
+    W = clustools.make_local_connectivity_tcorr(
+        nib.Nifti1Image(func_data, np.eye(4)),
+        nib.Nifti1Image(mask.astype("uint8"), np.eye(4)), thresh=0.1)
+
+    val_arpack, _ = clustools.ncut(W, 4, solver='arpack')
+    val_lobpcg, _, report = clustools.ncut(W, 4, solver='lobpcg',
+                                           cache_dir=str(tmp_path),
+                                           return_report=True)
+    assert np.allclose(val_arpack, val_lobpcg, atol=1e-4)
+    assert report['converged'] is True
+    assert len(list(tmp_path.glob("ncut_*.npy"))) == 1
+
+    # Cached eigenvectors warm start reparcellation at another k
+    _, vec, report = clustools.ncut(W, 3, solver='lobpcg',
+                                    cache_dir=str(tmp_path),
+                                    return_report=True)
+    assert vec.shape == (1000, 3)
+    assert report['iterations'] < 5
+
+    out_img = clustools.parcellate_ncut(
+        W, 4, nib.Nifti1Image(mask.astype("uint8"), np.eye(4)))
+    assert len(np.unique(np.asarray(out_img.dataobj))) == 4
+
+
 def test_make_local_connectivity_tcorr():
     """
     Test for make_local_connectivity_tcorr functionality
@@ -88,6 +192,54 @@ def test_make_local_connectivity_scorr():
     assert out_img is not None
 
 
+def test_coassignment_matrix():
+    """
+    Test for coassignment_matrix functionality
+    """
+    mask = np.zeros((3, 3, 3), dtype=bool)
+    mask[1, 1, :] = True
+    boot_labels = [np.array([1, 1, 2]), np.array([1, 2, 2]),
+                   np.array([0, 1, 1])]
+
+    W = clustools.coassignment_matrix(boot_labels, mask).toarray()
+
+    assert np.allclose(np.diag(W), 1)
+    assert np.allclose(W, W.T)
+    assert np.isclose(W[0, 1], 1 / 3)
+    assert np.isclose(W[1, 2], 2 / 3)
+    assert W[0, 2] == 0
+
+
+@pytest.mark.parametrize("clust_type", ['kmeans', 'ward', 'rena'])
+def test_bootstrap_parcellate(clust_type):
+    """
+    Test for bootstrap_parcellate functionality
+    """
+    rng = np.random.RandomState(42)
+    mask = np.zeros((8, 8, 8), dtype=bool)
+    mask[1:7, 1:7, 1:7] = True
+    mask_img = nib.Nifti1Image(mask.astype("uint8"), np.eye(4))
+    ts_data = rng.randn(40, np.sum(mask)).astype("float32")
+
+    indices = clustools.block_bootstrap_indices(40, 6, random_state=0)
+    assert len(indices) == 40
+    assert indices.min() >= 0 and indices.max() < 40
+
+    boot_labels = clustools.bootstrap_parcellate(
+        ts_data, 3, 6, clust_type, 10, mask_img, n_jobs=2, random_state=0)
+
+    assert len(boot_labels) == 3
+    for labels in boot_labels:
+        assert labels.shape == (np.sum(mask),)
+        assert np.array_equal(np.unique(labels), np.arange(1, 11))
+
+    # Iterations are reproducible from random_state
+    boot_labels_rep = clustools.bootstrap_parcellate(
+        ts_data, 3, 6, clust_type, 10, mask_img, n_jobs=1, random_state=0)
+    assert all(np.array_equal(i, j) for i, j in zip(boot_labels,
+                                                     boot_labels_rep))
+
+
 @pytest.mark.parametrize("clust_type", ['kmeans', 'rena', 'average', 'complete', 'ward', 'ncut',
                                         pytest.param('single', marks=pytest.mark.xfail)])
 # 1 connected component
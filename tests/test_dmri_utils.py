@@ -6,6 +6,7 @@ Created on Wed Dec 27 16:19:14 2017
 
 """
 import os
+import pytest
 import numpy as np
 try:
     import cPickle as pickle
@@ -45,7 +46,8 @@ def test_normalize_grads():
     assert bvals_normed is not None
 
 
-def test_evaluate_streamline_plausibility():
+@pytest.mark.parametrize("batch_size", [None, 5000])
+def test_evaluate_streamline_plausibility(batch_size):
     """
     Test evaluate_streamline_plausibility functionality
     """
@@ -78,7 +80,200 @@ def test_evaluate_streamline_plausibility():
     )
     streamlines = tractogram.streamlines
     cleaned = evaluate_streamline_plausibility(dwi_data, gtab, B0_mask_data,
-                                               streamlines)
+                                               streamlines,
+                                               batch_size=batch_size)
 
     assert len(cleaned) > 0
     assert len(cleaned) <= len(streamlines)
+
+
+def test_streamline_node_incidence():
+    """
+    Test streamline_node_incidence functionality
+    """
+    from pynets.core import nodemaker
+
+    atlas_data = np.zeros((12, 12, 12))
+    atlas_data[:6, :6, :6] = 1
+    atlas_data[6:, :6, :6] = 2
+    atlas_data[:, 6:, 6:] = 4
+    roi_zooms = (2.0, 2.0, 2.0)
+    error_margin = 2
+    streamlines = [np.random.rand(np.random.randint(2, 20), 3).astype(
+        'float32') * 11 for _ in range(50)]
+
+    label_data, node_lut, roi_volumes = dmriutils.get_node_lut(atlas_data)
+    assert node_lut.tolist() == [-1, 0, 1, -1, 2]
+    assert roi_volumes.tolist() == [216, 216, 432]
+
+    offsets = nodemaker.get_sphere_offsets(error_margin, roi_zooms)
+    incidence = dmriutils.streamline_node_incidence(
+        streamlines, label_data, node_lut, offsets, overlap_thr=2,
+        batch_size=7).toarray()
+    assert incidence.shape == (len(streamlines), 3)
+
+    for ix, s in enumerate(streamlines):
+        vox_coords = np.floor(s.astype('float64') + 0.5).astype(int)
+        [i, j, k] = np.vstack([
+            nodemaker.get_sphere(coord, error_margin, roi_zooms,
+                                 atlas_data.shape)
+            for coord in vox_coords]).T
+        lab_arr = atlas_data[i, j, k]
+        expected = [node_lut[int(lab)] for lab in np.unique(lab_arr)
+                    if lab > 0 and np.sum(lab_arr == lab) >= 2]
+        assert np.where(incidence[ix])[0].tolist() == expected
+
+    # Multiple error margins are labeled in a single pass
+    error_margins = [1, 2, 3]
+    incidences = dmriutils.streamline_node_incidence(
+        streamlines, label_data, node_lut,
+        [nodemaker.get_sphere_offsets(i, roi_zooms) for i in error_margins],
+        overlap_thr=2)
+    assert len(incidences) == len(error_margins)
+    for error_margin, incidence_em in zip(error_margins, incidences):
+        assert np.array_equal(incidence_em.toarray(),
+                              dmriutils.streamline_node_incidence(
+                                  streamlines, label_data, node_lut,
+                                  nodemaker.get_sphere_offsets(
+                                      error_margin, roi_zooms),
+                                  overlap_thr=2).toarray())
+
+
+def test_iter_streamline_chunks():
+    """
+    Test iter_streamline_chunks functionality
+    """
+    import tempfile
+    import nibabel as nib
+    from dipy.io.stateful_tractogram import Space, Origin, StatefulTractogram
+    from dipy.io.streamline import load_tractogram, save_tractogram
+
+    tmp = tempfile.TemporaryDirectory()
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-10, -12, -8]
+    reference = nib.Nifti1Image(np.zeros((10, 12, 8), dtype='float32'),
+                                affine)
+    streamlines = [np.random.rand(np.random.randint(2, 10), 3).astype(
+        'float32') * 14 + 1 for _ in range(25)]
+    streams = f"{tmp.name}/streamlines.trk"
+    save_tractogram(StatefulTractogram(streamlines, reference, Space.VOXMM,
+                                       origin=Origin.NIFTI), streams)
+
+    chunks = list(dmriutils.iter_streamline_chunks(streams, reference,
+                                                   chunk_size=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+
+    expected = load_tractogram(streams, reference, to_space=Space.VOXMM,
+                               to_origin=Origin.NIFTI).streamlines
+    for s, s_expected in zip([s for chunk in chunks for s in chunk],
+                             expected):
+        assert np.allclose(s, s_expected, atol=1e-4)
+    tmp.cleanup()
+
+
+@pytest.mark.parametrize("mode", ["both_end", "any", "all"])
+@pytest.mark.parametrize("tol", [0.5, 2, 3.3])
+def test_streamlines_near_rois(mode, tol):
+    """
+    Test streamlines_near_rois functionality
+    """
+    from scipy.ndimage import distance_transform_edt
+    from scipy.spatial import cKDTree
+    from dipy.tracking.streamline import select_by_rois
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    atlas = np.zeros((20, 20, 20), dtype='uint16')
+    atlas[2:5, 3:7, 3:9] = 1
+    atlas[14:17, 10:15, 8:12] = 2
+    atlas[9, 9, 9] = 3
+    rng = np.random.RandomState(42)
+    streamlines = ArraySequence(
+        [(rng.uniform(-2, 22, 3) + np.cumsum(rng.normal(
+            0, 1, (rng.randint(1, 15), 3)), 0)).astype('float32')
+         for _ in range(1000)])[::2]
+
+    near = dmriutils.streamlines_near_rois(
+        streamlines, distance_transform_edt(atlas == 0),
+        cKDTree(np.argwhere(atlas > 0)), tol, mode=mode)
+
+    expected = list(select_by_rois(
+        list(streamlines), np.eye(4), [atlas == i for i in (1, 2, 3)],
+        [True] * 3, mode=mode, tol=tol))
+    assert near.sum() == len(expected)
+    for s, s_expected in zip(streamlines[near], expected):
+        assert np.array_equal(s, s_expected)
+
+
+def test_compact_streamlines():
+    """
+    Test compact_streamlines functionality
+    """
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    streamlines = ArraySequence([np.random.rand(np.random.randint(1, 10), 3)
+                                 for _ in range(50)])
+    keep = np.random.rand(50) > 0.5
+    view = streamlines[keep]
+    assert np.shares_memory(view._data, streamlines._data)
+
+    compacted = dmriutils.compact_streamlines(view, dtype=np.float32)
+    assert compacted._data.dtype == np.float32
+    assert len(compacted._data) == np.sum(streamlines._lengths[keep])
+    assert len(compacted) == len(view)
+    for s, s_expected in zip(compacted, view):
+        assert np.allclose(s, s_expected.astype(np.float32))
+
+
+def test_accumulate_density_map():
+    """
+    Test accumulate_density_map functionality
+    """
+    from dipy.tracking import utils
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    streamlines = ArraySequence([
+        np.cumsum(np.random.rand(np.random.randint(2, 20), 3), axis=0) + 2
+        for _ in range(100)])
+    vol_dims = (40, 40, 40)
+    density = np.zeros(vol_dims, dtype='int64')
+
+    # Batches of filtered views add up to the density of the whole set
+    keep = np.random.rand(100) > 0.5
+    dmriutils.accumulate_density_map(density, streamlines[keep])
+    dmriutils.accumulate_density_map(density, streamlines[~keep])
+    dmriutils.accumulate_density_map(density, ArraySequence())
+    assert np.array_equal(density,
+                          utils.density_map(streamlines, np.eye(4), vol_dims))
+
+
+def test_build_life_matrix():
+    """
+    Test build_life_matrix functionality
+    """
+    import dipy.tracking.life as life
+    from dipy.core.gradients import gradient_table
+    from dipy.data import get_fnames
+    from dipy.io.gradients import read_bvals_bvecs
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    bvals, bvecs = read_bvals_bvecs(*get_fnames('small_64D')[1:])
+    gtab = gradient_table(bvals, bvecs=bvecs)
+    vol_shape = (12, 12, 12)
+    streamlines = ArraySequence([
+        np.cumsum(np.random.rand(np.random.randint(2, 20), 3) * 0.5,
+                  axis=0) + 2 for _ in range(50)])
+
+    life_matrix, vox_coords = dmriutils.build_life_matrix(
+        streamlines, gtab, vol_shape, batch_size=7)
+    life_matrix_ref, vox_coords_ref = life.FiberModel(gtab).setup(
+        [s for s in streamlines], np.eye(4), sphere=False)
+
+    # Same voxels and fiber contributions, up to the order of the voxels
+    vox_lin = np.ravel_multi_index(tuple(vox_coords.T), vol_shape)
+    vox_lin_ref = np.ravel_multi_index(tuple(vox_coords_ref.T), vol_shape)
+    assert np.array_equal(vox_lin, np.sort(vox_lin_ref))
+    n_bvecs = np.sum(~gtab.b0s_mask)
+    rows = (np.argsort(vox_lin_ref)[:, None] * n_bvecs +
+            np.arange(n_bvecs)).ravel()
+    assert np.allclose(life_matrix.toarray(),
+                       life_matrix_ref.toarray()[rows])
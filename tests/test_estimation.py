@@ -451,3 +451,86 @@ def test_streams2graph(fa_wei, dsn):
                                 directget, fa_path, min_length, error_margin)[2]
 
     assert conn_matrix is not None
+
+
+def test_structural_connectome_accumulator():
+    """Test accumulating structural connectome edges across batches."""
+    from scipy.sparse import csr_matrix
+    from pynets.dmri.estimation import StructuralConnectomeAccumulator
+
+    roi_volumes = np.array([10, 20, 30, 40])
+    incidence = csr_matrix(np.array([[1, 1, 0, 0],
+                                     [1, 1, 1, 0],
+                                     [0, 0, 1, 1],
+                                     [0, 1, 0, 0]], dtype=bool))
+    fiber_lengths = np.array([2, 2, 1, 3])
+    fa_values = [np.array([0.2, 0.4]), np.array([0.6, 0.6]),
+                 np.array([np.nan]), np.array([0., 0.7, 1.])]
+
+    accumulator = StructuralConnectomeAccumulator(roi_volumes)
+    accumulator.update(incidence[:2], fiber_lengths[:2], fa_values[:2])
+    accumulator.update(incidence[2:], fiber_lengths[2:], fa_values[2:])
+    assert accumulator.n_streamlines == 4
+    assert accumulator.fa_min == 0.2
+    assert accumulator.fa_max == 1.
+
+    counts = accumulator.to_matrix(fiber_density=False, fa_wei=False)
+    assert np.array_equal(counts, counts.T)
+    assert counts[0, 1] == 2
+    assert counts[1, 2] == 1
+    assert counts[2, 3] == 1
+    assert counts[0, 3] == 0
+
+    fa_counts = accumulator.to_matrix(fiber_density=False, fa_wei=True)
+    assert np.isclose(fa_counts[0, 1], ((0.3 + 0.6) / 2 - 0.2) / 0.8 * 2)
+    assert np.isnan(fa_counts[2, 3])
+
+    density = accumulator.to_matrix(fiber_density=True, fa_wei=False)
+    total_volume = 10 + 20 + 30
+    assert np.isclose(density[0, 1], ((2 / 4) / 2) *
+                      (2 * total_volume / (10 + 20)) * 1000)
+
+
+def test_structural_connectome_accumulator_non_consecutive_labels():
+    """Test fiber density weighting of an atlas with non-consecutive
+    labels."""
+    from itertools import combinations
+    from scipy.sparse import csr_matrix
+    from pynets.dmri.dmri_utils import get_node_lut
+    from pynets.dmri.estimation import StructuralConnectomeAccumulator
+
+    atlas_labels = [1, 2, 3, 5, 8, 9, 12]
+    atlas_data = np.zeros(200)
+    start = 0
+    for i, lab in enumerate(atlas_labels):
+        atlas_data[start:start + i + 2] = lab
+        start += i + 2
+    atlas_data = atlas_data.reshape((5, 5, 8))
+
+    _, node_lut, roi_volumes = get_node_lut(atlas_data)
+    assert np.array_equal(node_lut[atlas_labels], np.arange(7))
+    assert np.array_equal(roi_volumes, np.arange(2, 9))
+
+    incidence = np.zeros((4, 7), dtype=bool)
+    incidence[0, [0, 3]] = True
+    incidence[1, [3, 5, 6]] = True
+    incidence[2, [4, 5]] = True
+    incidence[3, [0, 3]] = True
+    fiber_lengths = np.array([4, 6, 3, 2])
+
+    accumulator = StructuralConnectomeAccumulator(roi_volumes)
+    accumulator.update(csr_matrix(incidence), fiber_lengths)
+    density = accumulator.to_matrix(fiber_density=True, fa_wei=False)
+    assert np.all(np.isfinite(density))
+
+    edges = {}
+    for sl, nodes in enumerate(incidence):
+        for edge in combinations(np.nonzero(nodes)[0], 2):
+            edges.setdefault(edge, []).append(fiber_lengths[sl])
+    total_volume = np.sum(roi_volumes[np.unique([u for u, v in edges])])
+    for (u, v), lengths in edges.items():
+        assert np.isclose(density[u, v],
+                          ((len(lengths) / len(edges)) / np.mean(lengths)) *
+                          (2 * total_volume /
+                           (roi_volumes[u] + roi_volumes[v])) * 1000)
+        assert density[v, u] == density[u, v]
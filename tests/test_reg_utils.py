@@ -355,3 +355,237 @@ def test_make_median_b0():
     mean_file_out = reg_utils.median(dwi_file)
 
     assert os.path.isfile(mean_file_out)
+
+
+def test_warp_streamlines():
+    import tempfile
+    from dipy.align.imwarp import DiffeomorphicMap
+    from dipy.tracking import utils
+    from dipy.tracking.streamline import values_from_volume
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    shape = (20, 24, 20)
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-20, -24, -20]
+    mapping = DiffeomorphicMap(3, shape, affine)
+    mapping.forward = (np.random.randn(*shape, 3) * 0.002).astype('float32')
+    mapping.backward = -mapping.forward
+    ref_grid_aff = np.diag([2., 2., 2., 1.])
+    ref_img = nib.Nifti1Image(np.zeros(shape, dtype='float32'), affine)
+    brain_mask = np.zeros(shape, dtype=bool)
+    brain_mask[3:17, 3:21, 3:17] = True
+    streamlines = ArraySequence([
+        np.cumsum(np.random.randn(np.random.randint(5, 30), 3) * 0.3,
+                  axis=0) + np.random.uniform(10, 30, 3) for _ in range(200)])
+
+    streams_deformed = reg_utils.deform_streamlines(
+        ref_grid_aff, mapping, streamlines, chunk_size=30)
+    for s, s_deformed, d in zip(streamlines, streams_deformed,
+                                values_from_volume(mapping.get_forward_field(),
+                                                   streamlines,
+                                                   ref_grid_aff)):
+        assert np.allclose(s_deformed, sum(d, s))
+
+    adjusted_affine = np.eye(4)
+    adjusted_affine[:3, 3] = [20, 24, 20]
+    streams_final_filt = reg_utils.warp_streamlines(
+        adjusted_affine, ref_grid_aff, mapping, ref_img, streamlines,
+        brain_mask, chunk_size=30)
+    assert len(streams_final_filt) == len(reg_utils.warp_streamlines(
+        adjusted_affine, ref_grid_aff, mapping, ref_img, streamlines,
+        brain_mask, streams_deformed, chunk_size=30))
+
+    temp_dir = tempfile.TemporaryDirectory()
+    streams_mni = f"{temp_dir.name}/streamlines_mni.trk"
+    n_streamlines, density = reg_utils.save_warped_streamlines(
+        streams_final_filt, ref_img, streams_mni, shape, chunk_size=30)
+    saved = nib.streamlines.load(streams_mni).streamlines
+    assert len(saved) == n_streamlines > 0
+    assert np.array_equal(density, utils.density_map(
+        streams_final_filt, np.eye(4), shape))
+
+
+def test_native_backend():
+    import tempfile
+    from scipy.ndimage import gaussian_filter
+
+    temp_dir = tempfile.TemporaryDirectory()
+    data = gaussian_filter(np.random.rand(30, 34, 28), 3).astype('float32')
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-30, -34, -28]
+    img = nib.Nifti1Image(data, affine)
+
+    # An FSL translation of (4, 0, -2) mm shifts the scaled-voxel grid, whose
+    # x axis is flipped for this neurological affine, by (2, 0, 1) voxels
+    xfm = np.eye(4)
+    xfm[:3, 3] = [4, 0, -2]
+    xfm_file = reg_utils.save_xfm(xfm, f"{temp_dir.name}/xfm.mat")
+    aligned = np.asarray(reg_utils.applyxfm(img, img, xfm_file, None,
+                                            backend='native').dataobj)
+    assert np.allclose(aligned[5:25, :, 5:25], data[7:27, :, 6:26])
+    assert np.allclose(reg_utils.world_to_fsl_xfm(
+        reg_utils.fsl_xfm_to_world(xfm, img, img), img, img), xfm)
+
+    reg_utils.invert_xfm(xfm_file, f"{temp_dir.name}/xfm_inv.mat",
+                         backend='native')
+    reg_utils.combine_xfms(xfm_file, f"{temp_dir.name}/xfm_inv.mat",
+                           f"{temp_dir.name}/identity.mat", backend='native')
+    assert np.allclose(np.loadtxt(f"{temp_dir.name}/identity.mat"),
+                       np.eye(4))
+
+    # A displacement field followed by its inverse is close to the identity
+    warp_img = nib.Nifti1Image(np.stack([
+        gaussian_filter(np.random.randn(30, 34, 28), 5) * 20
+        for _ in range(3)], -1).astype('float32'), affine)
+    warp_img.header.set_intent(2006)
+    warp_file = f"{temp_dir.name}/warp.nii.gz"
+    nib.save(warp_img, warp_file)
+    reg_utils.inverse_warp(img, f"{temp_dir.name}/warp_inv.nii.gz",
+                           warp_file, backend='native')
+    warped = reg_utils.apply_warp(img, img, None, warp=warp_file,
+                                  backend='native')
+    unwarped = reg_utils.apply_warp(img, warped, None,
+                                    warp=f"{temp_dir.name}/warp_inv.nii.gz",
+                                    backend='native')
+    assert np.abs(np.asarray(unwarped.dataobj) -
+                  data)[5:-5, 5:-5, 5:-5].max() < 0.1 * np.ptp(data)
+
+    mask = np.zeros(data.shape, dtype='uint8')
+    mask[10:20, 10:20, 10:20] = 1
+    masked = reg_utils.apply_mask_to_image(img, nib.Nifti1Image(mask, affine),
+                                           None, backend='native')
+    assert np.all(np.asarray(masked.dataobj)[mask == 0] == 0)
+    assert np.array_equal(np.asarray(masked.dataobj)[mask == 1],
+                          data[mask == 1])
+
+
+def test_transform_graph():
+    import tempfile
+    from scipy.ndimage import gaussian_filter
+
+    temp_dir = tempfile.TemporaryDirectory()
+    data = gaussian_filter(np.random.rand(30, 34, 28), 3).astype('float32')
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-30, -34, -28]
+    mni_file = f"{temp_dir.name}/mni.nii.gz"
+    nib.save(nib.Nifti1Image(data, affine), mni_file)
+    t1w_affine = affine.copy()
+    t1w_affine[:3, 3] = [-26, -30, -24]
+    t1w_file = f"{temp_dir.name}/t1w.nii.gz"
+    nib.save(nib.Nifti1Image(np.zeros((26, 30, 24), dtype='float32'),
+                             t1w_affine), t1w_file)
+    dwi_affine = np.diag([3., 3., 3., 1.])
+    dwi_affine[:3, 3] = [-24, -27, -21]
+    dwi_file = f"{temp_dir.name}/dwi.nii.gz"
+    nib.save(nib.Nifti1Image(np.zeros((16, 18, 14), dtype='float32'),
+                             dwi_affine), dwi_file)
+
+    warp_img = nib.Nifti1Image(np.stack([
+        gaussian_filter(np.random.randn(26, 30, 24), 5) * 20
+        for _ in range(3)], -1).astype('float32'), t1w_affine)
+    warp_img.header.set_intent(2006)
+    warp_file = f"{temp_dir.name}/mni2t1w_warp.nii.gz"
+    nib.save(warp_img, warp_file)
+    mni2t1_xfm = np.eye(4)
+    mni2t1_xfm[:3, 3] = [2, -1, 3]
+    mni2t1_file = reg_utils.save_xfm(mni2t1_xfm,
+                                     f"{temp_dir.name}/mni2t1.mat")
+    t1w2dwi_xfm = np.eye(4)
+    t1w2dwi_xfm[:3, 3] = [-3, 2, 1]
+    t1w2dwi_file = reg_utils.save_xfm(t1w2dwi_xfm,
+                                      f"{temp_dir.name}/t1w2dwi.mat")
+
+    cache_dir = f"{temp_dir.name}/composed"
+    graph = reg_utils.dwi_transform_graph(cache_dir, mni_file, t1w_file,
+                                          dwi_file, warp_file, mni2t1_file,
+                                          t1w2dwi_file)
+    assert [(edge['source'], edge['target']) for edge in
+            graph.path('mni', 'dwi')] == [('mni', 't1w'), ('t1w', 'dwi')]
+
+    # Resampling through the composed field matches applying the warp and
+    # the T1w --> dwi transform as a postmat in a single interpolation
+    composed = graph.resample(mni_file, 'mni', 'dwi', backend='native')
+    chained = reg_utils.apply_warp(dwi_file, mni_file, None, warp=warp_file,
+                                   postmat=t1w2dwi_file, backend='native')
+    assert np.allclose(np.asarray(composed.dataobj),
+                       np.asarray(chained.dataobj), atol=1e-4)
+
+    # The composed field is cached, and reused by other graphs with the same
+    # transforms
+    [composed_warp] = [i for i in os.listdir(cache_dir)
+                       if i.endswith('_warp.nii.gz')]
+    assert nib.load(f"{cache_dir}/{composed_warp}").shape == (16, 18, 14, 3)
+    graph = reg_utils.dwi_transform_graph(cache_dir, mni_file, t1w_file,
+                                          dwi_file, warp_file, mni2t1_file,
+                                          t1w2dwi_file)
+    assert graph.compose('mni', 'dwi')[1] == f"{cache_dir}/{composed_warp}"
+
+    # Linear paths compose into a single FSL matrix
+    graph = reg_utils.dwi_transform_graph(cache_dir, mni_file, t1w_file,
+                                          dwi_file, warp_file, mni2t1_file,
+                                          t1w2dwi_file, simple=True)
+    xfm, warp = graph.compose('mni', 'dwi')
+    assert warp is None
+    assert np.allclose(np.loadtxt(xfm), t1w2dwi_xfm @ mni2t1_xfm)
+
+    # Label volumes are resampled together through a cached index mapping,
+    # matching nearest neighbour resampling of each volume
+    graph = reg_utils.dwi_transform_graph(cache_dir, mni_file, t1w_file,
+                                          dwi_file, warp_file, mni2t1_file,
+                                          t1w2dwi_file)
+    atlases = [nib.Nifti1Image(np.random.randint(0, n, size=data.shape,
+                                                 dtype='uint16'), affine)
+               for n in [10, 100, 400]]
+    aligned = graph.resample_labels(atlases, 'mni', 'dwi')
+    assert len([i for i in os.listdir(cache_dir)
+                if i.endswith('_index.npy')]) == 1
+    for atlas, atlas_aligned in zip(atlases, aligned):
+        expected = np.asarray(graph.resample(atlas, 'mni', 'dwi', interp='nn',
+                                             backend='native').dataobj)
+        assert atlas_aligned.get_data_dtype() == np.uint16
+        assert atlas_aligned.shape == (16, 18, 14)
+        assert np.array_equal(np.asarray(atlas_aligned.dataobj), expected)
+
+
+def test_gen_mask_cached(monkeypatch):
+    import tempfile
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setattr(reg_utils, "get_registration_backend",
+                        lambda: "native")
+    temp_dir = tempfile.TemporaryDirectory()
+    affine = np.diag([2., 2., 2., 1.])
+    t1w_data = np.random.rand(20, 24, 18).astype('float32')
+    mask_data = np.zeros(t1w_data.shape, dtype='uint8')
+    mask_data[4:16, 4:20, 4:14] = 1
+    t1w = f"{temp_dir.name}/t1w.nii.gz"
+    mask = f"{temp_dir.name}/mask.nii.gz"
+    nib.save(nib.Nifti1Image(t1w_data, affine), t1w)
+    nib.save(nib.Nifti1Image(mask_data, affine), mask)
+    t1w_copy = f"{temp_dir.name}/t1w_copy.nii.gz"
+    shutil.copyfile(t1w, t1w_copy)
+
+    # Copies of the T1w share a cache, which differs between brain masks
+    anat_cache = f"{temp_dir.name}/anat_tmp"
+    assert reg_utils.get_anat_cache_dir(anat_cache, t1w, mask) == \
+        reg_utils.get_anat_cache_dir(anat_cache, t1w_copy, mask)
+    assert reg_utils.get_anat_cache_dir(anat_cache, t1w, mask) != \
+        reg_utils.get_anat_cache_dir(anat_cache, t1w, None)
+
+    # Concurrent workflows skull-strip once, and get the same result
+    with ThreadPoolExecutor(2) as executor:
+        outs = list(executor.map(
+            lambda t1w_file: reg_utils.gen_mask_cached(t1w_file, mask,
+                                                       anat_cache),
+            [t1w, t1w_copy]))
+    assert outs[0] == outs[1]
+    [cache_dir, t1w_brain, t1w_brain_mask] = outs[0]
+    assert np.array_equal(np.asarray(nib.load(t1w_brain_mask).dataobj) > 0,
+                          mask_data > 0)
+    brain_data = np.asarray(nib.load(t1w_brain).dataobj)
+    assert np.all(brain_data[mask_data == 0] == 0)
+    assert np.allclose(brain_data[mask_data == 1], t1w_data[mask_data == 1])
+    mtime = os.path.getmtime(t1w_brain)
+    assert reg_utils.gen_mask_cached(t1w, mask, anat_cache) == outs[0]
+    assert os.path.getmtime(t1w_brain) == mtime
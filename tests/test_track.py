@@ -6,6 +6,7 @@ Created on Thur July 18 20:19:14 2019
 
 """
 import pytest
+import os
 try:
     import cPickle as pickle
 except ImportError:
@@ -83,6 +84,195 @@ def test_prep_tissues(tiss_class):
     assert tiss_classifier is not None
 
 
+@pytest.mark.parametrize("tiss_class", ['act', 'wm', 'cmc', 'wb'])
+def test_share_tracking_inputs(tiss_class):
+    """
+    Test for share_tracking_inputs functionality
+    """
+    import tempfile
+    from pynets.dmri import track
+    base_dir = str(Path(__file__).parent/"examples")
+    dir_path = f"{base_dir}/003/dmri"
+    B0_mask = f"{base_dir}/003/anat/mean_B0_bet_mask_tmp.nii.gz"
+    gm_in_dwi = f"{base_dir}/003/anat/t1w_gm_in_dwi.nii.gz"
+    vent_csf_in_dwi = f"{base_dir}/003/anat/t1w_vent_csf_in_dwi.nii.gz"
+    wm_in_dwi = f"{base_dir}/003/anat/t1w_wm_in_dwi.nii.gz"
+    atlas_data_wm_gm_int = f"{dir_path}/whole_brain_cluster_labels_PCA200_" \
+                           f"dwi_track_wmgm_int.nii.gz"
+    labels_im_file = f"{dir_path}/whole_brain_cluster_labels_PCA200_dwi_" \
+                     f"track.nii.gz"
+
+    temp_dir = tempfile.TemporaryDirectory()
+    recon_path = temp_dir.name + '/model_file.hdf5'
+    with h5py.File(recon_path, 'w') as hf:
+        hf.create_dataset("reconstruction",
+                          data=np.ones(nib.load(B0_mask).shape + (15,),
+                                       dtype='float32'))
+    hf.close()
+
+    tracking_inputs = track.share_tracking_inputs(
+        recon_path, atlas_data_wm_gm_int, labels_im_file, B0_mask, None,
+        gm_in_dwi, gm_in_dwi, vent_csf_in_dwi, wm_in_dwi, tiss_class,
+        temp_dir.name)
+
+    assert tracking_inputs['waymask'] is None
+    assert np.load(tracking_inputs['recon'], mmap_mode='r').shape[-1] == 15
+    assert np.load(tracking_inputs['recon'], mmap_mode='r').shape[:3] == \
+        nib.load(B0_mask).shape
+    assert np.load(tracking_inputs['atlas'], mmap_mode='r').dtype == 'uint16'
+
+    tiss_classifier = track.tiss_classifier_from_maps(
+        tiss_class,
+        [np.load(i, mmap_mode='r') for i in tracking_inputs['tissue_maps']],
+        tracking_inputs['voxel_size'])
+    assert tiss_classifier is not None
+
+
+def test_share_tracking_inputs_bbox(tmp_path):
+    """
+    Test that share_tracking_inputs only stores the padded bounding box of
+    the reconstruction and tissue maps
+    """
+    from pynets.dmri import track
+
+    shape = (20, 18, 16)
+    mask = np.zeros(shape, dtype='uint8')
+    mask[6:12, 5:10, 4:14] = 1
+    paths = {}
+    for name, data in [('B0_mask', mask), ('wm', mask.astype('float32')),
+                       ('gm', np.zeros(shape, dtype='float32')),
+                       ('csf', np.zeros(shape, dtype='float32'))]:
+        paths[name] = str(tmp_path/f"{name}.nii.gz")
+        nib.save(nib.Nifti1Image(data, np.eye(4)), paths[name])
+    recon = np.random.rand(*shape, 15).astype('float32') * mask[..., None]
+    recon_path = str(tmp_path/'recon.hdf5')
+    with h5py.File(recon_path, 'w') as hf:
+        hf.create_dataset("reconstruction", data=recon)
+        hf['reconstruction'].attrs['bbox'] = [6, 12, 5, 10, 4, 14]
+    hf.close()
+
+    tracking_inputs = track.share_tracking_inputs(
+        recon_path, paths['B0_mask'], paths['B0_mask'], paths['B0_mask'],
+        None, paths['B0_mask'], paths['gm'], paths['csf'], paths['wm'],
+        'wm', str(tmp_path))
+
+    [x0, x1, y0, y1, z0, z1] = tracking_inputs['bbox']
+    assert [x0, x1, y0, y1, z0, z1] == [3, 15, 2, 13, 1, 16]
+    mod_fit = np.load(tracking_inputs['recon'], mmap_mode='r')
+    assert mod_fit.dtype == 'float64'
+    assert np.allclose(mod_fit, recon[x0:x1, y0:y1, z0:z1])
+    for tissue_map in tracking_inputs['tissue_maps']:
+        assert np.load(tissue_map).shape == mod_fit.shape[:3]
+
+
+def test_get_tracker():
+    """
+    Test for get_tracker functionality
+    """
+    import tempfile
+    from pynets.dmri import track
+    from dipy.data import get_sphere
+
+    temp_dir = tempfile.TemporaryDirectory()
+    tracking_inputs = {'run_id': 'a', 'tiss_class': 'wm',
+                       'recon': f"{temp_dir.name}/reconstruction.npy",
+                       'tissue_maps': [f"{temp_dir.name}/tissue_map.npy"],
+                       'voxel_size': 2.0}
+    np.save(tracking_inputs['recon'], np.ones((4, 4, 4, 15)))
+    np.save(tracking_inputs['tissue_maps'][0], np.ones((4, 4, 4), dtype=bool))
+    sphere = get_sphere('repulsion724')
+
+    tracker = track.get_tracker((0.5, 40), tracking_inputs, 'det', 20,
+                                sphere)
+    assert track.get_tracker((0.5, 40), tracking_inputs, 'det', 20,
+                             sphere) is tracker
+    assert track.get_tracker((0.5, 60), tracking_inputs, 'det', 20,
+                             sphere)[0] is not tracker[0]
+
+    tracking_inputs['run_id'] = 'b'
+    assert track.get_tracker((0.5, 40), tracking_inputs, 'det', 20,
+                             sphere) is not tracker
+
+
+def test_tracking_shards():
+    """
+    Test for save_tracking_shard and merge_tracking_shards functionality
+    """
+    import tempfile
+    from pynets.dmri import track
+    from nibabel.streamlines.array_sequence import ArraySequence
+
+    temp_dir = tempfile.TemporaryDirectory()
+    batches = [ArraySequence([np.random.rand(np.random.randint(2, 10),
+                                             3).astype('float32')
+                              for _ in range(n)]) for n in [5, 1, 12]]
+    shard_paths = [track.save_tracking_shard(batch, f"{temp_dir.name}/"
+                                                    f"shard_{i:05d}")
+                   for i, batch in enumerate(batches)]
+
+    streamlines = track.merge_tracking_shards(shard_paths)
+    expected = [s for batch in batches for s in batch]
+    assert len(streamlines) == len(expected)
+    for s, s_expected in zip(streamlines, expected):
+        assert np.array_equal(s, s_expected)
+
+    assert track.get_batch_seed(42, (0.2, 40), 3) == \
+        track.get_batch_seed(42, (0.2, 40), 3)
+    assert track.get_batch_seed(42, (0.2, 40), 3) != \
+        track.get_batch_seed(42, (0.2, 40), 4)
+    assert track.get_batch_seed(None, (0.2, 40), 3) is None
+    assert len(track.merge_tracking_shards([])) == 0
+
+
+def test_tracking_checkpoint_key():
+    """
+    Test for get_tracking_checkpoint_key functionality
+    """
+    import tempfile
+    from pynets.dmri import track
+
+    temp_dir = tempfile.TemporaryDirectory()
+    input_file = f"{temp_dir.name}/recon.npy"
+    np.save(input_file, np.zeros((4, 4, 4)))
+    run_params = {'directget': 'prob', 'min_length': 20}
+
+    key = track.get_tracking_checkpoint_key(run_params, [input_file, None])
+    assert key == track.get_tracking_checkpoint_key(run_params,
+                                                    [input_file, None])
+    assert key != track.get_tracking_checkpoint_key(
+        dict(run_params, min_length=10), [input_file, None])
+
+    # Same parameters, different input contents
+    np.save(input_file, np.ones((4, 4, 4)))
+    assert key != track.get_tracking_checkpoint_key(run_params,
+                                                    [input_file, None])
+    temp_dir.cleanup()
+
+
+def test_seed_budget_scheduler():
+    """
+    Test for SeedBudgetScheduler functionality
+    """
+    from pynets.dmri import track
+
+    scheduler = track.SeedBudgetScheduler(3, 100)
+    assert scheduler.allocate() == [100, 100, 100]
+
+    scheduler.update([100, 100, 100], [0, 50, 150], [10., 10., 10.])
+    seed_budget = scheduler.allocate()
+    assert sum(seed_budget) == 300
+    assert min(seed_budget) >= 25
+    assert seed_budget[0] < seed_budget[1] < seed_budget[2]
+
+    [per_seed, per_second] = scheduler.yields()
+    assert np.allclose(per_seed, [0, 0.5, 1.5])
+    assert np.allclose(per_second, [0, 5, 15])
+
+    restored = track.SeedBudgetScheduler(3, 100)
+    restored.set_state(scheduler.get_state())
+    assert restored.allocate() == seed_budget
+
+
 @pytest.mark.parametrize("conn_model", ['csa', 'csd', 'ten'])
 def test_reconstruction(conn_model):
     """
@@ -107,6 +297,72 @@ def test_reconstruction(conn_model):
     assert mod is not None
 
 
+@pytest.mark.parametrize("conn_model", ['csa', 'ten'])
+def test_reconstruction_blockwise(conn_model):
+    """
+    Test for reconstruction_blockwise functionality
+    """
+    import tempfile
+    from pynets.dmri import track
+    from dipy.core.gradients import gradient_table
+    from dipy.data import get_fnames
+    from dipy.io.gradients import read_bvals_bvecs
+    from dipy.sims.voxel import multi_tensor
+
+    bvals, bvecs = read_bvals_bvecs(*get_fnames('small_64D')[1:])
+    gtab = gradient_table(bvals, bvecs=bvecs)
+    mevals = np.array([[0.0015, 0.0003, 0.0003], [0.0015, 0.0003, 0.0003]])
+    rng = np.random.RandomState(0)
+    dwi_data = np.zeros((6, 5, 7, len(bvals)), dtype='float32')
+    for idx in np.ndindex(dwi_data.shape[:3]):
+        dwi_data[idx] = multi_tensor(gtab, mevals, S0=100,
+                                     angles=[(0, 0), (rng.uniform(0, 90),
+                                                      45)],
+                                     fractions=[50, 50], snr=20)[0]
+
+    temp_dir = tempfile.TemporaryDirectory()
+    B0_mask = f"{temp_dir.name}/B0_mask.nii.gz"
+    B0_mask_data = np.zeros(dwi_data.shape[:3], dtype='uint8')
+    B0_mask_data[1:5, 1:4, 2:6] = 1
+    nib.save(nib.Nifti1Image(B0_mask_data, np.eye(4)), B0_mask)
+
+    model, _ = track.reconstruction(conn_model, gtab, dwi_data, B0_mask)
+    recon_cache_dir = f"{temp_dir.name}/reconstructions"
+    recon_path = track.reconstruction_blockwise(
+        conn_model, gtab, dwi_data, B0_mask,
+        f"{temp_dir.name}/model_file.hdf5", nthreads=2, slab_size=3,
+        recon_cache_dir=recon_cache_dir)
+
+    with h5py.File(recon_path, 'r') as hf:
+        assert np.allclose(hf['reconstruction'][:], model.astype('float32'))
+        assert hf['reconstruction'].chunks[2:] == (3, model.shape[-1])
+        assert hf['reconstruction'].compression == 'lzf'
+        assert list(hf['reconstruction'].attrs['bbox']) == [1, 5, 1, 4, 2, 6]
+    hf.close()
+
+    # A rerun with identical inputs reuses the cached coefficients
+    recon_key = track.get_recon_cache_key(conn_model, gtab, dwi_data,
+                                          B0_mask_data)
+    assert os.listdir(recon_cache_dir) == [f"reconstruction_{recon_key}.hdf5"]
+    recon_path_cached = track.reconstruction_blockwise(
+        conn_model, gtab, dwi_data, B0_mask,
+        f"{temp_dir.name}/model_file_cached.hdf5",
+        recon_cache_dir=recon_cache_dir)
+    with h5py.File(recon_path_cached, 'r') as hf:
+        assert np.allclose(hf['reconstruction'][:], model.astype('float32'))
+    hf.close()
+    assert len(os.listdir(recon_cache_dir)) == 1
+
+    B0_mask_data[1, 1, 2] = 0
+    assert track.get_recon_cache_key(conn_model, gtab, dwi_data,
+                                     B0_mask_data) != recon_key
+    if conn_model == 'csa':
+        assert track.get_recon_cache_key(conn_model, gtab, dwi_data,
+                                         B0_mask_data, sh_order=6) != \
+            track.get_recon_cache_key(conn_model, gtab, dwi_data,
+                                      B0_mask_data)
+
+
 @pytest.mark.parametrize("directget", ['det', 'prob'])
 @pytest.mark.parametrize("target_samples",
                          [1000, pytest.param(0, marks=pytest.mark.xfail)])
@@ -118,6 +374,7 @@ def test_track_ensemble(directget, target_samples):
     from pynets.dmri import track
     from dipy.core.gradients import gradient_table
     from dipy.data import get_sphere
+    from dipy.tracking import utils
     from nibabel.streamlines.array_sequence import ArraySequence
 
     base_dir = str(Path(__file__).parent/"examples")
@@ -158,14 +415,58 @@ def test_track_ensemble(directget, target_samples):
                           data=model.astype('float32'))
     hf.close()
 
-    streamlines = track.track_ensemble(target_samples, atlas_data_wm_gm_int,
-                                       labels_im_file,
+    streamlines, density = track.track_ensemble(
+        target_samples, atlas_data_wm_gm_int, labels_im_file,
                    recon_path, sphere, directget, curv_thr_list, step_list,
                    track_type, maxcrossing, roi_neighborhood_tol, min_length,
                    waymask, B0_mask, gm_in_dwi, gm_in_dwi, vent_csf_in_dwi,
-                   wm_in_dwi, tiss_class, temp_dir.name)
+                   wm_in_dwi, tiss_class, temp_dir.name, return_density=True)
 
     assert isinstance(streamlines, ArraySequence)
+    assert np.array_equal(density, utils.density_map(streamlines, np.eye(4),
+                                                     density.shape))
+
+
+def test_track_ensemble_failure_cleanup(tmp_path):
+    """
+    Test that a failed ensemble tractography run removes its shared buffers
+    and shards
+    """
+    from pynets.dmri import track
+    from dipy.data import get_sphere
+
+    shape = (10, 10, 10)
+    mask = np.ones(shape, dtype='uint8')
+    labels = np.zeros(shape, dtype='uint16')
+    labels[2:4, 2:4, 2:4] = 1
+    labels[6:8, 6:8, 6:8] = 2
+    paths = {}
+    for name, data in [('B0_mask', mask), ('wm', mask.astype('float32')),
+                       ('gm', np.zeros(shape, dtype='float32')),
+                       ('csf', np.zeros(shape, dtype='float32')),
+                       ('labels', labels),
+                       ('wmgm', (labels > 0).astype('uint8'))]:
+        paths[name] = str(tmp_path/f"{name}.nii.gz")
+        nib.save(nib.Nifti1Image(data, np.eye(4)), paths[name])
+    recon_path = str(tmp_path/'recon.hdf5')
+    with h5py.File(recon_path, 'w') as hf:
+        hf.create_dataset("reconstruction",
+                          data=np.random.rand(*shape, 45).astype('float32'))
+    hf.close()
+
+    # No streamline can reach the minimum length
+    streamlines, density = track.track_ensemble(
+        1000, paths['wmgm'], paths['labels'], recon_path,
+        get_sphere('repulsion724'), 'prob', [40], [0.5], 'local', 2, 2,
+        1000, None, paths['B0_mask'], paths['B0_mask'], paths['gm'],
+        paths['csf'], paths['wm'], 'wb', str(tmp_path/'work'),
+        return_density=True, checkpoint_dir=str(tmp_path/'checkpoints'))
+
+    assert len(streamlines) == 0
+    assert not np.any(density)
+    assert not os.path.isdir(str(tmp_path/'work'/'joblib_tracking'))
+    if os.path.isdir(str(tmp_path/'checkpoints')):
+        assert len(os.listdir(str(tmp_path/'checkpoints'))) == 0
 
 
 def test_track_ensemble_particle():